@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+
+from ingest.config import (
+    JOB_BASE_MEMORY,
+    JOB_RESOURCE_FACTORS,
+    DEFAULT_JOB_RESOURCE_FACTORS,
+    INGEST_MEMORY_BUDGET_MB,
+    INGEST_DISK_BUDGET_MB
+)
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def available_memory() -> int:
+    """
+    Compute the RAM available to this process in bytes. Inside a container the cgroup limit is honoured
+    because /proc/meminfo reports the memory of the host.
+    @return: int, number of bytes
+    """
+    meminfo = dict()
+    with open('/proc/meminfo') as mi:
+        for line in mi:
+            name, value, *unit = line.split()
+            meminfo[name.strip(':')] = int(value) * 1024
+    available = meminfo.get('MemAvailable', meminfo.get('MemFree', 0))
+    for cgroup_limit_file in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(cgroup_limit_file) as cl:
+                limit = cl.read().strip()
+            if limit.isdigit():
+                available = min(available, int(limit))
+            break
+        except OSError:
+            continue
+    return available
+
+
+def available_disk(folder: str = None) -> int:
+    """
+    Compute the free space in bytes on the device hosting folder (defaults to the temporary folder)
+    """
+    return shutil.disk_usage(folder or tempfile.gettempdir()).free
+
+
+def estimate_job_resources(blob_path: str = None, size: int = None):
+    """
+    Estimate the RAM and temporary disk space required to ingest a blob
+    @param blob_path: str, the path of the blob, used to find out the format
+    @param size: int, the size of the blob in bytes
+    @return: tuple(memory, disk) in bytes
+    """
+    _, ext = os.path.splitext(blob_path.lower())
+    memory_factor, disk_factor = JOB_RESOURCE_FACTORS.get(ext, DEFAULT_JOB_RESOURCE_FACTORS)
+    size = size or 0
+    return JOB_BASE_MEMORY + int(size * memory_factor), int(size * disk_factor)
+
+
+class ResourceBudget:
+    """
+    Keeps track of the RAM and disk space reserved by the ingest jobs running concurrently in this process.
+    A job is admitted only if its estimated needs fit in what is left of the budget. A job that is larger than the
+    whole budget is admitted when no other job is running so it can not starve.
+    """
+
+    def __init__(self, memory: int = None, disk: int = None):
+        self.memory = memory if memory is not None else available_memory()
+        self.disk = disk if disk is not None else available_disk()
+        self.used_memory = 0
+        self.used_disk = 0
+        self.njobs = 0
+        self._condition = asyncio.Condition()
+
+    @classmethod
+    def from_config(cls):
+        memory = int(INGEST_MEMORY_BUDGET_MB) * MB if INGEST_MEMORY_BUDGET_MB else None
+        disk = int(INGEST_DISK_BUDGET_MB) * MB if INGEST_DISK_BUDGET_MB else None
+        budget = cls(memory=memory, disk=disk)
+        logger.info(f'Ingest resource budget is {budget.memory // MB} MB RAM and {budget.disk // MB} MB disk')
+        return budget
+
+    @property
+    def free_memory(self):
+        return self.memory - self.used_memory
+
+    @property
+    def free_disk(self):
+        return self.disk - self.used_disk
+
+    def fits(self, memory: int = 0, disk: int = 0) -> bool:
+        if self.njobs == 0:
+            return True
+        return memory <= self.free_memory and disk <= self.free_disk
+
+    async def acquire(self, memory: int = 0, disk: int = 0):
+        """
+        Wait until the memory and disk fit in the budget and reserve them
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.fits(memory=memory, disk=disk))
+            self.used_memory += memory
+            self.used_disk += disk
+            self.njobs += 1
+
+    async def release(self, memory: int = 0, disk: int = 0):
+        async with self._condition:
+            self.used_memory -= memory
+            self.used_disk -= disk
+            self.njobs -= 1
+            self._condition.notify_all()
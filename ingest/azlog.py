@@ -1,14 +1,43 @@
+import collections
+import contextvars
 import logging
-from azure.storage.blob import ContentSettings, ContainerClient
+import sys
+import threading
+from azure.storage.blob import ContentSettings
 from urllib.parse import urlparse
 import os
+
+from ingest.clients import container_client
+from ingest.config import INGEST_LOG_FLUSH_INTERVAL, INGEST_LOG_FLUSH_BYTES
+
+# the blob url of the job the current task/thread is working on. asyncio tasks and asyncio.to_thread
+# copy the context so the records logged while ingesting a blob can be routed to the log blob of that job
+current_blob_url = contextvars.ContextVar('current_blob_url', default=None)
+
+# the largest block that can be appended to an append blob
+MAX_APPEND_BLOCK = 4 * 1024 * 1024
+
+
 class AzureBlobStorageHandler(logging.Handler):
-    def __init__(self, connection_string=None, blob_url=None, log_level=None):
+    """
+    Appends the records of a job to its log blob. The records are buffered and a background thread appends them in
+    blocks of at most MAX_APPEND_BLOCK bytes every flush_interval seconds or as soon as flush_bytes bytes are waiting,
+    so the threads logging (GDAL, tippecanoe) never wait for the storage account. When the thread can not keep up
+    more than max_buffer_bytes the oldest records are dropped and a line telling how many is written instead.
+    close flushes the buffer and stops the thread.
+    """
+
+    def __init__(self, connection_string=None, blob_url=None, log_level=None,
+                 flush_interval: float = INGEST_LOG_FLUSH_INTERVAL, flush_bytes: int = INGEST_LOG_FLUSH_BYTES,
+                 max_buffer_bytes: int = 64 * 1024 * 1024):
         super().__init__()
 
         self.blob_url = blob_url
         self.connection_string = connection_string
         self.level = log_level
+        self.flush_interval = flush_interval
+        self.flush_bytes = min(flush_bytes, MAX_APPEND_BLOCK)
+        self.max_buffer_bytes = max_buffer_bytes
         self.container_client = None
         self.blob_client = None
         self.blob_name = None
@@ -16,6 +45,14 @@ class AzureBlobStorageHandler(logging.Handler):
         formatter = logging.Formatter('%(asctime)s-%(filename)s:%(funcName)s:%(lineno)d:%(levelname)s:%(message)s\n',
                                       "%Y-%m-%d %H:%M:%S")
         self.setFormatter(formatter)
+        self.buffer = collections.deque()
+        self.buffered_bytes = 0
+        self.dropped = 0
+        self.in_flight = False
+        self.closing = False
+        self.condition = threading.Condition()
+        self.flusher = threading.Thread(target=self.run, name='log-flusher', daemon=True)
+        self.flusher.start()
 
 
     def createBlob(self):
@@ -23,20 +60,101 @@ class AzureBlobStorageHandler(logging.Handler):
         path = urlparse(self.blob_url).path[1:]
         container_name, *rest, blob_name = path.split(os.path.sep)
         self.blob_name = os.path.join(*rest, f"{blob_name}.log")
-        self.container_client = ContainerClient.from_connection_string(conn_str=self.connection_string, container_name=container_name)
+        self.container_client = container_client(conn_string=self.connection_string, container_name=container_name)
         self.blob_client = self.container_client.get_blob_client(self.blob_name)
         content_settings = ContentSettings(content_type="text/plain")
         self.blob_client.create_append_blob(content_settings)
 
 
-    def emit(self, record):
-        # Write the log record to the blob
-        log_data = self.format(record).encode("utf-8")
-
-        self.blob_client.append_block(log_data)
+    def filter(self, record):
+        # records logged on behalf of other concurrently running jobs belong to their own log blob
+        job_blob_url = current_blob_url.get()
+        if job_blob_url is not None and job_blob_url != self.blob_url:
+            return False
+        return super().filter(record)
 
-    def __del__(self):
-        self.container_client.close()
+    def emit(self, record):
+        # queue the log record, it is written to the blob by the flusher thread
+        try:
+            log_data = self.format(record).encode("utf-8")
+        except Exception:
+            self.handleError(record)
+            return
+        with self.condition:
+            if self.closing:
+                return
+            self.buffer.append(log_data)
+            self.buffered_bytes += len(log_data)
+            while self.buffered_bytes > self.max_buffer_bytes and len(self.buffer) > 1:
+                self.buffered_bytes -= len(self.buffer.popleft())
+                self.dropped += 1
+            if self.buffered_bytes >= self.flush_bytes:
+                self.condition.notify_all()
+
+    def next_block(self) -> bytes:
+        """
+        Take up to MAX_APPEND_BLOCK bytes of records from the buffer, a larger record is split
+        """
+        chunks = list()
+        size = 0
+        if self.dropped:
+            chunks.append(f'... {self.dropped} log records were dropped, the log blob could not keep up\n'.encode())
+            size = len(chunks[0])
+            self.dropped = 0
+        while self.buffer and size + len(self.buffer[0]) <= MAX_APPEND_BLOCK:
+            log_data = self.buffer.popleft()
+            self.buffered_bytes -= len(log_data)
+            chunks.append(log_data)
+            size += len(log_data)
+        if self.buffer and not chunks:
+            log_data = self.buffer.popleft()
+            self.buffer.appendleft(log_data[MAX_APPEND_BLOCK:])
+            self.buffered_bytes -= MAX_APPEND_BLOCK
+            chunks.append(log_data[:MAX_APPEND_BLOCK])
+        return b''.join(chunks)
+
+    def run(self):
+        # the records of the flusher (azure SDK) do not belong to the log blob of any job
+        current_blob_url.set('')
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closing or self.buffered_bytes >= self.flush_bytes,
+                                        timeout=self.flush_interval)
+                if not self.buffer and not self.dropped:
+                    if self.closing:
+                        return
+                    continue
+                block = self.next_block()
+                self.in_flight = True
+            try:
+                self.blob_client.append_block(block)
+            except Exception as e:
+                sys.stderr.write(f'Failed to append {len(block)} bytes to {self.blob_name}: {e}\n')
+            finally:
+                with self.condition:
+                    self.in_flight = False
+                    self.condition.notify_all()
+
+    def flush(self, timeout: float = 30):
+        """
+        Wait until the buffered records have been appended to the log blob
+        """
+        with self.condition:
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: not self.buffer and not self.dropped and not self.in_flight
+                                    or not self.flusher.is_alive(), timeout=timeout)
+
+    def close(self):
+        """
+        Flush the buffered records and stop the flusher thread. The container client is shared, it stays open
+        """
+        with self.condition:
+            if self.closing:
+                return
+            self.closing = True
+            self.condition.notify_all()
+        self.flusher.join(timeout=30)
+        super().close()
 
 if __name__ == '__main__':
 
@@ -48,11 +166,10 @@ if __name__ == '__main__':
     azlogger.setLevel(logging.WARNING)
     sblogger = logging.getLogger("uamqp")
     sblogger.setLevel(logging.WARNING)
-    container_client = ContainerClient.from_connection_string(os.environ.get('CONNECTION_STRING'), container_name='userdata')
     # Add the Azure Blob Storage handler to the logger
     level = logging.INFO
 
-    handler = AzureBlobStorageHandler(container_client, blob_url=blob_url)
+    handler = AzureBlobStorageHandler(connection_string=os.environ.get('CONNECTION_STRING'), blob_url=blob_url)
     handler.setLevel(level)
 
     formatter = logging.Formatter('%(asctime)s-%(filename)s:%(funcName)s:%(lineno)d:%(levelname)s:%(message)s',
@@ -62,9 +179,7 @@ if __name__ == '__main__':
     logger.addHandler(handler)
 
     logger.info(f'Welcome to AZURE logging')
-
-
-    container_client.close()
+    handler.close()
 
 
 
@@ -0,0 +1,263 @@
+import datetime
+import hashlib
+import json
+import logging
+import threading
+import weakref
+
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import BlobLeaseClient, BlobServiceClient, ContentSettings
+
+from ingest.clients import blob_client as shared_blob_client, blob_service_client as shared_blob_service_client
+from ingest.utils import chop_blob_url, get_dst_blob_path
+
+logger = logging.getLogger(__name__)
+
+# the checkpoints of the jobs running in this process, flushed when the process is terminated
+_open_checkpoints = weakref.WeakSet()
+
+
+def checkpoint_blob_path(blob_url: str = None):
+    """
+    The manifest of a job is stored in the datasets folder of the job, next to its outputs. The raw folder triggers
+    ingest messages for every new blob.
+    @return: tuple(container_name, blob path relative to the container)
+    """
+    blob_path = chop_blob_url(blob_url)
+    *_, blob_name = blob_path.split("/")
+    container_name, *rest = get_dst_blob_path(blob_path=blob_path, file_name=f'{blob_name}.checkpoint.json').split("/")
+    return container_name, "/".join(rest)
+
+
+def source_version(properties=None) -> str:
+    """
+    Identify the content of the raw blob from its properties. The ETag can not be used, it changes whenever the stage
+    and the progress of the job are written to the metadata of the blob.
+    """
+    md5 = properties.content_settings.content_md5
+    return f'{properties.size}:{properties.creation_time.isoformat()}:{bytes(md5).hex() if md5 else ""}'
+
+
+class JobCheckpoint:
+    """
+    Keeps track of the units of a job (vector layer, raster band, subdataset) that have been converted and uploaded,
+    together with the ETag of their outputs, in a manifest blob. When the message of an interrupted job (evicted
+    pod, deployment) is delivered again the finished units are skipped.
+
+    A unit is written to the manifest as soon as it is finished. The manifest is updated with an ETag conditional
+    read-modify-write so several writers (workers of the same job) never overwrite each others units. A manifest
+    created for a different version of the raw blob (see source_version) is disregarded.
+
+    A job split into sub-jobs (one per unit) also stores its plan, the list of all its units. Every write is based on
+    the latest version of the manifest, so exactly one writer sees the manifest turn complete, the finisher.
+    """
+
+    def __init__(self, blob_url: str = None, conn_string: str = None):
+        self.blob_url = blob_url
+        self.conn_string = conn_string
+        self.container_name, self.manifest_path = checkpoint_blob_path(blob_url=blob_url)
+        self.source_version = None
+        self.units = dict()
+        self.pending = dict()
+        self.plan = None
+        self.plan_pending = False
+        self.finisher = False
+        # reentrant, the SIGTERM handler of a worker process flushes from the main thread
+        self.lock = threading.RLock()
+        _open_checkpoints.add(self)
+
+    @classmethod
+    def load(cls, blob_url: str = None, conn_string: str = None):
+        """
+        Read the manifest of the job ingesting blob_url
+        @return: instance of JobCheckpoint
+        """
+        checkpoint = cls(blob_url=blob_url, conn_string=conn_string)
+        container_name, *rest = chop_blob_url(blob_url).split("/")
+        blob_service_client = shared_blob_service_client(conn_string)
+        with blob_service_client.get_blob_client(container=container_name, blob="/".join(rest)) as blob_client:
+            checkpoint.source_version = source_version(blob_client.get_blob_properties())
+        manifest, _ = checkpoint.read(blob_service_client=blob_service_client)
+        if manifest.get('source_version') == checkpoint.source_version:
+            checkpoint.units = manifest.get('units', {})
+            checkpoint.plan = manifest.get('plan')
+            if checkpoint.units:
+                logger.info(f'Resuming {blob_url}, {len(checkpoint.units)} units were already ingested')
+        return checkpoint
+
+    def read(self, blob_service_client: BlobServiceClient = None):
+        """
+        @return: tuple(manifest dict, etag). The etag is None if the manifest does not exist
+        """
+        with blob_service_client.get_blob_client(container=self.container_name, blob=self.manifest_path) as blob_client:
+            try:
+                downloader = blob_client.download_blob()
+                return json.loads(downloader.readall()), downloader.properties.etag
+            except ResourceNotFoundError:
+                return dict(), None
+
+    def is_done(self, unit: str = None) -> bool:
+        return unit in self.units and self.units[unit].get('status', 'done') == 'done'
+
+    @staticmethod
+    def is_complete(manifest: dict = None) -> bool:
+        """
+        Whether all the units in the plan of a split job have been handled
+        """
+        plan = manifest.get('plan')
+        return bool(plan) and all(unit in manifest.get('units', {}) for unit in plan)
+
+    @property
+    def progress(self) -> int:
+        """
+        The progress of a split job, the download accounts for the first 30%
+        """
+        if not self.plan:
+            return 30
+        return 30 + int(70 * sum(1 for unit in self.plan if unit in self.units) / len(self.plan))
+
+    def set_plan(self, units: list = None):
+        """
+        Record the units of a job that is split into sub-jobs
+        """
+        with self.lock:
+            self.plan = units
+            self.plan_pending = True
+        self.flush()
+
+    def mark_done(self, unit: str = None, outputs: dict = None, status: str = 'done'):
+        """
+        Record unit as finished and write it to the manifest
+        @param unit: str, the id of the unit, e.g. layer:roads, band:3, subdataset:2
+        @param outputs: dict, the blob paths of the outputs of the unit and their ETag
+        @param status: str, done, failed or cancelled. Only the done units are skipped when a job is resumed
+        """
+        record = dict(outputs=outputs or {}, status=status, finished_at=datetime.datetime.utcnow().isoformat())
+        with self.lock:
+            self.units[unit] = record
+            self.pending[unit] = record
+        self.flush()
+
+    def flush(self, attempts: int = 5):
+        """
+        Merge the units not written yet into the manifest. Failures are logged and the units are written by the next
+        flush.
+        """
+        with self.lock:
+            if not self.pending and not self.plan_pending:
+                return
+            try:
+                blob_service_client = shared_blob_service_client(self.conn_string)
+                for attempt in range(1, attempts + 1):
+                    manifest, etag = self.read(blob_service_client=blob_service_client)
+                    if manifest.get('source_version') != self.source_version:
+                        manifest = dict(source_version=self.source_version, units={})
+                    was_complete = self.is_complete(manifest)
+                    manifest['units'].update(self.pending)
+                    if self.plan_pending:
+                        manifest['plan'] = self.plan
+                    if etag:
+                        conditions = dict(overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified)
+                    else:
+                        conditions = dict(overwrite=False)
+                    try:
+                        with blob_service_client.get_blob_client(container=self.container_name,
+                                                                 blob=self.manifest_path) as blob_client:
+                            blob_client.upload_blob(json.dumps(manifest, indent=2),
+                                                    content_settings=ContentSettings(
+                                                        content_type='application/json'),
+                                                    **conditions)
+                        self.units.update(manifest['units'])
+                        self.plan = manifest.get('plan')
+                        self.pending.clear()
+                        self.plan_pending = False
+                        self.finisher = self.finisher or (not was_complete and self.is_complete(manifest))
+                        return
+                    except (ResourceModifiedError, ResourceExistsError):
+                        logger.debug(f'{self.manifest_path} was modified concurrently, attempt {attempt}')
+                logger.error(f'Failed to update {self.manifest_path} after {attempts} attempts')
+            except Exception as e:
+                logger.error(f'Failed to update {self.manifest_path}: {e}')
+
+    def delete(self):
+        """
+        Remove the manifest once the job has been settled
+        """
+        _open_checkpoints.discard(self)
+        discard_checkpoint(blob_url=self.blob_url, conn_string=self.conn_string)
+
+
+class UnitClaim:
+    """
+    Claims a unit of a split job through a lease on a claim blob stored next to the manifest so a unit is not
+    converted twice when its message is delivered more than once. The lease is renewed in the background until the
+    claim is released. If the consumer holding it dies the lease expires and the redelivered message can claim it.
+    """
+
+    def __init__(self, checkpoint: JobCheckpoint = None, unit: str = None, lease_duration: int = 60):
+        self.lease_duration = lease_duration
+        claim_path = f'{checkpoint.manifest_path}.{hashlib.md5(unit.encode()).hexdigest()}.claim'
+        self.blob_client = shared_blob_client(conn_string=checkpoint.conn_string,
+                                              container_name=checkpoint.container_name, blob_name=claim_path)
+        self.lease = None
+        self.stop_event = threading.Event()
+        self.renewer = None
+
+    def acquire(self) -> bool:
+        """
+        @return: False if the unit is claimed by somebody else
+        """
+        try:
+            self.blob_client.upload_blob(b'', overwrite=False)
+        except (ResourceExistsError, HttpResponseError):
+            # the claim blob exists and may be leased
+            pass
+        lease = BlobLeaseClient(client=self.blob_client)
+        try:
+            lease.acquire(lease_duration=self.lease_duration)
+        except HttpResponseError as e:
+            if e.status_code == 409:
+                return False
+            raise
+        self.lease = lease
+        self.renewer = threading.Thread(target=self.renew, name='unit-claim', daemon=True)
+        self.renewer.start()
+        return True
+
+    def renew(self):
+        while not self.stop_event.wait(self.lease_duration / 3):
+            try:
+                self.lease.renew()
+            except Exception as e:
+                logger.error(f'Failed to renew the lease on {self.blob_client.blob_name}: {e}')
+
+    def release(self):
+        if self.lease is None:
+            return
+        self.stop_event.set()
+        self.renewer.join()
+        try:
+            self.blob_client.delete_blob(lease=self.lease)
+        except Exception as e:
+            logger.error(f'Failed to release {self.blob_client.blob_name}: {e}')
+
+
+def discard_checkpoint(blob_url: str = None, conn_string: str = None):
+    container_name, manifest_path = checkpoint_blob_path(blob_url=blob_url)
+    try:
+        blob_service_client = shared_blob_service_client(conn_string)
+        with blob_service_client.get_blob_client(container=container_name, blob=manifest_path) as blob_client:
+            blob_client.delete_blob()
+    except ResourceNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f'Failed to delete {manifest_path}: {e}')
+
+
+def flush_checkpoints():
+    """
+    Write the pending units of all the jobs of this process, used when the process is being terminated
+    """
+    for checkpoint in list(_open_checkpoints):
+        checkpoint.flush()
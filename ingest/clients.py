@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+import threading
+import weakref
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import AioHttpTransport, RequestsTransport
+from azure.storage.blob import BlobClient, BlobServiceClient, ContainerClient
+from azure.storage.blob.aio import BlobServiceClient as ABlobServiceClient
+from urllib3.util.retry import Retry
+
+from ingest.config import INGEST_HTTP_POOL_SIZE, INGEST_HTTP_KEEPALIVE
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# (pid, connection string) -> (sync BlobServiceClient, requests session)
+_clients = dict()
+# event loop -> {connection string: (async BlobServiceClient, aiohttp session)}, an aiohttp session is bound to the
+# loop it was created in
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def blob_service_client(conn_string: str = None) -> BlobServiceClient:
+    """
+    The sync service client of the storage account shared by all the threads of this process. The container and blob
+    clients it hands out share its connection pool, closing them leaves the pool open, so they are meant to be
+    used without closing the service client
+    @param conn_string: str, the connection string of the storage account
+    """
+    key = os.getpid(), conn_string
+    with _lock:
+        if key not in _clients:
+            session = requests.Session()
+            # the retries are done by the azure pipeline, like in the transport azure-core creates by default
+            adapter = HTTPAdapter(pool_connections=INGEST_HTTP_POOL_SIZE, pool_maxsize=INGEST_HTTP_POOL_SIZE,
+                                  max_retries=Retry(total=False, redirect=False, raise_on_status=False))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            transport = RequestsTransport(session=session, session_owner=False)
+            _clients[key] = BlobServiceClient.from_connection_string(conn_string, transport=transport), session
+        client, _ = _clients[key]
+        return client
+
+
+def container_client(conn_string: str = None, container_name: str = None) -> ContainerClient:
+    return blob_service_client(conn_string).get_container_client(container_name)
+
+
+def blob_client(conn_string: str = None, container_name: str = None, blob_name: str = None) -> BlobClient:
+    return blob_service_client(conn_string).get_blob_client(container=container_name, blob=blob_name)
+
+
+def async_blob_service_client(conn_string: str = None) -> ABlobServiceClient:
+    """
+    The async service client of the storage account shared by the tasks of the running event loop, see
+    blob_service_client. The loops that are not closed with the process (asyncio.run) have to call
+    close_async_clients before they end
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, dict())
+    if conn_string not in clients:
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=INGEST_HTTP_POOL_SIZE,
+                                                                       keepalive_timeout=INGEST_HTTP_KEEPALIVE))
+        transport = AioHttpTransport(session=session, session_owner=False)
+        clients[conn_string] = ABlobServiceClient.from_connection_string(conn_string, transport=transport), session
+    client, _ = clients[conn_string]
+    return client
+
+
+async def close_async_clients():
+    """
+    Close the async clients of the running event loop
+    """
+    clients = _async_clients.pop(asyncio.get_running_loop(), dict())
+    for client, session in clients.values():
+        await client.close()
+        await session.close()
+
+
+def close_clients():
+    """
+    Close the sync clients of this process
+    """
+    with _lock:
+        for (pid, conn_string), (client, session) in list(_clients.items()):
+            if pid == os.getpid():
+                client.close()
+                session.close()
+            del _clients[pid, conn_string]
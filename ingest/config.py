@@ -1,5 +1,6 @@
 import logging
 import os
+import tempfile
 from azure.messaging.webpubsubservice import WebPubSubServiceClient
 from rio_cogeo.profiles import cog_profiles
 
@@ -29,6 +30,190 @@ attribution = "United Nations Development Programme (UNDP)"
 # os.environ["AZURE_STORAGE_ACCOUNT"] = account_name
 # os.environ["AZURE_STORAGE_CONNECTION_STRING"] = connection_string
 AZURE_WEBPUBSUB_GROUP_NAME = 'datapipeline'
+
+# concurrent ingestion. By default the messages are ingested one by one (INGEST_MAX_WORKERS=1).
+# When more workers are configured a job is only started if its estimated RAM and temporary disk needs fit into
+# what is left from the budgets below. The budgets default to the free RAM/disk detected at startup.
+INGEST_MAX_WORKERS = int(os.getenv('INGEST_MAX_WORKERS', 1))
+INGEST_MEMORY_BUDGET_MB = os.getenv('INGEST_MEMORY_BUDGET_MB')
+INGEST_DISK_BUDGET_MB = os.getenv('INGEST_DISK_BUDGET_MB')
+# the RAM a job uses regardless of the size of the data file (GDAL block cache, tippecanoe, python)
+JOB_BASE_MEMORY = 512 * 1024 * 1024
+# (memory factor, disk factor) multiplied with the blob size to estimate the resources a job requires.
+# The disk factor covers the downloaded file, the intermediary FlatGeobuf files and the PMTiles/COG outputs.
+# Archives are compressed and expand considerably once they are read.
+JOB_RESOURCE_FACTORS = {
+    ".zip": (1.0, 6.0),
+    ".gz": (1.0, 6.0),
+    ".tar": (0.5, 4.0),
+    ".tgz": (1.0, 6.0),
+    ".7z": (1.0, 6.0),
+    ".tif": (0.25, 2.5),
+    ".tiff": (0.25, 2.5),
+    ".nc": (0.5, 3.0),
+    ".geojson": (1.5, 4.0),
+    ".json": (1.5, 4.0),
+    ".csv": (1.5, 4.0),
+    ".gpkg": (0.5, 4.0),
+    ".fgb": (0.5, 3.0),
+    ".pmtiles": (0.0, 0.0),  # copied server side
+}
+DEFAULT_JOB_RESOURCE_FACTORS = (1.0, 4.0)
+
+# execution backend for sync_ingest, "thread" or "process". The process backend runs the jobs in a pool of
+# pre-forked worker processes that are recycled after INGEST_WORKER_MAX_JOBS jobs or once their peak RSS exceeds
+# INGEST_WORKER_MAX_RSS_MB and are killed (with their whole process group) on timeout/cancel.
+INGEST_BACKEND = os.getenv('INGEST_BACKEND', 'thread')
+INGEST_WORKER_MAX_JOBS = int(os.getenv('INGEST_WORKER_MAX_JOBS', 20))
+INGEST_WORKER_MAX_RSS_MB = int(os.getenv('INGEST_WORKER_MAX_RSS_MB', 4096))
+# a cancelled or timed out job is killed at once (within 0.2 seconds), it is not resumed. The worker of a job stopped
+# because the consumer is draining gets INGEST_WORKER_KILL_GRACE seconds to flush the checkpoint of the job
+INGEST_WORKER_KILL_GRACE = float(os.getenv('INGEST_WORKER_KILL_GRACE', 2))
+
+# download-ahead. Up to INGEST_PREFETCH_COUNT messages are received (and locked) while all workers are busy and
+# their blobs are downloaded in the background into a spool folder holding at most INGEST_PREFETCH_SPOOL_MB
+INGEST_PREFETCH_COUNT = int(os.getenv('INGEST_PREFETCH_COUNT', 0))
+INGEST_PREFETCH_SPOOL_MB = int(os.getenv('INGEST_PREFETCH_SPOOL_MB', 10240))
+INGEST_PREFETCH_SPOOL_DIR = os.getenv('INGEST_PREFETCH_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'ingest-spool'))
+
+# job scheduling. The messages of a received batch are ordered shortest job first by their cost, the blob size times
+# the disk factor of its format, with every second spent waiting worth INGEST_SJF_AGING_MB of cost so a large job can
+# not be starved. Both of the following are opt-in, by default a pod runs INGEST_MAX_WORKERS jobs and holds no more
+# messages than that (plus INGEST_PREFETCH_COUNT). With INGEST_HEAVY_WORKERS > 0 the blobs of INGEST_HEAVY_JOB_MB or
+# more run in a separate heavy lane of that many extra workers so they do not hold up the small uploads arriving behind
+# them. INGEST_SCHEDULER_LOOKAHEAD extra messages are received (and their locks renewed) while the workers are busy so
+# they can be reordered, they can not be consumed by idle pods meanwhile.
+INGEST_HEAVY_JOB_MB = int(os.getenv('INGEST_HEAVY_JOB_MB', 2048))
+INGEST_HEAVY_WORKERS = int(os.getenv('INGEST_HEAVY_WORKERS', 0))
+INGEST_SJF_AGING_MB = float(os.getenv('INGEST_SJF_AGING_MB', 10))
+INGEST_SCHEDULER_LOOKAHEAD = int(os.getenv('INGEST_SCHEDULER_LOOKAHEAD', 0))
+# per user fair share. A user with INGEST_MAX_JOBS_PER_USER jobs running (0 means no limit) is passed over while the
+# jobs of other users are waiting, a user alone in the queue still gets every free worker. The free workers go to the
+# user who has received the least service (cost of the started jobs divided by the user's weight). The other users are
+# only seen if their messages are received, the fair share behind a bulk upload needs INGEST_SCHEDULER_LOOKAHEAD.
+# INGEST_USER_WEIGHTS is a comma separated list of user=weight pairs, the users not listed weigh 1
+INGEST_MAX_JOBS_PER_USER = int(os.getenv('INGEST_MAX_JOBS_PER_USER', 2))
+INGEST_USER_WEIGHTS = {
+    user.strip(): float(weight) for user, weight in
+    (pair.split('=') for pair in os.getenv('INGEST_USER_WEIGHTS', '').split(',') if '=' in pair)
+}
+
+# daemon mode. Instead of exiting when the queue is empty the consumer keeps the receiver and the other clients open
+# and polls with a receive wait time that doubles while the queue is idle (up to INGEST_POLL_MAX_WAIT seconds) and
+# drops back to INGEST_POLL_MIN_WAIT as soon as a message arrives. With INGEST_IDLE_EXIT_SECONDS > 0 the daemon exits
+# after being idle (no messages, no jobs) for that long, for scale-to-zero deployments.
+INGEST_DAEMON = os.getenv('INGEST_DAEMON', 'false').lower() in ('1', 'true', 'yes')
+INGEST_POLL_MIN_WAIT = int(os.getenv('INGEST_POLL_MIN_WAIT', 5))
+INGEST_POLL_MAX_WAIT = int(os.getenv('INGEST_POLL_MAX_WAIT', 60))
+INGEST_IDLE_EXIT_SECONDS = int(os.getenv('INGEST_IDLE_EXIT_SECONDS', 0))
+# on SIGTERM the consumer stops receiving and gives the running jobs INGEST_DRAIN_SECONDS to finish. The jobs still
+# running after that are stopped, their checkpoint is flushed and their message is abandoned to be delivered again
+INGEST_DRAIN_SECONDS = int(os.getenv('INGEST_DRAIN_SECONDS', 20))
+# a job running in a thread can not be killed. When it is stopped (drain, timeout, lost lock) its timeout_event is set
+# and the thread is given INGEST_THREAD_STOP_SECONDS to notice it before the message is settled
+INGEST_THREAD_STOP_SECONDS = int(os.getenv('INGEST_THREAD_STOP_SECONDS', 30))
+# a file with at least INGEST_SPLIT_MIN_UNITS units (vector layers, raster bands, subdatasets) is split into one
+# sub-job message per unit so the units are converted by all the pods consuming the queue. 0 disables the splitting
+INGEST_SPLIT_MIN_UNITS = int(os.getenv('INGEST_SPLIT_MIN_UNITS', 0))
+# the sub-jobs of a split job running on the same host share one copy of the raw blob in INGEST_UNIT_CACHE_DIR. The copy
+# is removed by the sub-job finishing the job or once it has not been used for INGEST_UNIT_CACHE_HOURS
+INGEST_UNIT_CACHE_DIR = os.getenv('INGEST_UNIT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ingest-units'))
+INGEST_UNIT_CACHE_HOURS = float(os.getenv('INGEST_UNIT_CACHE_HOURS', 1))
+
+# job ledger. Every ingested job is recorded (format, size, layers, bands, features, stage durations) in a SQLite file
+# and once INGEST_LEDGER_MIN_JOBS jobs are recorded a model fitted on them predicts the runtime of the new jobs. A job
+# is given the predicted runtime times INGEST_TIMEOUT_FACTOR, clamped to [INGEST_TIMEOUT_MIN, INGEST_TIMEOUT_MAX]
+# seconds, before it is cancelled, and INGEST_TIMEOUT seconds until the model is available. The prediction is also
+# used as the cost of a job by the scheduler and to send an ETA with the progress messages. The ledger is kept across
+# restarts only if INGEST_LEDGER_PATH is on a persistent volume, under the default temp folder a pod that is replaced
+# (or runs a single job) never records INGEST_LEDGER_MIN_JOBS jobs and always uses INGEST_TIMEOUT
+INGEST_LEDGER_PATH = os.getenv('INGEST_LEDGER_PATH', os.path.join(tempfile.gettempdir(), 'ingest-ledger.sqlite'))
+INGEST_LEDGER_MIN_JOBS = int(os.getenv('INGEST_LEDGER_MIN_JOBS', 20))
+INGEST_TIMEOUT = int(os.getenv('INGEST_TIMEOUT', 3600))
+INGEST_TIMEOUT_FACTOR = float(os.getenv('INGEST_TIMEOUT_FACTOR', 3))
+INGEST_TIMEOUT_MIN = int(os.getenv('INGEST_TIMEOUT_MIN', 300))
+INGEST_TIMEOUT_MAX = int(os.getenv('INGEST_TIMEOUT_MAX', 14400))
+
+# the consumer serves its capacity and backlog in the Prometheus text format on http://<pod>:INGEST_METRICS_PORT/metrics
+# so the deployment can be scaled on the work waiting instead of the number of messages. 0 disables the endpoint
+INGEST_METRICS_PORT = int(os.getenv('INGEST_METRICS_PORT', 0))
+
+# the stack of the call blocking the event loop of the consumer for longer than INGEST_LOOP_LAG_THRESHOLD seconds is
+# logged. A blocked loop delays the lock renewals and the cancel requests. 0 disables the monitor
+INGEST_LOOP_LAG_THRESHOLD = float(os.getenv('INGEST_LOOP_LAG_THRESHOLD', 0.5))
+
+# the progress of the jobs is published from a background thread. Only the latest progress of a blob is kept, the
+# stage/progress metadata of a raw blob is written at most every INGEST_PROGRESS_METADATA_INTERVAL seconds (the final
+# stage right away) and the progress of at most INGEST_PROGRESS_MAX_BLOBS blobs is held at once
+INGEST_PROGRESS_METADATA_INTERVAL = float(os.getenv('INGEST_PROGRESS_METADATA_INTERVAL', 10))
+INGEST_PROGRESS_MAX_BLOBS = int(os.getenv('INGEST_PROGRESS_MAX_BLOBS', 1000))
+
+# while a unit (layer, band, subdataset) is converted the progress reported by GDAL, rio-cogeo and tippecanoe is
+# published within the share of the unit, at most every INGEST_PROGRESS_UPDATE_INTERVAL seconds and only once it has
+# advanced by INGEST_PROGRESS_UPDATE_STEP percent
+INGEST_PROGRESS_UPDATE_INTERVAL = float(os.getenv('INGEST_PROGRESS_UPDATE_INTERVAL', 2))
+INGEST_PROGRESS_UPDATE_STEP = int(os.getenv('INGEST_PROGRESS_UPDATE_STEP', 1))
+
+# the stage, progress, user and job id are also kept as index tags of the raw blob (ingest_stage, ingest_progress,
+# ingest_user, ingest_job) so the jobs can be found with a tag query instead of listing the container. The tags are
+# only written if nobody else has changed them since they were read. They are skipped on the accounts with a
+# hierarchical namespace (no index tags) and for the credentials without the tag permission (403)
+INGEST_PROGRESS_TAGS = os.getenv('INGEST_PROGRESS_TAGS', 'true').lower() in ('1', 'true', 'yes')
+
+# the records of a job are buffered and appended to its log blob by a background thread every
+# INGEST_LOG_FLUSH_INTERVAL seconds or as soon as INGEST_LOG_FLUSH_BYTES bytes are waiting, in blocks of at most 4 MiB
+INGEST_LOG_FLUSH_INTERVAL = float(os.getenv('INGEST_LOG_FLUSH_INTERVAL', 2))
+INGEST_LOG_FLUSH_BYTES = int(os.getenv('INGEST_LOG_FLUSH_BYTES', 1024 * 1024))
+
+# the storage clients of a process share one HTTP connection pool per storage account (and event loop) holding up to
+# INGEST_HTTP_POOL_SIZE connections, the idle connections of the async pool are kept alive INGEST_HTTP_KEEPALIVE seconds
+INGEST_HTTP_POOL_SIZE = int(os.getenv('INGEST_HTTP_POOL_SIZE', 32))
+INGEST_HTTP_KEEPALIVE = float(os.getenv('INGEST_HTTP_KEEPALIVE', 60))
+
+# the raw blob is downloaded with INGEST_DOWNLOAD_CONCURRENCY concurrent range GETs at first, each range is sized from
+# the measured throughput to take about INGEST_DOWNLOAD_RANGE_SECONDS, which bounds how long a cancelled download
+# lingers
+INGEST_DOWNLOAD_CONCURRENCY = int(os.getenv('INGEST_DOWNLOAD_CONCURRENCY', 8))
+INGEST_DOWNLOAD_RANGE_SECONDS = float(os.getenv('INGEST_DOWNLOAD_RANGE_SECONDS', 0.5))
+
+# the raw blob is downloaded into INGEST_DOWNLOAD_RESUME_DIR together with a sidecar listing the completed ranges, a
+# download that failed is resumed when the message is delivered again unless it is older than
+# INGEST_DOWNLOAD_RESUME_HOURS. An empty INGEST_DOWNLOAD_RESUME_DIR disables resuming
+INGEST_DOWNLOAD_RESUME_DIR = os.getenv('INGEST_DOWNLOAD_RESUME_DIR',
+                                       os.path.join(tempfile.gettempdir(), 'ingest-downloads'))
+INGEST_DOWNLOAD_RESUME_HOURS = float(os.getenv('INGEST_DOWNLOAD_RESUME_HOURS', 24))
+
+# the outputs of INGEST_UPLOAD_BLOCK_THRESHOLD_MB or more are uploaded as staged blocks of at most INGEST_UPLOAD_BLOCK_MB,
+# a failed upload is retried without staging the blocks that succeeded again. INGEST_UPLOAD_CONCURRENCY blocks are
+# staged concurrently at first
+INGEST_UPLOAD_BLOCK_THRESHOLD_MB = int(os.getenv('INGEST_UPLOAD_BLOCK_THRESHOLD_MB', 256))
+INGEST_UPLOAD_BLOCK_MB = int(os.getenv('INGEST_UPLOAD_BLOCK_MB', 32))
+INGEST_UPLOAD_CONCURRENCY = int(os.getenv('INGEST_UPLOAD_CONCURRENCY', 8))
+
+# the requests in flight of the uploads and downloads are adapted with AIMD to the throughput and the throttling of
+# the storage account, up to INGEST_TRANSFER_MAX_CONCURRENCY. The best concurrency of every storage account is kept
+# in INGEST_TRANSFER_STATE_PATH and used by the next transfers
+INGEST_TRANSFER_MAX_CONCURRENCY = int(os.getenv('INGEST_TRANSFER_MAX_CONCURRENCY', 32))
+INGEST_TRANSFER_STATE_PATH = os.getenv('INGEST_TRANSFER_STATE_PATH',
+                                       os.path.join(tempfile.gettempdir(), 'ingest-transfer.json'))
+
+# the outputs of a job are uploaded in the background by INGEST_UPLOAD_QUEUE_WORKERS threads while the next unit is
+# converted, the conversion waits when INGEST_UPLOAD_QUEUE_SIZE outputs are waiting to be uploaded
+INGEST_UPLOAD_QUEUE_WORKERS = int(os.getenv('INGEST_UPLOAD_QUEUE_WORKERS', 2))
+INGEST_UPLOAD_QUEUE_SIZE = int(os.getenv('INGEST_UPLOAD_QUEUE_SIZE', 4))
+
+# queue backend, "servicebus" (production) or "local", a SQLite backed stand-in with the same peek-lock semantics used
+# to benchmark the consumer without a service bus namespace
+INGEST_QUEUE_BACKEND = os.getenv('INGEST_QUEUE_BACKEND', 'servicebus')
+INGEST_LOCAL_QUEUE_PATH = os.getenv('INGEST_LOCAL_QUEUE_PATH', os.path.join(tempfile.gettempdir(), 'ingest-queue.sqlite'))
+INGEST_LOCAL_QUEUE_LOCK_SECONDS = int(os.getenv('INGEST_LOCAL_QUEUE_LOCK_SECONDS', 60))
+INGEST_LOCAL_QUEUE_MAX_DELIVERY_COUNT = int(os.getenv('INGEST_LOCAL_QUEUE_MAX_DELIVERY_COUNT', 10))
+
+# the message locks are renewed INGEST_LOCK_RENEWAL_MARGIN seconds before they expire. The renewals falling due within
+# INGEST_LOCK_RENEWAL_BATCH_WINDOW seconds of each other are sent together
+INGEST_LOCK_RENEWAL_MARGIN = float(os.getenv('INGEST_LOCK_RENEWAL_MARGIN', 10))
+INGEST_LOCK_RENEWAL_BATCH_WINDOW = float(os.getenv('INGEST_LOCK_RENEWAL_BATCH_WINDOW', 2))
+
 GDAL_ARCHIVE_FORMATS = {
     ".zip": "/vsizip/",
     ".gz": "/vsigzip/",
@@ -133,6 +318,9 @@ def setup_env_vars():
     assert connection_string is not None, f"AZURE_STORAGE_CONNECTION_STRING env var is not set"
     account_name = connection_string.split(';')[1].split('=')[1]
     os.environ["AZURE_STORAGE_ACCOUNT"] = account_name
-    service_bus_connection = os.environ['SERVICE_BUS_CONNECTION_STRING']
-    queue_name = service_bus_connection.split(';')[-1].split('=')[1]
-    os.environ['SERVICE_BUS_QUEUE_NAME'] = queue_name
\ No newline at end of file
+    service_bus_connection = os.environ.get('SERVICE_BUS_CONNECTION_STRING')
+    if INGEST_QUEUE_BACKEND == 'servicebus':
+        assert service_bus_connection is not None, f"SERVICE_BUS_CONNECTION_STRING env var is not set"
+    if service_bus_connection:
+        queue_name = service_bus_connection.split(';')[-1].split('=')[1]
+        os.environ['SERVICE_BUS_QUEUE_NAME'] = queue_name
\ No newline at end of file
@@ -0,0 +1,130 @@
+import datetime
+import logging
+import threading
+import time
+import weakref
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import ContentSettings
+
+from ingest.azblob import upload_content_to_blob
+from ingest.clients import blob_client
+from ingest.utils import chop_blob_url
+
+logger = logging.getLogger(__name__)
+
+# the diagnostics of the jobs running in this process, flushed when the process is terminated
+_open_diagnostics = weakref.WeakSet()
+
+# the largest block that can be appended to an append blob
+MAX_APPEND_BLOCK = 4 * 1024 * 1024
+
+
+def error_blob_path(blob_url: str = None):
+    """
+    The errors of a job are written to an .error blob next to its raw blob
+    @return: tuple(container_name, blob path relative to the container)
+    """
+    container_name, *rest, blob_name = chop_blob_url(blob_url).split("/")
+    return container_name, f'{"/".join(rest)}/{blob_name}.error'
+
+
+class JobDiagnostics:
+    """
+    Collects the errors and warnings of a job (failed layers and bands, layers that lost features, timeouts) in memory
+    and writes them to the .error blob of the job in one request instead of one exists/create/append round for every
+    message.
+
+    The entries are appended to the blob when the job ends, when the checkpoint of the job is written (at most every
+    flush_interval seconds) and when the worker running the job is terminated (see flush_diagnostics). The .error blob
+    is an append blob, the sub-jobs of a split job append their entries to the same blob.
+    """
+
+    def __init__(self, blob_url: str = None, conn_string: str = None, flush_interval: float = 60):
+        self.blob_url = blob_url
+        self.conn_string = conn_string
+        self.flush_interval = flush_interval
+        self.container_name, self.blob_path = error_blob_path(blob_url=blob_url)
+        self.entries = list()
+        # the number of entries already appended to the blob
+        self.flushed = 0
+        self.flushed_at = time.monotonic()
+        # reentrant, the SIGTERM handler of a worker process flushes from the main thread
+        self.lock = threading.RLock()
+        _open_diagnostics.add(self)
+
+    def add(self, message: str = None, unit: str = None, level: str = 'error'):
+        """
+        Record an entry
+        @param message: str, the text written to the .error blob
+        @param unit: optional, the unit (layer, band, subdataset) the entry is about
+        @param level: str, error or warning
+        """
+        with self.lock:
+            self.entries.append(dict(unit=unit, level=level, message=message,
+                                     at=datetime.datetime.utcnow().isoformat()))
+
+    def checkpoint(self):
+        """
+        Flush the entries if they have not been flushed for flush_interval seconds, called once a unit is finished
+        """
+        if time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Append the entries not written yet to the .error blob. Failures are logged and the entries are written by the
+        next flush.
+        """
+        with self.lock:
+            self.flushed_at = time.monotonic()
+            pending = self.entries[self.flushed:]
+            if not pending:
+                return
+            content = ''.join(f'{entry["message"].rstrip()}\n' for entry in pending).encode('utf-8')
+            try:
+                error_blob_client = blob_client(conn_string=self.conn_string, container_name=self.container_name,
+                                                blob_name=self.blob_path)
+                for offset in range(0, len(content), MAX_APPEND_BLOCK):
+                    block = content[offset:offset + MAX_APPEND_BLOCK]
+                    try:
+                        error_blob_client.append_block(block)
+                    except ResourceNotFoundError:
+                        error_blob_client.create_append_blob(content_settings=ContentSettings(content_type='text/plain'))
+                        error_blob_client.append_block(block)
+                self.flushed += len(pending)
+                logger.info(f'Wrote {len(pending)} diagnostics entries to {self.blob_path}')
+            except Exception as e:
+                logger.error(f'Failed to write the diagnostics of {self.blob_url} to {self.blob_path}: {e}')
+
+    def close(self):
+        """
+        Flush the entries once the job has ended
+        """
+        _open_diagnostics.discard(self)
+        self.flush()
+
+
+def report_error(message: str = None, blob_url: str = None, conn_string: str = None, unit: str = None,
+                 level: str = 'error', diagnostics: JobDiagnostics = None):
+    """
+    Record an error of a job in its diagnostics or, without diagnostics (command line conversions), upload it to the
+    .error blob right away
+    """
+    if diagnostics is not None:
+        diagnostics.add(message=message, unit=unit, level=level)
+        return
+    if conn_string is None:
+        return
+    container_name, blob_path = error_blob_path(blob_url=blob_url)
+    logger.info(f'Uploading error message to {blob_path}')
+    upload_content_to_blob(content=message, connection_string=conn_string, container_name=container_name,
+                           dst_blob_path=blob_path)
+
+
+def flush_diagnostics():
+    """
+    Write the pending entries of all the jobs of this process, used when the process is being terminated
+    """
+    for diagnostics in list(_open_diagnostics):
+        diagnostics.flush()
@@ -0,0 +1,581 @@
+import contextlib
+import contextvars
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import threading
+import time
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobClient
+
+from ingest.checkpoint import source_version
+from ingest.clients import blob_client
+from ingest.ingest_exceptions import DownloadIntegrityError
+from ingest.transfer import TransferController
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# the ranges are multiples of ALIGNMENT between MIN_RANGE and MAX_RANGE. A range up to the max_single_get_size of the
+# SDK (32 MiB) is fetched with one GET
+ALIGNMENT = 256 * 1024
+MIN_RANGE = 1 * MB
+MAX_RANGE = 32 * MB
+# the size of the first ranges, before the throughput has been measured
+INITIAL_RANGE = 4 * MB
+# how often the cancellation event is checked while the ranges are downloaded
+POLL_INTERVAL = 0.2
+# the completed ranges are written to the sidecar at most every SIDECAR_INTERVAL seconds
+SIDECAR_INTERVAL = 2
+# the backoff between the attempts to download a range, doubled after every attempt
+BACKOFF = 0.5
+MAX_BACKOFF = 16
+
+
+class RangeDownloader:
+    """
+    Downloads a blob into a local file with concurrent range GETs. The file is preallocated and every range is
+    written at its offset with os.pwrite, so the ranges can finish in any order.
+
+    The ranges are handed out one at a time from the start of the blob. How many are in flight is decided by the
+    TransferController of the download. Every stream measures its throughput and the next range is sized to take
+    about range_seconds at that rate, within [MIN_RANGE, MAX_RANGE] and never more than a fair share of what is left
+    so the streams finish together. Small ranges on slow links keep the time a range is in flight short, which
+    bounds how long a cancelled download keeps the streams busy.
+
+    A range that fails is retried with exponential backoff up to attempts times while the other streams carry on.
+    The completed ranges are recorded in a JSON sidecar next to the file. A download that failed or was cancelled is
+    resumed from the sidecar, only the missing ranges are downloaded, if the sidecar belongs to the same version of
+    the blob (see checkpoint.source_version).
+
+    The MD5 of the file is computed while the ranges arrive. The ranges finishing right after the hashed prefix of the
+    file are hashed from memory, the ones that finished out of order are read back (from the page cache) once the
+    prefix reaches them. When the blob has a stored Content-MD5 the file is checked against it before it is handed
+    to GDAL.
+
+    When cancel_event is set the download stops handing out ranges and run raises TimeoutError within POLL_INTERVAL
+    seconds. It does not wait for the ranges in flight, their streams drop the data once they finish and the last of
+    them writes the sidecar, see when_finished.
+    """
+
+    def __init__(self, blob_client: BlobClient = None, dst_file: str = None, size: int = None,
+                 controller: TransferController = None, range_seconds: float = 0.5,
+                 cancel_event: multiprocessing.Event = None, sidecar: str = None, version: str = None,
+                 content_md5: bytes = None, attempts: int = 5):
+        self.blob_client = blob_client
+        self.dst_file = dst_file
+        self.size = size
+        self.controller = controller or TransferController.for_client(client=blob_client, direction='download')
+        self.concurrency = self.controller.streams(size=size, unit=MIN_RANGE)
+        self.range_seconds = range_seconds
+        self.cancel_event = cancel_event
+        self.sidecar = sidecar
+        self.version = version
+        self.content_md5 = content_md5
+        self.attempts = attempts
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.finished = threading.Event()
+        # called once the streams have all stopped, see when_finished
+        self.callbacks = list()
+        # the parts of the blob not handed out yet, list of [offset, length]. An empty blob has none, its file is
+        # only created and checked against the MD5 of no bytes
+        self.gaps = [[0, size]] if size else []
+        # the ranges written to the file, offset -> length
+        self.completed = dict()
+        self.downloaded = 0
+        self.running = 0
+        self.error = None
+        # bytes per second of one stream, None until the first range has been downloaded
+        self.rate = None
+        self.logtrack = set()
+        self.saved_at = time.monotonic()
+        self.hash_lock = threading.Lock()
+        self.md5 = hashlib.md5()
+        self.hashed = 0
+
+    def range_size(self) -> int:
+        """
+        The size of the next range, called with the lock held
+        """
+        if self.rate is None:
+            size = min(INITIAL_RANGE, self.size // (self.controller.limit * 4))
+        else:
+            size = self.rate * self.range_seconds
+        fair_share = sum(length for _, length in self.gaps) / self.controller.limit
+        size = min(size, MAX_RANGE, fair_share)
+        return max(MIN_RANGE, int(size) // ALIGNMENT * ALIGNMENT)
+
+    def next_range(self):
+        """
+        @return: tuple(offset, length) of the next range or None once the blob has been handed out or the download
+        has been stopped
+        """
+        with self.lock:
+            if self.stop_event.is_set() or not self.gaps:
+                return
+            gap = self.gaps[0]
+            offset = gap[0]
+            length = min(self.range_size(), gap[1])
+            gap[0] += length
+            gap[1] -= length
+            if gap[1] == 0:
+                self.gaps.pop(0)
+            return offset, length
+
+    def range_done(self, offset: int = None, length: int = None, seconds: float = None):
+        with self.lock:
+            self.completed[offset] = length
+            self.downloaded += length
+            rate = length / max(seconds, 1e-3)
+            self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+            progress = int(self.downloaded / self.size * 10) * 10
+            if progress not in self.logtrack:
+                self.logtrack.add(progress)
+                logger.info(f'downloaded - {progress}%')
+
+    def fetch_range(self, offset: int = None, length: int = None) -> memoryview:
+        """
+        Download a range, retrying with exponential backoff
+        @return: memoryview of the bytes or None if the download has been stopped
+        """
+        for attempt in range(1, self.attempts + 1):
+            try:
+                # the range is retried here rather than by the SDK, a throttled request reaches the controller
+                # right away instead of after the backoff of the SDK
+                data = memoryview(self.blob_client.download_blob(offset=offset, length=length, max_concurrency=1,
+                                                                 retry_total=0).readall())
+                if len(data) != length:
+                    raise IOError(f'Received {len(data)} bytes instead of {length} at offset {offset}')
+                return data
+            except Exception as e:
+                self.controller.observe(error=e)
+                if attempt == self.attempts or self.stop_event.is_set():
+                    raise
+                delay = min(BACKOFF * 2 ** (attempt - 1), MAX_BACKOFF) * random.uniform(0.5, 1)
+                logger.info(f'Failed to download {length} bytes at offset {offset} in attempt no {attempt}: {e}. '
+                            f'Trying again in {delay:.1f} seconds... ')
+                if self.stop_event.wait(delay):
+                    return
+
+    def advance_hash(self, fd: int = None, offset: int = None, data: memoryview = None, wait: bool = False):
+        """
+        Hash the completed ranges following the hashed prefix of the file. data, the bytes of the range at offset,
+        is used instead of reading the range back if the prefix has reached it. Unless wait is True a stream does
+        not wait for another one that is hashing, that one picks up the completed ranges
+        """
+        if not self.hash_lock.acquire(blocking=wait):
+            return
+        try:
+            while True:
+                with self.lock:
+                    length = self.completed.get(self.hashed)
+                if length is None or self.stop_event.is_set():
+                    return
+                if self.hashed == offset and data is not None:
+                    self.md5.update(data)
+                else:
+                    for position in range(self.hashed, self.hashed + length, MAX_RANGE):
+                        self.md5.update(os.pread(fd, min(MAX_RANGE, self.hashed + length - position), position))
+                self.hashed += length
+        finally:
+            self.hash_lock.release()
+
+    def save(self, fd: int = None, force: bool = False):
+        """
+        Write the completed ranges to the sidecar, at most every SIDECAR_INTERVAL seconds unless forced. The file is
+        synced first so the sidecar never lists bytes that are not on disk
+        """
+        if self.sidecar is None:
+            return
+        with self.lock:
+            if not force and time.monotonic() - self.saved_at < SIDECAR_INTERVAL:
+                return
+            self.saved_at = time.monotonic()
+            ranges = list()
+            for offset, length in sorted(self.completed.items()):
+                if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                    ranges[-1][1] += length
+                else:
+                    ranges.append([offset, length])
+        try:
+            os.fdatasync(fd)
+            with open(f'{self.sidecar}.tmp', 'w') as sidecar:
+                json.dump(dict(version=self.version, size=self.size, ranges=ranges), sidecar)
+            os.replace(f'{self.sidecar}.tmp', self.sidecar)
+        except OSError as e:
+            logger.error(f'Failed to write {self.sidecar}: {e}')
+
+    def resume(self) -> bool:
+        """
+        Load the completed ranges from the sidecar
+        @return: False if there is nothing to resume
+        """
+        if self.sidecar is None or not os.path.exists(self.sidecar):
+            return False
+        try:
+            with open(self.sidecar) as sidecar:
+                state = json.load(sidecar)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring {self.sidecar}: {e}')
+            return False
+        if state.get('version') != self.version or state.get('size') != self.size or \
+                not os.path.exists(self.dst_file) or os.path.getsize(self.dst_file) != self.size:
+            logger.info(f'Ignoring {self.sidecar}, the blob has changed')
+            return False
+        self.gaps, position = list(), 0
+        for offset, length in sorted(state['ranges']):
+            self.completed[offset] = length
+            if offset > position:
+                self.gaps.append([position, offset - position])
+            position = offset + length
+        if position < self.size:
+            self.gaps.append([position, self.size - position])
+        self.downloaded = sum(self.completed.values())
+        logger.info(f'Resuming the download of {self.blob_client.blob_name}, {self.downloaded} of {self.size} bytes '
+                    f'were already downloaded')
+        return True
+
+    def stream(self, fd: int = None):
+        """
+        Download ranges until there are none left, runs in a thread of its own
+        """
+        try:
+            while self.controller.acquire(stop_event=self.stop_event):
+                item = self.next_range()
+                if item is None:
+                    self.controller.release()
+                    return
+                offset, length = item
+                started = time.monotonic()
+                try:
+                    data = self.fetch_range(offset=offset, length=length)
+                except Exception:
+                    self.controller.release()
+                    raise
+                self.controller.release(nbytes=length if data is not None else 0)
+                if data is None or self.stop_event.is_set():
+                    return
+                written = 0
+                while written < length:
+                    written += os.pwrite(fd, data[written:], offset + written)
+                self.range_done(offset=offset, length=length, seconds=time.monotonic() - started)
+                self.advance_hash(fd=fd, offset=offset, data=data)
+                self.save(fd=fd)
+        except Exception as e:
+            with self.lock:
+                self.error = self.error or e
+            self.stop_event.set()
+        finally:
+            with self.lock:
+                # the last stream is counted as running until it has written the sidecar, see when_finished
+                last = self.running == 1
+                if not last:
+                    self.running -= 1
+            if last:
+                self.save(fd=fd, force=True)
+                # the streams that outlive a cancelled run close the file
+                os.close(fd)
+                with self.lock:
+                    self.running = 0
+                    self.finished.set()
+                    callbacks, self.callbacks = self.callbacks, list()
+                for callback in callbacks:
+                    callback()
+
+    def when_finished(self, callback=None):
+        """
+        Call callback once the streams have all stopped writing the file and the sidecar, right away if none is
+        running. The streams outlive a cancelled run, whatever guards the file (the lock of the resume folder) is
+        released by the last of them
+        """
+        with self.lock:
+            if self.running:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def preallocate(self):
+        fd = os.open(self.dst_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        if not self.size:
+            os.close(fd)
+            return
+        try:
+            try:
+                os.posix_fallocate(fd, 0, self.size)
+            except (AttributeError, OSError):
+                # not supported on this platform or file system, the file is extended without reserving the blocks
+                os.ftruncate(fd, self.size)
+        finally:
+            os.close(fd)
+
+    def verify(self, fd: int = None):
+        self.advance_hash(fd=fd, wait=True)
+        if self.hashed != self.size:
+            raise DownloadIntegrityError(f'Only {self.hashed} of {self.size} bytes of {self.blob_client.blob_name} '
+                                         f'were hashed')
+        if not self.content_md5:
+            logger.info(f'{self.blob_client.blob_name} has no Content-MD5, its MD5 is {self.md5.hexdigest()}')
+            return
+        if self.md5.digest() != bytes(self.content_md5):
+            raise DownloadIntegrityError(f'The MD5 of the downloaded {self.blob_client.blob_name} '
+                                         f'({self.md5.hexdigest()}) does not match its Content-MD5 '
+                                         f'({bytes(self.content_md5).hex()})')
+        logger.info(f'Verified the MD5 of {self.blob_client.blob_name}')
+
+    def run(self) -> str:
+        """
+        @return: str, the abs path to the downloaded file
+        """
+        if not self.resume():
+            self.preallocate()
+        fd = os.open(self.dst_file, os.O_RDWR)
+        if not self.gaps:
+            try:
+                self.verify(fd=fd)
+            finally:
+                os.close(fd)
+            return self.dst_file
+        self.running = self.concurrency
+        for n in range(self.concurrency):
+            # the records logged by the streams belong to the log of the job
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(self.stream, fd), name=f'download-{n}', daemon=True).start()
+        while not self.finished.wait(POLL_INTERVAL):
+            if self.cancel_event and self.cancel_event.is_set():
+                self.stop_event.set()
+                raise TimeoutError(f'Downloading {self.blob_client.blob_name} has timed out')
+        if self.error:
+            raise self.error
+        if self.downloaded != self.size:
+            # the download was stopped by the cancellation event right before it would have finished
+            raise TimeoutError(f'Downloading {self.blob_client.blob_name} has timed out')
+        fd = os.open(self.dst_file, os.O_RDONLY)
+        try:
+            self.verify(fd=fd)
+        finally:
+            os.close(fd)
+        return self.dst_file
+
+
+def resume_folder(resume_dir: str = None, src_blob_path: str = None, max_age: float = None):
+    """
+    Lock the folder of resume_dir where src_blob_path is downloaded, removing the folders of the downloads that
+    were not resumed for max_age seconds
+    @return: tuple(folder, lock file descriptor) or (None, None) if the blob is being downloaded by another process
+    """
+    os.makedirs(resume_dir, exist_ok=True)
+    for name in os.listdir(resume_dir):
+        stale_folder = os.path.join(resume_dir, name)
+        try:
+            if time.time() - os.path.getmtime(stale_folder) > max_age:
+                with open(os.path.join(stale_folder, '.lock'), 'a') as stale_lock:
+                    fcntl.flock(stale_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    shutil.rmtree(stale_folder, ignore_errors=True)
+                    logger.info(f'Removed the stale partial download {stale_folder}')
+        except OSError:
+            continue
+    folder = os.path.join(resume_dir, hashlib.md5(src_blob_path.encode()).hexdigest())
+    os.makedirs(folder, exist_ok=True)
+    lock_fd = os.open(os.path.join(folder, '.lock'), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(lock_fd)
+        return None, None
+    # the age of the folder is the time it was last resumed
+    os.utime(folder)
+    return folder, lock_fd
+
+
+def download_blob_ranges(src_blob_path: str = None, local_folder: str = None, conn_string: str = None,
+                         cancel_event: multiprocessing.Event = None, concurrency: int = 8,
+                         range_seconds: float = 0.5, resume_dir: str = None, resume_max_age: float = 86400,
+                         controller: TransferController = None) -> str:
+    """
+    Download the src_blob_path into the local_folder, see RangeDownloader
+    @param src_blob_path: str, the full relative path (including the container) to the blob file
+    @param local_folder: str, abs path to a local folder where the src_blob_path will be downloaded
+    @param conn_string: str, the connections string to the azure storage account
+    @param cancel_event: object used to cancel the download
+    @param concurrency: int, the number of ranges downloaded concurrently at first, see TransferController
+    @param range_seconds: float, the time the download of a range should take at the measured throughput
+    @param resume_dir: str, optional, the folder where the blob is downloaded with its sidecar and moved to
+    local_folder once complete. A download that failed is resumed the next time the blob is downloaded, unless
+    resume_max_age seconds have passed
+    @param controller: optional, the TransferController of the download, created from concurrency by default
+    @return: str, the abs path to the downloaded file
+    """
+    container_name, *rest, file_name = src_blob_path.split("/")
+    container_rel_blob_path = os.path.join(*rest, file_name)
+    src_blob_client = blob_client(conn_string=conn_string, container_name=container_name,
+                                  blob_name=container_rel_blob_path)
+    try:
+        properties = src_blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        raise FileNotFoundError(f'{container_rel_blob_path} does not exist in container "{container_name}"')
+    dst_file = os.path.join(local_folder, file_name)
+    folder, lock_fd = (None, None)
+    downloader = None
+    if resume_dir:
+        folder, lock_fd = resume_folder(resume_dir=resume_dir, src_blob_path=src_blob_path, max_age=resume_max_age)
+        if folder is None:
+            logger.info(f'{src_blob_path} is being downloaded by another process, downloading it without resuming')
+    try:
+        partial_file = os.path.join(folder, file_name) if folder else dst_file
+        logger.info(f'Downloading {container_rel_blob_path} ({properties.size} bytes)')
+        started = time.monotonic()
+        controller = controller or TransferController.for_client(client=src_blob_client, direction='download',
+                                                                 concurrency=concurrency)
+        downloader = RangeDownloader(blob_client=src_blob_client, dst_file=partial_file, size=properties.size,
+                                     controller=controller, range_seconds=range_seconds, cancel_event=cancel_event,
+                                     sidecar=f'{partial_file}.ranges.json' if folder else None,
+                                     version=source_version(properties),
+                                     content_md5=properties.content_settings.content_md5)
+        try:
+            downloader.run()
+        except DownloadIntegrityError:
+            if folder:
+                # the partial file is corrupt, the next attempt starts over
+                os.remove(downloader.sidecar)
+            raise
+        finally:
+            controller.close()
+        if folder:
+            shutil.move(partial_file, dst_file)
+            shutil.rmtree(folder, ignore_errors=True)
+        seconds = time.monotonic() - started
+        logger.info(f'Downloaded {container_rel_blob_path} in {seconds:.1f} seconds '
+                    f'({properties.size / MB / max(seconds, 1e-3):.1f} MiB/s, {controller.limit} requests in flight)')
+        return dst_file
+    finally:
+        if lock_fd is not None:
+            # a cancelled download is not resumed by another attempt while its streams are still writing
+            if downloader is None:
+                os.close(lock_fd)
+            else:
+                downloader.when_finished(functools.partial(os.close, lock_fd))
+
+
+def open_shared_lock(folder: str = None):
+    """
+    Open the lock file of the folder of a shared copy
+    @return: the lock file descriptor
+    """
+    os.makedirs(folder, exist_ok=True)
+    return os.open(os.path.join(folder, '.lock'), os.O_WRONLY | os.O_CREAT, 0o644)
+
+
+def try_flock(fd: int = None, operation: int = None) -> bool:
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def same_file(fd: int = None, path: str = None) -> bool:
+    """
+    Check fd is still the file at path, the folder of a shared copy may have been removed while its lock was awaited
+    """
+    try:
+        return os.fstat(fd).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+@contextlib.contextmanager
+def shared_copy(cache_dir: str = None, key: str = None, file_name: str = None, download=None,
+                cancel_event: multiprocessing.Event = None, max_age: float = None):
+    """
+    Share one local copy of a blob between the jobs running on the host, in threads or in worker processes. The first
+    job downloads the blob while holding the lock of the folder of the copy exclusively, the others wait for it and
+    read the copy while holding the lock shared. The folder is removed by remove_shared_copy or, once it has not been
+    used for max_age seconds, by the next job using a shared copy
+    @param cache_dir: str, the folder holding the copies
+    @param key: str, identifies the blob and its content, the copy of a blob that has changed is not used
+    @param file_name: str, the name of the copy
+    @param download: function(local_folder) downloading the blob into local_folder and returning the abs path to it
+    @param cancel_event: object used to cancel the wait for a copy being downloaded by another job, TimeoutError is
+    raised then
+    @param max_age: float, the age in seconds of the copies that are removed
+    @return: context manager yielding the abs path to the copy
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    for name in os.listdir(cache_dir):
+        stale_folder = os.path.join(cache_dir, name)
+        try:
+            if time.time() - os.path.getmtime(stale_folder) > max_age:
+                remove_shared_folder(folder=stale_folder)
+        except OSError:
+            continue
+    folder = os.path.join(cache_dir, hashlib.md5(key.encode()).hexdigest())
+    lock_path = os.path.join(folder, '.lock')
+    copy_path = os.path.join(folder, file_name)
+    complete_path = os.path.join(folder, '.complete')
+    while True:
+        lock_fd = open_shared_lock(folder=folder)
+        try:
+            if try_flock(lock_fd, fcntl.LOCK_SH):
+                if same_file(lock_fd, lock_path) and os.path.exists(complete_path):
+                    break
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            if try_flock(lock_fd, fcntl.LOCK_EX) and same_file(lock_fd, lock_path):
+                if not os.path.exists(complete_path):
+                    logger.info(f'Downloading the shared copy {copy_path}')
+                    downloaded_path = download(folder)
+                    if downloaded_path != copy_path:
+                        shutil.move(downloaded_path, copy_path)
+                    with open(complete_path, 'w'):
+                        pass
+                # the downgrade is not atomic, the copy is checked again
+                fcntl.flock(lock_fd, fcntl.LOCK_SH)
+                if same_file(lock_fd, lock_path) and os.path.exists(complete_path):
+                    break
+        except BaseException:
+            os.close(lock_fd)
+            raise
+        os.close(lock_fd)
+        if cancel_event and cancel_event.is_set():
+            raise TimeoutError(f'Waiting for the shared copy {copy_path} has timed out')
+        time.sleep(POLL_INTERVAL)
+    try:
+        # the age of the folder is the time it was last used
+        os.utime(folder)
+        yield copy_path
+    finally:
+        os.close(lock_fd)
+
+
+def remove_shared_folder(folder: str = None) -> bool:
+    """
+    Remove the folder of a shared copy unless it is in use
+    @return: True if the folder was removed
+    """
+    with open(os.path.join(folder, '.lock'), 'a') as lock:
+        if not try_flock(lock.fileno(), fcntl.LOCK_EX):
+            return False
+        shutil.rmtree(folder, ignore_errors=True)
+        logger.info(f'Removed the shared copy {folder}')
+        return True
+
+
+def remove_shared_copy(cache_dir: str = None, key: str = None) -> bool:
+    """
+    Remove the shared copy of key (see shared_copy) unless it is in use
+    @return: True if the copy was removed
+    """
+    folder = os.path.join(cache_dir, hashlib.md5(key.encode()).hexdigest())
+    if not os.path.isdir(folder):
+        return False
+    try:
+        return remove_shared_folder(folder=folder)
+    except OSError:
+        return False
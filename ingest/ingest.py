@@ -3,24 +3,45 @@ import json
 import logging
 import multiprocessing
 import os
+import signal
+import time
+import urllib.parse
+from contextlib import AsyncExitStack, nullcontext
 from io import StringIO
 from traceback import print_exc
-from ingest.processing import process_geo_file
-from ingest.azlog import AzureBlobStorageHandler
-from azure.servicebus.aio import AutoLockRenewer, ServiceBusClient
-from ingest.config import raw_folder, setup_env_vars, get_azurewebsubpub_client_token, AZURE_WEBPUBSUB_GROUP_NAME
+from ingest.processing import process_geo_file, list_units, process_unit
+from ingest.utils import describe_dataset, prepare_arch_path
+from ingest.azlog import AzureBlobStorageHandler, current_blob_url
+from ingest.admission import ResourceBudget, estimate_job_resources, MB
+from ingest.workers import ProcessPool, WorkerKilledError
+from ingest.prefetch import Prefetcher
+from ingest.queues import MessageQueue, open_queue, compose_message
+from ingest.locks import LockRenewalScheduler
+from ingest.pubsub import PubSubHub
+from ingest.scheduler import JobScheduler, job_cost
+from ingest.ledger import JobLedger
+from ingest.metrics import MetricsServer
+from ingest.looplag import LoopLagMonitor
+from ingest.progress import publish_progress, flush_progress
+from ingest.checkpoint import JobCheckpoint, UnitClaim, discard_checkpoint, flush_checkpoints
+from ingest.clients import close_async_clients
+from ingest.diagnostics import JobDiagnostics, flush_diagnostics
+from ingest.config import raw_folder, setup_env_vars, \
+    INGEST_BACKEND, INGEST_WORKER_MAX_JOBS, INGEST_WORKER_MAX_RSS_MB, INGEST_PREFETCH_COUNT, \
+    INGEST_PREFETCH_SPOOL_MB, INGEST_PREFETCH_SPOOL_DIR, INGEST_DAEMON, INGEST_POLL_MIN_WAIT, INGEST_POLL_MAX_WAIT, \
+    INGEST_IDLE_EXIT_SECONDS, INGEST_SCHEDULER_LOOKAHEAD, INGEST_DRAIN_SECONDS, INGEST_WORKER_KILL_GRACE, \
+    INGEST_SPLIT_MIN_UNITS, INGEST_LEDGER_PATH, INGEST_METRICS_PORT, \
+    INGEST_LOOP_LAG_THRESHOLD, INGEST_THREAD_STOP_SECONDS
 import tempfile
 from ingest.azblob import (
-    copy_raw2datasets,
-    handle_lock,
+    copy_raw2datasets_sync,
     chop_blob_url,
+    download_blob_shared,
     download_blob_sync,
-    upload_content_to_blob,
-    set_blob_metadata
+    get_blob_size,
+    remove_shared_blob,
+    upload_content_to_blob
 )
-from ingest.utils import cancel_processing
-from azure.messaging.webpubsubclient import WebPubSubClient
-from azure.messaging.webpubsubclient.models import WebPubSubDataType, CallbackType
 
 logger = logging.getLogger(__name__)
 
@@ -32,183 +53,508 @@ sblogger.setLevel(logging.WARNING)
 
 setup_env_vars()
 
-INGEST_TIMEOUT = 3600  #  1 hr MAX
-CONNECTION_STR = os.environ["SERVICE_BUS_CONNECTION_STRING"]
-QUEUE_NAME = os.environ["SERVICE_BUS_QUEUE_NAME"]
+CONNECTION_STR = os.environ.get("SERVICE_BUS_CONNECTION_STRING")
+QUEUE_NAME = os.environ.get("SERVICE_BUS_QUEUE_NAME")
 AZ_STORAGE_CONN_STR = os.environ['AZURE_STORAGE_CONNECTION_STRING']
 AZURE_WEBPUBSUB_CONNECTION_STRING = os.environ.get('AZURE_WEBPUBSUB_CONNECTION_STRING')
 
+class Consumer:
+    """
+    The long-lived objects shared by the ingest jobs running in this process
+    @param queue: instance of MessageQueue the messages are received from
+    @param budget: instance of ResourceBudget used to admit the jobs
+    @param pool: optional, instance of ProcessPool the jobs are run in
+    @param prefetcher: optional, instance of Prefetcher downloading the blobs of the waiting jobs
+    @param locks: instance of LockRenewalScheduler keeping the locks of the messages in flight
+    @param pubsub: optional, instance of PubSubHub, the webpubsub connection shared by the jobs. Without it (no
+    AZURE_WEBPUBSUB_CONNECTION_STRING, e.g. with the local queue) the jobs send no websocket messages
+    @param scheduler: instance of JobScheduler deciding which waiting job gets a free worker
+    @param ledger: instance of JobLedger predicting the runtime (timeout, cost, ETA) of the jobs
+    @param monitor: optional, instance of LoopLagMonitor watching the event loop
+    """
+
+    def __init__(self, queue: MessageQueue = None, budget: ResourceBudget = None, pool: ProcessPool = None,
+                 prefetcher: Prefetcher = None, locks: LockRenewalScheduler = None, pubsub: PubSubHub = None,
+                 scheduler: JobScheduler = None, ledger: JobLedger = None, monitor: LoopLagMonitor = None):
+        self.queue = queue
+        self.locks = locks
+        self.pubsub = pubsub
+        self.budget = budget
+        self.pool = pool
+        self.prefetcher = prefetcher
+        # the jobs holding a slot of the scheduler are running, the others wait (and are prefetched)
+        self.scheduler = scheduler
+        self.ledger = ledger
+        self.monitor = monitor
+        self.draining = asyncio.Event()
+
+    def drain(self):
+        logger.info('Received SIGTERM, draining')
+        self.draining.set()
+
+    async def until_draining(self, aws=None) -> set:
+        """
+        Wait until the first of aws is done or the consumer starts to drain
+        @return: the done aws
+        """
+        draining = asyncio.ensure_future(self.draining.wait())
+        try:
+            done, _ = await asyncio.wait(set(aws) | {draining}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            draining.cancel()
+        return done - {draining}
+
+
 async def ingest_message():
-    async with ServiceBusClient.from_connection_string(
-            conn_str=CONNECTION_STR, logging_enable=True
-    ) as servicebus_client:
-        async with servicebus_client.get_queue_receiver(
-                queue_name=QUEUE_NAME,
-                # prefetch_count=0,
-        ) as receiver:  # get one message without caching
-
-            while True:
-                received_msgs = await receiver.receive_messages(
-                    max_message_count=1,
-                    max_wait_time=5,
-                )
+    """
+    Consume the messages from the queue (service bus or the local stand-in) and ingest the blobs they point to.
+    Up to INGEST_MAX_WORKERS messages (plus INGEST_HEAVY_WORKERS large ones) are ingested concurrently, the waiting
+    ones are shared fairly between the users and started shortest job first by the JobScheduler. Each job reserves
+    its estimated RAM and disk needs from a ResourceBudget before it starts so the concurrently processed files can not
+    exhaust the pod's resources. While all workers are busy up to INGEST_PREFETCH_COUNT more messages are received and
+    their blobs are downloaded ahead into a spool folder.
+    SIGTERM makes the consumer drain: no more messages are received and the running jobs are given
+    INGEST_DRAIN_SECONDS to finish before they are stopped and their messages are abandoned.
+    """
+    budget = ResourceBudget.from_config()
+    prefetcher = None
+    if INGEST_PREFETCH_COUNT > 0:
+        prefetcher = Prefetcher(spool_dir=INGEST_PREFETCH_SPOOL_DIR, max_bytes=INGEST_PREFETCH_SPOOL_MB * MB,
+                                conn_string=AZ_STORAGE_CONN_STR)
+    async with AsyncExitStack() as stack:
+        # the connections of the shared storage clients of the loop are closed last
+        stack.push_async_callback(close_async_clients)
+        monitor = None
+        if INGEST_LOOP_LAG_THRESHOLD > 0:
+            monitor = await stack.enter_async_context(LoopLagMonitor(threshold=INGEST_LOOP_LAG_THRESHOLD))
+        ledger = await stack.enter_async_context(JobLedger.from_config())
+        scheduler = JobScheduler.from_config(ledger=ledger)
+        pool = None
+        if INGEST_BACKEND == 'process':
+            pool = await stack.enter_async_context(
+                ProcessPool(size=scheduler.capacity, max_jobs=INGEST_WORKER_MAX_JOBS,
+                            max_rss_mb=INGEST_WORKER_MAX_RSS_MB, kill_grace=INGEST_WORKER_KILL_GRACE)
+            )
+        queue = await stack.enter_async_context(open_queue(connection_string=CONNECTION_STR, queue_name=QUEUE_NAME))
+        locks = await stack.enter_async_context(LockRenewalScheduler())
+        pubsub = None
+        if AZURE_WEBPUBSUB_CONNECTION_STRING:
+            pubsub = PubSubHub()
+            # opening the connection is a blocking call
+            await asyncio.to_thread(pubsub.open)
+            stack.push_async_callback(asyncio.to_thread, pubsub.close)
+        else:
+            logger.info('AZURE_WEBPUBSUB_CONNECTION_STRING is not set, the progress is not sent over the websocket')
+        consumer = Consumer(queue=queue, budget=budget, pool=pool, prefetcher=prefetcher, locks=locks,
+                            pubsub=pubsub, scheduler=scheduler, ledger=ledger, monitor=monitor)
+        if INGEST_METRICS_PORT:
+            await stack.enter_async_context(MetricsServer(consumer=consumer, port=INGEST_METRICS_PORT))
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, consumer.drain)
+        stack.callback(loop.remove_signal_handler, signal.SIGTERM)
+        await consume(consumer=consumer)
+
+
+async def consume(consumer: Consumer = None):
+    """
+    Receive the messages from the queue and start an ingest job for each of them while there are free worker slots
+    or room for prefetching/scheduling. The sizes of the blobs of a received batch are read with one round of
+    concurrent requests and the jobs are queued shortest first.
+    In daemon mode an empty queue does not end the consumption. The receive call returns as soon as a message
+    arrives so the wait time is doubled on every empty poll, which cuts down the number of polls issued by an idle pod
+    without delaying the next message, and is reset when messages arrive.
+    Once the consumer drains the running jobs are given INGEST_DRAIN_SECONDS to finish, the rest are cancelled
+    (their messages are abandoned by ingest_job).
+    """
+    queue = consumer.queue
+    max_jobs = consumer.scheduler.capacity + max(INGEST_PREFETCH_COUNT, INGEST_SCHEDULER_LOOKAHEAD)
+    jobs = set()
+    wait_time = INGEST_POLL_MIN_WAIT
+    idle_since = None
+    while not consumer.draining.is_set():
+        if len(jobs) >= max_jobs:
+            await consumer.until_draining(jobs)
+            jobs = {job for job in jobs if not job.done()}
+            continue
+        receiving = asyncio.ensure_future(queue.receive_messages(
+            max_message_count=max_jobs - len(jobs),
+            max_wait_time=wait_time,
+        ))
+        await consumer.until_draining([receiving])
+        if not receiving.done():
+            receiving.cancel()
+            break
+        received_msgs = receiving.result()
+        jobs = {job for job in jobs if not job.done()}
+        if consumer.draining.is_set():
+            for msg in received_msgs:
+                await queue.abandon_message(msg)
+            break
+
+        if not received_msgs:
+            if INGEST_DAEMON:
+                if jobs:
+                    idle_since = None
+                else:
+                    idle_since = idle_since or time.monotonic()
+                    idle_secs = time.monotonic() - idle_since
+                    if INGEST_IDLE_EXIT_SECONDS and idle_secs >= INGEST_IDLE_EXIT_SECONDS:
+                        logger.info(f'Queue "{QUEUE_NAME}" has been idle for {idle_secs:.0f} seconds. Exiting')
+                        break
+                wait_time = min(wait_time * 2, INGEST_POLL_MAX_WAIT)
+                logger.debug(f'Queue "{QUEUE_NAME}" is empty, polling again with {wait_time} seconds wait time')
+                continue
+            if jobs:
+                # some jobs are still running, more messages could be consumed when they finish
+                await consumer.until_draining(jobs)
+                jobs = {job for job in jobs if not job.done()}
+                continue
+            logger.info(f'No (more) messages to process. Queue "{QUEUE_NAME}" is empty')
+            break
+
+        wait_time = INGEST_POLL_MIN_WAIT
+        idle_since = None
+
+        batch = await inspect_messages(messages=received_msgs)
+        # the jobs reach the scheduler in the order they are created
+        for msg, blob_path, blob_size in sorted(batch, key=lambda job: job_cost(blob_path=job[1], size=job[2],
+                                                                                  ledger=consumer.ledger)):
+            job = asyncio.create_task(ingest_job(consumer=consumer, msg=msg, blob_size=blob_size))
+            jobs.add(job)
+
+    if consumer.draining.is_set() and jobs:
+        logger.info(f'Waiting up to {INGEST_DRAIN_SECONDS} seconds for {len(jobs)} jobs to finish')
+        _, pending = await asyncio.wait(jobs, timeout=INGEST_DRAIN_SECONDS)
+        for job in pending:
+            job.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # the jobs running in threads keep their checkpoint and their diagnostics in this process
+        await asyncio.to_thread(flush_checkpoints)
+        await asyncio.to_thread(flush_diagnostics)
+
+
+def parse_message(msg=None):
+    """
+    Extract the blob url, the token, the join_vector_tiles flag and the unit from a message. The unit is only set in
+    the messages of the sub-jobs of a split job
+    """
+    msg_str = json.loads(str(msg))
+
+    blob_url, token, join_vector_tiles_str, *unit_str = msg_str.split(";")
+
+    join_vector_tiles = join_vector_tiles_str.split('=')[1] == 'true'
+    unit = urllib.parse.unquote(unit_str[0].split('=', 1)[1]) if unit_str else None
+    return blob_url, token, join_vector_tiles, unit
 
-                if not received_msgs:
-                    logger.info(f'No (more) messages to process. Queue "{QUEUE_NAME}" is empty')
-                    break
 
-                for msg in received_msgs:
+async def inspect_messages(messages: list = None) -> list:
+    """
+    Fetch the size of the raw blobs the messages point to with one round of concurrent HEAD requests
+    @param messages: the received messages
+    @return: list of (message, blob_path, blob_size) tuples. The path is empty and the size None for the messages
+    that can not be parsed or do not point to a raw blob, their jobs will deal with them
+    """
+
+    async def _inspect_(msg=None):
+        try:
+            blob_url, *_ = parse_message(msg=msg)
+            blob_path = chop_blob_url(blob_url=blob_url)
+            if f"/{raw_folder}/" not in blob_url:
+                return msg, blob_path, None
+            return msg, blob_path, await get_blob_size(blob_path=blob_path, connection_string=AZ_STORAGE_CONN_STR)
+        except Exception as e:
+            logger.debug(f'Failed to inspect message {msg}: {e}')
+            return msg, '', None
+
+    return await asyncio.gather(*[_inspect_(msg=msg) for msg in messages])
+
+
+async def ingest_job(consumer: Consumer = None, msg=None, blob_size: int = None):
+    """
+    Ingest the blob from one service bus message and settle (complete/dead-letter) the message
+    @param consumer: instance of Consumer
+    @param msg: instance of Azure ServiceBusReceivedMessage or LocalMessage
+    @param blob_size: optional, the size of the blob if it was already fetched
+    @return: None
+    """
+    queue = consumer.queue
+    blob_url = unit = None
+    try:
+        blob_url, token, join_vector_tiles, unit = parse_message(msg=msg)
+        # if not 'Sample' in blob_url: continue
+        logger.info(
+            f"Received blob: {blob_url} from queue" + (f' for unit {unit}' if unit else '')
+        )
+        current_blob_url.set(blob_url)
+
+        if f"/{raw_folder}/" in blob_url:
+            """
+            First, it looks like the max_lock_renewal_duration arg is not working as it should be,
+            or, I have no idea how to use it properly. So far the queue has been honouring the
+            lock_time as set in the Azure portal through the web interface.
+            Second, to ensure a smooth ride, the message is registered with the LockRenewalScheduler of the consumer
+            which renews its lock INGEST_LOCK_RENEWAL_MARGIN seconds before the lock_time due ot networking. The
+            lock task waits until the lock is lost (the timeout_event is set at the same time), as a result the ingest
+            is done concurrently using asyncio.wait with the lock task and it will usually end first.
+            The asyncio.wait returns when the ingest has completed or an exception has been encountered.
+            It also uses a hard timeout which should ensure the ingest can not get stuck. The timeout is derived from
+            the runtime the JobLedger predicts for the blob (INGEST_TIMEOUT until it has a model).
+            asyncio.wait throws no errors and returns two lists, done and pending, the ingest will be in done and the lock renewal will be
+            still running in the pending. FOr ths reason, the lock task has to be cancelled disregarding
+            whether the ingest task was successful or failed.
+            It might be a good idea for the ingest to return a value but this is not necessary.
+
+            The ingest future must be awaited and this is where an exception is thrown in case the ingest task
+             has failed. In this case the lock  task has to be canceled and the error including the traceback is
+             extracted and the message is dead lettered.
+
+            The lock is renewed while the job waits for a free worker (see JobScheduler) and to be admitted by the
+            resource budget. A waiting job has its blob prefetched if the spool has room for it. The sub-jobs of a
+            split job are not prefetched, the spool holds one copy per blob.
+
+            """
+            timeout_event = multiprocessing.Event()
+            lock_renewal = consumer.locks.register(queue=queue, message=msg, timeout_event=timeout_event,
+                                                   name=blob_url)
+            lock_task = asyncio.ensure_future(lock_renewal.wait())
+            lock_task.set_name('lock')
+            prefetched = False
+            blob_path = chop_blob_url(blob_url=blob_url)
+            try:
+                if blob_size is None:
+                    blob_size = await get_blob_size(blob_path=blob_path, connection_string=AZ_STORAGE_CONN_STR)
+                memory, disk = estimate_job_resources(blob_path=blob_path, size=blob_size)
+                if consumer.prefetcher and consumer.scheduler.must_wait(blob_path=blob_path, size=blob_size) and \
+                        not blob_url.endswith('.pmtiles') and unit is None:
+                    prefetched = consumer.prefetcher.prefetch(blob_path=blob_path, size=blob_size)
+                if prefetched:
+                    # the downloaded file is accounted for by the spool
+                    disk = max(disk - blob_size, 0)
+                lane = await consumer.scheduler.acquire(blob_path=blob_path, size=blob_size)
+                try:
+                    if consumer.draining.is_set():
+                        logger.info(f'Abandoning the message for {blob_url}, the consumer is draining')
+                        await queue.abandon_message(msg)
+                        return
+                    logger.info(f'Waiting for {memory // MB} MB RAM and {disk // MB} MB disk to ingest {blob_url}')
+                    await consumer.budget.acquire(memory=memory, disk=disk)
                     try:
-                        msg_str = json.loads(str(msg))
-
-                        blob_url, token, join_vector_tiles_str = msg_str.split(";")
-
-                        join_vector_tiles = join_vector_tiles_str.split('=')[1] == 'true'
-                        # if not 'Sample' in blob_url: continue
-                        logger.info(
-                            f"Received blob: {blob_url} from queue"
-                        )
-
-                        async with AutoLockRenewer() as auto_lock_renewer:
-                            auto_lock_renewer.register(
-                                receiver=receiver, renewable=msg
-                            )
-                            if f"/{raw_folder}/" in blob_url:
-                                """
-                                First, it looks like the max_lock_renewal_duration arg is not working as it should be,
-                                or, I have no idea how to use it properly. So far the queue has been honouring the
-                                lock_time as set in the Azure portal through the web interface.
-                                Second, to ensure a smooth ride, the message is registered and then the lock is renewed
-                                in an infinite loop ten seconds before the lock_time due ot networking. Shorter time lead to
-                                inconsistent behaviour. As a result the ingest is done concurrently using asyncio.wait with lock
-                                renewal and it will usually end first because the lock renewal is infinite.
-                                The asyncio.wait returns when the ingest has completed or an exception has been encountered.
-                                It also uses a hard timeout which should ensure the ingest can not get stuck.
-                                asyncio.wait throws no errors and returns two lists, done and pending, the ingest will be in done and the lock renewal will be
-                                still running in the pending. FOr ths reason, the lock task has to be cancelled disregarding
-                                whether the ingest task was successful or failed.
-                                It might be a good idea for the ingest to return a value but this is not necessary.
-
-                                The ingest future must be awaited and this is where an exception is thrown in case the ingest task
-                                 has failed. In this case the lock  task has to be canceled and the error including the traceback is
-                                 extracted and the message is dead lettered.
-
-
-                                
-                                """
-                                #get  a token valid for
-                                azure_web_pubsub_client_token = get_azurewebsubpub_client_token(minutes_to_expire=INGEST_TIMEOUT//60)
-                                websocket_client = WebPubSubClient(azure_web_pubsub_client_token['url'], )
-                                timeout_event = multiprocessing.Event()
-                                websocket_client.subscribe(
-                                    CallbackType.GROUP_MESSAGE,
-                                    listener=lambda e:cancel_processing(event=e,blob_url=blob_url,cancel_event=timeout_event)
-                                )
-                                with websocket_client:
-                                    websocket_client.join_group(AZURE_WEBPUBSUB_GROUP_NAME)
-                                    # create and attach  azure log handler to the root logger
-                                    root_logger = logging.getLogger()
-                                    az_handler = AzureBlobStorageHandler(connection_string=AZ_STORAGE_CONN_STR,
-                                                                         blob_url=blob_url,
-                                                                         log_level=root_logger.level)
-                                    root_logger.addHandler(az_handler)
-
-                                    ingest_task = asyncio.ensure_future(
-                                        asyncio.to_thread(sync_ingest, blob_url=blob_url, timeout_event=timeout_event,
-                                                          conn_string=AZ_STORAGE_CONN_STR, websocket_client=websocket_client, join_vector_tiles=join_vector_tiles)
-                                    )
-                                    ingest_task.set_name('ingest')
-                                    lock_task = asyncio.ensure_future(
-                                        handle_lock(receiver=receiver, message=msg, timeout_event=timeout_event)
-                                    )
-                                    lock_task.set_name('lock')
-
-                                    done, pending = await asyncio.wait(
-                                        [lock_task, ingest_task],
-                                        return_when=asyncio.FIRST_COMPLETED,
-                                        timeout=INGEST_TIMEOUT,
-                                    )
-                                    if len(done) == 0:
-                                        error_message = f'Ingesting {blob_url} has timed out after {INGEST_TIMEOUT} seconds.'
-                                        logger.error(error_message)
-                                        timeout_event.set()
-                                        # upload an blob to the /dataset/{datasetname} folder.
-                                        blob_path = chop_blob_url(blob_url=blob_url)
-                                        container_name, user, *rest, blob_name = blob_path.split("/")
-                                        error_blob_path = f'{"/".join([user]+rest)}/{blob_name}.error'
-                                        logger.info(f'Uploading error message to {error_blob_path}')
-                                        upload_content_to_blob(content=error_message, connection_string=CONNECTION_STR,
-                                                               container_name=container_name,
-                                                               dst_blob_path=error_blob_path)
-                                        payload = dict(user=user, url=blob_url, stage='Cancelled', progress=100)
-
-                                        websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME,
-                                                                       content=json.dumps(payload),
-                                                                       data_type=WebPubSubDataType.JSON)
-                                        container_rel_blob_path = os.path.join(user, *rest, blob_name)
-                                        set_blob_metadata(connection_string=CONNECTION_STR, container_name=container_name,
-                                                          dst_blob_path=container_rel_blob_path,
-                                                          metadata={'stage': payload['stage'],
-                                                                    'progress': payload['progress']})
-
-
-                                    logger.debug(f'Handling done tasks')
-                                    for done_future in done:
-                                        try:
-                                            await done_future
-                                            await receiver.complete_message(msg)
-
-                                        except Exception as e:
-                                            with StringIO() as m:
-                                                print_exc(file=m)
-                                                em = m.getvalue()
-                                                logger.error(f'done future error {em}')
-
-                                    logger.debug(f'Cancelling pending tasks')
-
-                                    for pending_future in pending:
-
-                                        try:
-                                            pending_future.cancel()
-                                            await pending_future
-
-                                        except asyncio.exceptions.CancelledError as e:
-                                            # deadletter if task_name is ingest task: name == ingest
-                                            future_name = pending_future.get_name()
-                                            if future_name == 'ingest':
-                                                with StringIO() as m:
-                                                    print_exc(file=m)
-                                                    em = m.getvalue()
-                                                    logger.error(f"Pushing message for  {blob_url} to dead-letter "
-                                                                 f"sub-queue")
-                                                    await receiver.dead_letter_message(
-                                                        msg, reason="ingest task error", error_description=em
-
-                                                    )
-
-                                    root_logger.removeHandler(az_handler)
-                            else:
-                                logger.info(
-                                    f"Skipping {blob_url} because it is not in the {raw_folder} folder"
-                                )
-                                await receiver.complete_message(msg)
-                                logger.info(f"Completed message for: {blob_url}")
-
-                    except Exception as pe:  # this  first level might be redundant
-                        with StringIO() as m:
-                            print_exc(file=m)
-                            em = m.getvalue()
-                            logger.error(em)
-                        logger.info(f"Pushing {msg} to dead-letter sub-queue")
-
-                        await receiver.dead_letter_message(
-                            msg, reason="message parse error", error_description=em
-                        )
-                        continue
+                        src_file_path = await consumer.prefetcher.take(blob_path=blob_path) if prefetched else None
+                        await run_ingest(consumer=consumer, msg=msg, blob_url=blob_url,
+                                         join_vector_tiles=join_vector_tiles, timeout_event=timeout_event,
+                                         lock_task=lock_task, src_file_path=src_file_path, unit=unit,
+                                         blob_size=blob_size)
+                    finally:
+                        await consumer.budget.release(memory=memory, disk=disk)
+                finally:
+                    consumer.scheduler.release(lane=lane, blob_path=blob_path)
+            finally:
+                consumer.locks.unregister(lock_renewal)
+                lock_task.cancel()
+                if prefetched:
+                    await consumer.prefetcher.release(blob_path=blob_path)
+        else:
+            logger.info(
+                f"Skipping {blob_url} because it is not in the {raw_folder} folder"
+            )
+            await queue.complete_message(msg)
+            logger.info(f"Completed message for: {blob_url}")
+
+    except asyncio.CancelledError:
+        if consumer.draining.is_set():
+            # the checkpoint of the job has been flushed, it resumes when the message is delivered again
+            logger.info(f'Abandoning {msg}, the consumer is draining')
+            await queue.abandon_message(msg)
+        raise
+    except Exception as pe:  # this  first level might be redundant
+        with StringIO() as m:
+            print_exc(file=m)
+            em = m.getvalue()
+            logger.error(em)
+        logger.info(f"Pushing {msg} to dead-letter sub-queue")
+
+        await queue.dead_letter_message(
+            msg, reason="message parse error", error_description=em
+        )
+        if blob_url and unit is None:
+            # the job will not be resumed
+            await asyncio.to_thread(discard_checkpoint, blob_url=blob_url, conn_string=AZ_STORAGE_CONN_STR)
+
+
+def report_cancellation(blob_url: str = None, error_message: str = None, websocket_client=None):
+    """
+    Let the user know the ingest of blob_url was stopped before it has finished. An error blob is uploaded, a
+    "Cancelled" message is sent over the websocket and the stage is recorded in the metadata of the raw blob.
+    """
+    logger.error(error_message)
+    # upload an blob to the /dataset/{datasetname} folder.
+    blob_path = chop_blob_url(blob_url=blob_url)
+    container_name, user, *rest, blob_name = blob_path.split("/")
+    error_blob_path = f'{"/".join([user]+rest)}/{blob_name}.error'
+    logger.info(f'Uploading error message to {error_blob_path}')
+    upload_content_to_blob(content=error_message, connection_string=AZ_STORAGE_CONN_STR,
+                           container_name=container_name,
+                           dst_blob_path=error_blob_path)
+    payload = dict(user=user, url=blob_url, stage='Cancelled', progress=100)
+    # supersedes the progress of the job still waiting to be published
+    publish_progress(payload=payload, websocket_client=websocket_client, conn_string=AZ_STORAGE_CONN_STR)
+    # the job will not be resumed
+    discard_checkpoint(blob_url=blob_url, conn_string=AZ_STORAGE_CONN_STR)
+    flush_progress(blob_url=blob_url)
+
+
+def run_holding(func=None, release=None, **kwargs):
+    """
+    Run func(**kwargs) and call release once it has returned, release frees a resource func uses (see Prefetcher.hold)
+    """
+    try:
+        return func(**kwargs)
+    finally:
+        if release is not None:
+            release()
+
+
+async def stop_ingest(ingest_task: asyncio.Future = None, timeout_event: multiprocessing.Event = None):
+    """
+    Stop a running ingest and wait for it to end. timeout_event is set, a job running in a worker process is killed by
+    the pool as soon as it sees it. Cancelling the future of asyncio.to_thread does not stop the thread, so a job
+    running in a thread is given INGEST_THREAD_STOP_SECONDS to notice the event (GDAL, tippecanoe and the download
+    check it) and return before its message is settled.
+    """
+    timeout_event.set()
+    await asyncio.wait([ingest_task], timeout=INGEST_THREAD_STOP_SECONDS)
+    if not ingest_task.done():
+        logger.warning(f'The ingest did not stop within {INGEST_THREAD_STOP_SECONDS} seconds')
+
+
+async def run_ingest(consumer: Consumer = None, msg=None, blob_url: str = None, join_vector_tiles: bool = None,
+                     timeout_event: multiprocessing.Event = None, lock_task: asyncio.Task = None,
+                     src_file_path: str = None, unit: str = None, blob_size: int = None):
+    """
+    Run sync_ingest in a thread or in a worker process of the pool concurrently with the lock renewal
+    and report/settle the outcome. When sync_ingest splits the job the messages of its sub-jobs are sent before the
+    message is completed
+    """
+    queue = consumer.queue
+    pool = consumer.pool
+    blob_path = chop_blob_url(blob_url=blob_url)
+    timeout = consumer.ledger.timeout(blob_path=blob_path, size=blob_size)
+    started = time.monotonic()
+    # the cancel requests for blob_url are routed to timeout_event by the shared pubsub connection
+    tracking = consumer.pubsub.track(blob_url=blob_url, cancel_event=timeout_event,
+                                     expected_seconds=consumer.ledger.predict(blob_path=blob_path, size=blob_size)) \
+        if consumer.pubsub else nullcontext()
+    with tracking as websocket_client:
+        # create and attach  azure log handler to the root logger
+        root_logger = logging.getLogger()
+        # creating the log blob is a blocking request, like all the sync azure calls it is kept off the event loop
+        az_handler = await asyncio.to_thread(AzureBlobStorageHandler, connection_string=AZ_STORAGE_CONN_STR,
+                                             blob_url=blob_url,
+                                             log_level=root_logger.level)
+        root_logger.addHandler(az_handler)
+
+        if pool is not None:
+            ingest_task = asyncio.ensure_future(
+                pool.run(sync_ingest, cancel_event=timeout_event, websocket_client=websocket_client, blob_url=blob_url,
+                         conn_string=AZ_STORAGE_CONN_STR, join_vector_tiles=join_vector_tiles,
+                         src_file_path=src_file_path, unit=unit)
+            )
+        else:
+            # the thread keeps the prefetched file until it ends, it can outlive the message (see stop_ingest)
+            release = consumer.prefetcher.hold(blob_path=blob_path) if src_file_path else None
+            ingest_task = asyncio.ensure_future(
+                asyncio.to_thread(run_holding, sync_ingest, release=release, blob_url=blob_url,
+                                  timeout_event=timeout_event,
+                                  conn_string=AZ_STORAGE_CONN_STR, websocket_client=websocket_client, join_vector_tiles=join_vector_tiles,
+                                  src_file_path=src_file_path, unit=unit)
+            )
+        ingest_task.set_name('ingest')
+
+        try:
+            done, pending = await asyncio.wait(
+                [lock_task, ingest_task],
+                return_when=asyncio.FIRST_COMPLETED,
+                timeout=timeout,
+            )
+        except asyncio.CancelledError:
+            # the consumer is draining. The job is stopped and flushes its checkpoint, the message is abandoned by
+            # ingest_job. A cancelled pool job is killed after INGEST_WORKER_KILL_GRACE seconds to flush it, the
+            # thread of a job has to see timeout_event
+            if pool is None:
+                await stop_ingest(ingest_task=ingest_task, timeout_event=timeout_event)
+            ingest_task.cancel()
+            await asyncio.wait([ingest_task])
+            root_logger.removeHandler(az_handler)
+            await asyncio.to_thread(az_handler.close)
+            raise
+        if ingest_task in pending:
+            # timed out or the lock was lost, the job must not keep converting and uploading once its message is
+            # settled
+            await stop_ingest(ingest_task=ingest_task, timeout_event=timeout_event)
+        if len(done) == 0:
+            await asyncio.to_thread(report_cancellation, blob_url=blob_url,
+                                    error_message=f'Ingesting {blob_url} has timed out after {timeout:.0f} seconds.',
+                                    websocket_client=websocket_client)
+            if unit is None:
+                await asyncio.to_thread(consumer.ledger.record, blob_path=blob_path, size=blob_size,
+                                        total_seconds=time.monotonic() - started, status='timeout')
+
+        logger.debug(f'Handling done tasks')
+        for done_future in done:
+            try:
+                sub_units = await done_future
+                if done_future is ingest_task and sub_units:
+                    await queue.send_messages([compose_message(blob_url=blob_url, join_vector_tiles=join_vector_tiles,
+                                                               unit=sub_unit) for sub_unit in sub_units])
+                    logger.info(f'Sent {len(sub_units)} sub-job messages for {blob_url}')
+                await queue.complete_message(msg)
+                if done_future is ingest_task and unit is None and timeout_event.is_set():
+                    # the job was cancelled, it will not be resumed
+                    await asyncio.to_thread(discard_checkpoint, blob_url=blob_url, conn_string=AZ_STORAGE_CONN_STR)
+            except WorkerKilledError:
+                # the worker process was killed upon a cancel request, it had no chance to report it
+                await asyncio.to_thread(report_cancellation, blob_url=blob_url,
+                                        error_message=f'Ingesting {blob_url} was cancelled.',
+                                        websocket_client=websocket_client)
+                await queue.complete_message(msg)
+            except Exception as e:
+                with StringIO() as m:
+                    print_exc(file=m)
+                    em = m.getvalue()
+                    logger.error(f'done future error {em}')
+
+        logger.debug(f'Cancelling pending tasks')
+
+        for pending_future in pending:
+            em = f'Ingesting {blob_url} has not finished in time'
+            try:
+                pending_future.cancel()
+                await pending_future
+            except (asyncio.exceptions.CancelledError, Exception) as e:
+                # the stopped ingest may have ended by itself (WorkerKilledError from the pool)
+                with StringIO() as m:
+                    print_exc(file=m)
+                    em = m.getvalue()
+            # deadletter if task_name is ingest task: name == ingest
+            if pending_future is ingest_task:
+                logger.error(f"Pushing message for  {blob_url} to dead-letter "
+                             f"sub-queue")
+                await queue.dead_letter_message(
+                    msg, reason="ingest task error", error_description=em
+
+                )
+                if unit is None:
+                    await asyncio.to_thread(discard_checkpoint, blob_url=blob_url,
+                                            conn_string=AZ_STORAGE_CONN_STR)
+
+        root_logger.removeHandler(az_handler)
+        # appends the records still buffered to the log blob
+        await asyncio.to_thread(az_handler.close)
 
 
 def sync_ingest(blob_url: str = None, token: str = None, timeout_event: multiprocessing.Event = None,
-                conn_string: str = None, websocket_client=None, join_vector_tiles=None):
+                conn_string: str = None, websocket_client=None, join_vector_tiles=None, src_file_path: str = None,
+                unit: str = None):
     """
     Ingest a geospatial data file potentially containing multiple raster/vector layers
     into geohub
@@ -229,43 +575,184 @@ def sync_ingest(blob_url: str = None, token: str = None, timeout_event: multipro
 
     It is by design that the ingest is sync managed by an async machinery. The risk of running truly async ingest is running
     out of memory because multiple data files would have been opened at the same time in RAM.
-    This is why in essence the ingest is sequential, run by an async machinery and sync at its core. By combining these
-    features and approached a resilient and solid pipeline was produced.
+    This is why in essence every ingest is sequential, run by an async machinery and sync at its core. Several ingests
+    can run concurrently (INGEST_MAX_WORKERS) but only when their estimated RAM and disk needs fit in the ResourceBudget
+    of the pod. By combining these features and approached a resilient and solid pipeline was produced.
+
+    A file with at least INGEST_SPLIT_MIN_UNITS units is not converted here. Its units are recorded as the plan of the
+    job in the checkpoint manifest and returned, one sub-job message is sent for each of them (see ingest_unit).
 
     @param blob_url: the input file stored in Azure (blob)
     @param token:
     @param timeout_event: object used to signal a timeout has occurred
     @param conn_string: info to connect to Azure (download/upload)
     @param websocket_client, instance of webpubsub client to communites over azure webpubsub
-    @return: None
+    @param src_file_path: optional, abs path to the blob if it has already been downloaded (prefetched)
+    @param unit: optional, the unit to ingest if this is a sub-job of a split job
+    @return: list, the units of a split job still to be ingested, None otherwise
     """
     logger.info(f"Starting to ingest {blob_url}")
-    # if the file is a pmtiles file, return without ingesting, copy to datasets
+    try:
+        # if the file is a pmtiles file, return without ingesting, copy to datasets
+        blob_path = chop_blob_url(blob_url)
+        container_name, user, *rest = blob_path.split("/")
+        if blob_url.endswith(".pmtiles"):
+            copy_raw2datasets_sync(raw_blob_path=blob_path, connection_string=AZ_STORAGE_CONN_STR)
+        elif unit is not None:
+            ingest_unit(blob_url=blob_url, unit=unit, timeout_event=timeout_event, conn_string=conn_string,
+                        websocket_client=websocket_client)
+        else:
+            # the units of the file that were finished before the message was delivered again are skipped
+            checkpoint = JobCheckpoint.load(blob_url=blob_url, conn_string=conn_string)
+            started = time.monotonic()
+            with tempfile.TemporaryDirectory() as temp_dir:
+                if src_file_path:
+                    logger.info(f'Using prefetched {src_file_path}')
+                    temp_data_file = src_file_path
+                else:
+                    temp_data_file = download_blob_sync(
+                        local_folder=temp_dir,
+                        conn_string=conn_string,
+                        src_blob_path=blob_path,
+                        timeout_event=timeout_event
+                    )
+                downloaded = time.monotonic()
+                if websocket_client:
+                    payload = dict(user=user, url=blob_url, stage='downloaded', progress=30)
+                    publish_progress(payload=payload, websocket_client=websocket_client, conn_string=conn_string)
+                if not temp_data_file:
+                    raise Exception(f'Undetected exception has occurred while downloading {blob_path}')
+                if INGEST_SPLIT_MIN_UNITS > 0:
+                    units = list_units(src_file_path=temp_data_file, join_vector_tiles=join_vector_tiles)
+                    if len(units) >= INGEST_SPLIT_MIN_UNITS:
+                        checkpoint.set_plan(units)
+                        if not checkpoint.plan_pending:
+                            pending = [u for u in units if u not in checkpoint.units]
+                            logger.info(f'Split {blob_url} into {len(units)} units, '
+                                        f'{len(pending)} still to be ingested')
+                            if checkpoint.finisher:
+                                # the units were all finished before the message was delivered again
+                                finish_split_job(checkpoint=checkpoint, websocket_client=websocket_client)
+                            return pending
+                        logger.warning(f'Failed to record the plan of {blob_url}, ingesting it in one job')
+                        checkpoint.plan, checkpoint.plan_pending = None, False
+                diagnostics = JobDiagnostics(blob_url=blob_url, conn_string=conn_string)
+                try:
+                    process_geo_file(blob_url=blob_url, src_file_path=temp_data_file,
+                                     join_vector_tiles=join_vector_tiles, timeout_event=timeout_event,
+                                     conn_string=conn_string,
+                                     websocket_client=websocket_client, checkpoint=checkpoint,
+                                     diagnostics=diagnostics)
+                except BaseException:
+                    # the message is delivered again, the finished units are skipped then
+                    checkpoint.flush()
+                    raise
+                finally:
+                    diagnostics.close()
+                if timeout_event.is_set():
+                    # cancelled, timed out or drained. The manifest is removed once the message is settled for good
+                    # (see run_ingest), a drained job resumes from it
+                    checkpoint.flush()
+                else:
+                    checkpoint.delete()
+                finished = time.monotonic()
+                if not timeout_event.is_set():
+                    record_job(blob_path=blob_path, src_file_path=temp_data_file, total_seconds=finished - started,
+                               download_seconds=None if src_file_path else downloaded - started,
+                               process_seconds=finished - downloaded)
+                logger.info(f"Finished ingesting {blob_url}")
+    finally:
+        # the progress of the job is published before its message is settled
+        flush_progress(blob_url=blob_url)
+
+
+def record_job(blob_path: str = None, src_file_path: str = None, **durations):
+    """
+    Record an ingested job in the ledger (see JobLedger). The job has succeeded already, failing to describe the file
+    or to write the ledger is only logged
+    @param blob_path: str, the full relative path (including the container) to the raw blob
+    @param src_file_path: str, abs path to the downloaded raw blob
+    @param durations: the stage durations of the job in seconds, see JobLedger.record
+    """
+    try:
+        JobLedger(path=INGEST_LEDGER_PATH).record(
+            blob_path=blob_path, size=os.path.getsize(src_file_path),
+            **durations, **describe_dataset(src_path=prepare_arch_path(src_file_path))
+        )
+    except Exception as e:
+        logger.warning(f'Failed to record {blob_path} in the ledger {INGEST_LEDGER_PATH}: {e}')
+
+
+def ingest_unit(blob_url: str = None, unit: str = None, timeout_event: multiprocessing.Event = None,
+                conn_string: str = None, websocket_client=None):
+    """
+    Ingest one unit of a split job. The unit is claimed through a blob lease first so a message delivered twice does
+    not convert it twice. The outcome of the unit is recorded in the manifest of the job and the sub-job completing
+    the plan (the finisher) reports the job as processed and removes the manifest.
+    GDAL needs a local file to read a unit from most formats, the sub-jobs running on the same host convert their
+    unit from one shared copy of the file (see download_blob_shared).
+    """
+    checkpoint = JobCheckpoint.load(blob_url=blob_url, conn_string=conn_string)
     blob_path = chop_blob_url(blob_url)
-    container_name, user, *rest = blob_path.split("/")
-    if blob_url.endswith(".pmtiles"):
-        asyncio.run(copy_raw2datasets(raw_blob_path=blob_path, connection_string=AZ_STORAGE_CONN_STR))
-    else:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_data_file = download_blob_sync(
-                local_folder=temp_dir,
-                conn_string=conn_string,
-                src_blob_path=blob_path,
-                timeout_event=timeout_event
-            )
-            if websocket_client:
-                payload = dict(user=user, url=blob_url, stage='downloaded', progress=30)
-
-                websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME,
-                                               content=json.dumps(payload),
-                                                data_type=WebPubSubDataType.JSON)
-                container_rel_blob_path = os.path.join(user, *rest)
-                set_blob_metadata(connection_string=conn_string, container_name=container_name,dst_blob_path=container_rel_blob_path,
-                                  metadata={'stage':payload['stage'], 'progress':payload['progress']})
-            if not temp_data_file:
-                raise Exception(f'Undetected exception has occurred while downloading {blob_path}')
-            process_geo_file(blob_url=blob_url, src_file_path=temp_data_file, join_vector_tiles=join_vector_tiles,
-                             timeout_event=timeout_event,
-                             conn_string=conn_string, websocket_client=websocket_client)
-            logger.info(f"Finished ingesting {blob_url}")
+    if not checkpoint.plan or unit in checkpoint.units:
+        # the job was cancelled (the manifest has been removed), the raw blob has changed or the unit was ingested
+        logger.info(f'Skipping unit {unit} of {blob_url}, it is not pending')
+        if not checkpoint.plan:
+            remove_shared_blob(src_blob_path=blob_path, source_version=checkpoint.source_version)
+        return
+    claim = UnitClaim(checkpoint=checkpoint, unit=unit)
+    if not claim.acquire():
+        logger.info(f'Unit {unit} of {blob_url} is being ingested by another consumer')
+        return
+    diagnostics = JobDiagnostics(blob_url=blob_url, conn_string=conn_string)
+    try:
+        try:
+            with download_blob_shared(src_blob_path=blob_path, source_version=checkpoint.source_version,
+                                      conn_string=conn_string, timeout_event=timeout_event) as data_file:
+                outputs = process_unit(src_file_path=data_file, blob_url=blob_url, unit=unit,
+                                       conn_string=conn_string, timeout_event=timeout_event,
+                                       diagnostics=diagnostics)
+        except Exception as e:
+            logger.error(f'Failed to ingest unit {unit} of {blob_url}: {e}')
+            outputs = {}
+        finally:
+            # the errors of the unit are written before the finisher can report the job
+            diagnostics.close()
+        if outputs:
+            status = 'done'
+        else:
+            status = 'cancelled' if timeout_event and timeout_event.is_set() else 'failed'
+        checkpoint.mark_done(unit, outputs=outputs, status=status)
+    finally:
+        claim.release()
+    logger.info(f'Unit {unit} of {blob_url} is {status}')
+    if checkpoint.finisher:
+        remove_shared_blob(src_blob_path=blob_path, source_version=checkpoint.source_version)
+        finish_split_job(checkpoint=checkpoint, websocket_client=websocket_client)
+    elif websocket_client:
+        send_stage(blob_url=blob_url, stage='processing', progress=checkpoint.progress, conn_string=conn_string,
+                   websocket_client=websocket_client)
+
+
+def finish_split_job(checkpoint: JobCheckpoint = None, websocket_client=None):
+    """
+    Report a split job whose units have all been handled as processed (cancelled if any unit was cancelled) and
+    remove its manifest
+    """
+    cancelled = any(record.get('status') == 'cancelled' for record in checkpoint.units.values())
+    logger.info(f"Finished ingesting {checkpoint.blob_url}")
+    if websocket_client:
+        send_stage(blob_url=checkpoint.blob_url, stage='Cancelled' if cancelled else 'processed', progress=100,
+                   conn_string=checkpoint.conn_string, websocket_client=websocket_client)
+    checkpoint.delete()
+
+
+def send_stage(blob_url: str = None, stage: str = None, progress: int = None, conn_string: str = None,
+               websocket_client=None):
+    """
+    Send the stage and the progress of a job over the websocket and record them in the metadata of the raw blob
+    """
+    container_name, user, *rest = chop_blob_url(blob_url).split("/")
+    payload = dict(user=user, url=blob_url, stage=stage, progress=progress)
+    publish_progress(payload=payload, websocket_client=websocket_client, conn_string=conn_string)
 
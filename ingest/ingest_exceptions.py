@@ -5,3 +5,10 @@ class ResourceNotFoundError(Exception):
 class ClientRequestError(Exception):
     pass
 
+
+class MessageLockLostError(Exception):
+    pass
+
+
+class DownloadIntegrityError(Exception):
+    pass
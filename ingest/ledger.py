@@ -0,0 +1,198 @@
+import asyncio
+import contextlib
+import logging
+import math
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from ingest.config import (
+    INGEST_LEDGER_PATH,
+    INGEST_LEDGER_MIN_JOBS,
+    INGEST_TIMEOUT,
+    INGEST_TIMEOUT_FACTOR,
+    INGEST_TIMEOUT_MIN,
+    INGEST_TIMEOUT_MAX
+)
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def blob_format(blob_path: str = None) -> str:
+    _, ext = os.path.splitext(blob_path.lower())
+    return ext
+
+
+class JobLedger:
+    """
+    A local (SQLite) record of the ingested jobs: the format and size of the file, the number of layers, bands and
+    features and how long the download and the conversion took. Several processes (the pool workers) can write to
+    the same file.
+
+    A log-linear regression fitted on the successful jobs predicts the runtime of a job from what is known before
+    its file is downloaded, the size and the format:
+        log(seconds) = b0 + b1 * log(1 + size in MB) + b(format)
+    The model is fitted once min_jobs jobs have been recorded. Used as an async context manager the ledger refits it
+    every refit_interval seconds in a thread so the event loop never waits for the database. Until there is a model
+    predict returns None and the callers fall back to their defaults.
+    """
+
+    def __init__(self, path: str = None, min_jobs: int = 20, max_jobs: int = 5000, refit_interval: float = 300,
+                 timeout: float = 3600, timeout_factor: float = 3, timeout_min: float = 300,
+                 timeout_max: float = 14400):
+        self.path = path
+        self.min_jobs = min_jobs
+        # only the latest max_jobs are used to fit the model so it follows changes of the pods and of the formats
+        self.max_jobs = max_jobs
+        self.refit_interval = refit_interval
+        self.timeout_default = timeout
+        self.timeout_factor = timeout_factor
+        self.timeout_min = timeout_min
+        self.timeout_max = timeout_max
+        # (formats, coefficients, pooled throughput in bytes per second), replaced as a whole by fit
+        self.model = None
+        self.created = False
+        self.task = None
+
+    @classmethod
+    def from_config(cls):
+        return cls(path=INGEST_LEDGER_PATH, min_jobs=INGEST_LEDGER_MIN_JOBS, timeout=INGEST_TIMEOUT,
+                   timeout_factor=INGEST_TIMEOUT_FACTOR, timeout_min=INGEST_TIMEOUT_MIN,
+                   timeout_max=INGEST_TIMEOUT_MAX)
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.run(), name='ledger')
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def run(self):
+        while True:
+            await asyncio.to_thread(self.fit)
+            await asyncio.sleep(self.refit_interval)
+
+    @contextlib.contextmanager
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            if not self.created:
+                connection.execute(
+                    '''
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        blob_path TEXT NOT NULL,
+                        format TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        nlayers INTEGER,
+                        nbands INTEGER,
+                        nfeatures INTEGER,
+                        download_seconds REAL,
+                        process_seconds REAL,
+                        total_seconds REAL NOT NULL,
+                        status TEXT NOT NULL,
+                        finished_at REAL NOT NULL
+                    )
+                    '''
+                )
+                self.created = True
+            yield connection
+        finally:
+            connection.close()
+
+    def record(self, blob_path: str = None, size: int = None, total_seconds: float = None, status: str = 'ok',
+               nlayers: int = None, nbands: int = None, nfeatures: int = None, download_seconds: float = None,
+               process_seconds: float = None):
+        """
+        Add a job to the ledger. Failures are logged, the ledger never fails a job
+        @param status: str, ok, timeout or cancelled. Only the ok jobs are used to fit the model
+        """
+        try:
+            with self.connect() as connection:
+                connection.execute(
+                    '''
+                    INSERT INTO jobs (blob_path, format, size, nlayers, nbands, nfeatures, download_seconds,
+                        process_seconds, total_seconds, status, finished_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', (blob_path, blob_format(blob_path), size or 0, nlayers, nbands, nfeatures, download_seconds,
+                          process_seconds, total_seconds, status, time.time())
+                )
+        except Exception as e:
+            logger.error(f'Failed to record {blob_path} in the job ledger {self.path}: {e}')
+
+    @staticmethod
+    def features(formats: list = None, fmt: str = None, size: int = None) -> np.ndarray:
+        row = np.zeros(2 + len(formats))
+        row[0] = 1
+        row[1] = math.log1p((size or 0) / MB)
+        if fmt in formats:
+            row[2 + formats.index(fmt)] = 1
+        return row
+
+    def fit(self):
+        """
+        Fit the model on the latest successful jobs
+        """
+        try:
+            with self.connect() as connection:
+                rows = connection.execute(
+                    '''
+                    SELECT format, size, total_seconds FROM jobs WHERE status = 'ok' AND total_seconds > 0
+                    ORDER BY id DESC LIMIT ?
+                    ''', (self.max_jobs,)
+                ).fetchall()
+        except Exception as e:
+            logger.error(f'Failed to read the job ledger {self.path}: {e}')
+            return
+        if len(rows) < self.min_jobs:
+            return
+        formats = sorted({fmt for fmt, _, _ in rows})
+        x = np.array([self.features(formats=formats, fmt=fmt, size=size) for fmt, size, _ in rows])
+        y = np.log([seconds for _, _, seconds in rows])
+        # a small ridge penalty on the format terms keeps the rarely seen formats close to the overall mean
+        penalty = np.diag([0, 0] + [1e-2] * len(formats))
+        coefficients, *_ = np.linalg.lstsq(np.vstack([x, penalty]), np.concatenate([y, np.zeros(len(penalty))]),
+                                           rcond=None)
+        rate = sum(size for _, size, _ in rows) / sum(seconds for _, _, seconds in rows)
+        self.model = formats, coefficients, rate
+        residuals = y - x @ coefficients
+        logger.info(f'Fitted the job runtime model on {len(rows)} jobs, residual std {residuals.std():.2f} (log s)')
+
+    def predict(self, blob_path: str = None, size: int = None) -> float:
+        """
+        @return: float, the predicted runtime of the job in seconds or None if there is no model yet
+        """
+        if self.model is None:
+            return None
+        formats, coefficients, _ = self.model
+        return math.exp(self.features(formats=formats, fmt=blob_format(blob_path), size=size) @ coefficients)
+
+    def timeout(self, blob_path: str = None, size: int = None) -> float:
+        """
+        The time a job is given before it is cancelled, the predicted runtime times the safety factor clamped to
+        [timeout_min, timeout_max]. The default timeout is used until the model has been fitted
+        """
+        predicted = self.predict(blob_path=blob_path, size=size)
+        if predicted is None:
+            return self.timeout_default
+        return min(max(predicted * self.timeout_factor, self.timeout_min), self.timeout_max)
+
+    def cost(self, blob_path: str = None, size: int = None) -> float:
+        """
+        The predicted runtime expressed in bytes ingested at the average throughput of the recorded jobs, a job of a
+        format that is slow to convert costs more than its size. None if there is no model yet
+        """
+        predicted = self.predict(blob_path=blob_path, size=size)
+        if predicted is None:
+            return None
+        _, _, rate = self.model
+        return predicted * rate
@@ -0,0 +1,173 @@
+import asyncio
+import collections
+import datetime
+import heapq
+import itertools
+import logging
+import multiprocessing
+import statistics
+import time
+
+from ingest.config import INGEST_LOCK_RENEWAL_MARGIN, INGEST_LOCK_RENEWAL_BATCH_WINDOW
+from ingest.ingest_exceptions import MessageLockLostError
+
+logger = logging.getLogger(__name__)
+
+
+def lock_expiry(message=None) -> float:
+    """
+    The epoch time the lock on message expires. locked_until_utc is naive in some versions of the service bus SDK
+    """
+    return message.locked_until_utc.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class LockRenewal:
+    """
+    A message registered with the LockRenewalScheduler
+    """
+
+    def __init__(self, queue=None, message=None, timeout_event: multiprocessing.Event = None, name: str = None):
+        self.queue = queue
+        self.message = message
+        self.timeout_event = timeout_event
+        self.name = name
+        self.active = True
+        self.lost = asyncio.get_running_loop().create_future()
+
+    def fail(self, error: Exception = None):
+        self.active = False
+        if self.timeout_event is not None:
+            self.timeout_event.set()
+        if not self.lost.done():
+            self.lost.set_exception(error)
+
+    async def wait(self):
+        """
+        Wait until the lock is lost, raises MessageLockLostError
+        """
+        await self.lost
+
+
+class LockRenewalScheduler:
+    """
+    Keeps the locks of all messages in flight with a single task instead of one polling loop per message.
+    The registered messages are kept in a heap ordered by the time their lock has to be renewed, margin seconds
+    before it expires. The scheduler sleeps until the earliest deadline and then renews all the locks falling due
+    within batch_window seconds concurrently, so a pod ingesting many messages wakes up once per batch.
+    A failed renewal sets the timeout_event of the job right away, which cancels the ingest.
+    """
+
+    def __init__(self, margin: float = INGEST_LOCK_RENEWAL_MARGIN, batch_window: float = INGEST_LOCK_RENEWAL_BATCH_WINDOW,
+                 min_interval: float = 1, report_interval: float = 300):
+        self.margin = margin
+        self.batch_window = batch_window
+        # guards against a hot loop if the lock duration of the queue is shorter than the margin
+        self.min_interval = min_interval
+        self.report_interval = report_interval
+        self.heap = list()
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.task = None
+        self.renewals = 0
+        self.failures = 0
+        self.batches = 0
+        self.latencies = collections.deque(maxlen=1000)
+        self.last_report = time.monotonic()
+
+    async def __aenter__(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run(), name='lock-renewal')
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.report()
+
+    def register(self, queue=None, message=None, timeout_event: multiprocessing.Event = None,
+                 name: str = None) -> LockRenewal:
+        """
+        Keep the lock on message until it is unregistered
+        @param queue: instance of MessageQueue message was received from
+        @param message: the received message
+        @param timeout_event: set if the lock can not be renewed
+        @param name: used in the log records, usually the blob url
+        @return: instance of LockRenewal
+        """
+        renewal = LockRenewal(queue=queue, message=message, timeout_event=timeout_event, name=name)
+        self.schedule(renewal)
+        logger.debug(f'Starting lock monitoring for {name}')
+        return renewal
+
+    def unregister(self, renewal: LockRenewal = None):
+        # the entry is dropped from the heap when it falls due
+        renewal.active = False
+
+    def schedule(self, renewal: LockRenewal = None):
+        due = max(lock_expiry(renewal.message) - self.margin, time.time() + self.min_interval)
+        if not self.heap or due < self.heap[0][0]:
+            self.wakeup.set()
+        heapq.heappush(self.heap, (due, next(self.counter), renewal))
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            horizon = time.time() + self.batch_window
+            batch = list()
+            while self.heap and self.heap[0][0] <= horizon:
+                _, _, renewal = heapq.heappop(self.heap)
+                if renewal.active:
+                    batch.append(renewal)
+            if batch:
+                self.batches += 1
+                await asyncio.gather(*[self.renew(renewal) for renewal in batch])
+            if time.monotonic() - self.last_report >= self.report_interval:
+                self.report()
+
+    async def renew(self, renewal: LockRenewal = None):
+        start = time.monotonic()
+        try:
+            await renewal.queue.renew_message_lock(message=renewal.message)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f'Failed to renew the lock for {renewal.name}: {e}. Cancelling the ingest')
+            renewal.fail(MessageLockLostError(f'The lock for {renewal.name} could not be renewed: {e}'))
+            return
+        latency = time.monotonic() - start
+        self.renewals += 1
+        self.latencies.append(latency)
+        logger.debug(f'Renewed the lock for {renewal.name} in {latency:.3f} seconds')
+        if renewal.active:
+            self.schedule(renewal)
+
+    def stats(self) -> dict:
+        """
+        The number of renewals, failures and batches and the latency (seconds) of the recent renewals
+        """
+        stats = dict(renewals=self.renewals, failures=self.failures, batches=self.batches,
+                     registered=sum(1 for _, _, renewal in self.heap if renewal.active))
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            stats.update(latency_mean=statistics.fmean(latencies),
+                         latency_p95=latencies[int(0.95 * (len(latencies) - 1))],
+                         latency_max=latencies[-1])
+        return stats
+
+    def report(self):
+        self.last_report = time.monotonic()
+        stats = self.stats()
+        if stats['renewals'] or stats['failures']:
+            logger.info(f'Lock renewal stats: {stats}')
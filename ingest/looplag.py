@@ -0,0 +1,86 @@
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from ingest.azlog import current_blob_url
+from ingest.config import INGEST_LOOP_LAG_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """
+    Watches the event loop of the consumer. A task sleeping interval seconds measures how late the loop wakes it up
+    (the loop lag) and a watchdog thread logs the stack of the loop thread as soon as the loop has not woken the task
+    for threshold seconds, which points at the call blocking the loop while it is still blocking it. A blocked loop
+    delays the lock renewals and the cancel requests of all the jobs.
+    """
+
+    def __init__(self, threshold: float = INGEST_LOOP_LAG_THRESHOLD, interval: float = None):
+        self.threshold = threshold
+        self.interval = interval or threshold / 2
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.task = None
+        self.watchdog = None
+        self.stop_event = threading.Event()
+        self.lags = collections.deque(maxlen=1000)
+        self.max_lag = 0
+        self.stalls = 0
+
+    async def __aenter__(self):
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self.run(), name='loop-lag')
+        self.watchdog = threading.Thread(target=self.watch, name='loop-lag-watchdog', daemon=True)
+        self.watchdog.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.stop_event.set()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        await asyncio.to_thread(self.watchdog.join)
+
+    async def run(self):
+        # the records of the monitor do not belong to the log blob of any job
+        current_blob_url.set('')
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            lag = self.heartbeat - start - self.interval
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self.stalls += 1
+                logger.warning(f'The event loop was blocked for {lag:.2f} seconds')
+
+    def watch(self):
+        current_blob_url.set('')
+        reported = None
+        while not self.stop_event.wait(self.interval):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat
+            if blocked < self.threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            logger.warning(f'The event loop has been blocked for {blocked:.2f} seconds in:\n{stack}')
+
+    def stats(self) -> dict:
+        """
+        The recent, the 95th percentile and the maximum loop lag in seconds and the number of stalls longer than the
+        threshold
+        """
+        lags = sorted(self.lags)
+        return dict(lag_last=self.lags[-1] if self.lags else 0,
+                    lag_p95=lags[int(0.95 * (len(lags) - 1))] if lags else 0, lag_max=self.max_lag, stalls=self.stalls)
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+
+from ingest.admission import available_memory, available_disk
+
+logger = logging.getLogger(__name__)
+
+
+def escape_label(value) -> str:
+    """
+    Escape a label value (the user names come from the blob paths)
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_metrics(metrics: list = None) -> str:
+    """
+    Format metrics in the Prometheus text exposition format
+    @param metrics: list of (name, type, help, samples) tuples, samples is a list of (labels dict, value)
+    """
+    lines = list()
+    for name, metric_type, help_text, samples in metrics:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in samples:
+            label_str = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+            lines.append(f'{name}{{{label_str}}} {value}' if label_str else f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def collect_metrics(consumer=None) -> list:
+    """
+    The capacity and the backlog of a consumer
+    @param consumer: instance of ingest.ingest.Consumer
+    @return: list of (name, type, help, samples) tuples
+    """
+    scheduler = consumer.scheduler
+    budget = consumer.budget
+    lanes = scheduler.lanes.values()
+    waiting = scheduler.waiting_jobs()
+    metrics = [
+        ('ingest_jobs_running', 'gauge', 'Jobs holding a worker slot',
+         [(dict(lane=lane.name), lane.running) for lane in lanes]),
+        ('ingest_jobs_waiting', 'gauge', 'Received jobs waiting for a worker slot',
+         [(dict(lane=lane.name), len(scheduler.waiting_jobs(lane=lane))) for lane in lanes]),
+        ('ingest_worker_slots', 'gauge', 'Worker slots', [(dict(lane=lane.name), lane.slots) for lane in lanes]),
+        ('ingest_worker_slots_free', 'gauge', 'Free worker slots',
+         [(dict(lane=lane.name), max(lane.slots - lane.running, 0)) for lane in lanes]),
+        ('ingest_memory_budget_free_bytes', 'gauge', 'RAM not reserved by the running jobs',
+         [({}, budget.free_memory)]),
+        ('ingest_disk_budget_free_bytes', 'gauge', 'Temporary disk space not reserved by the running jobs',
+         [({}, budget.free_disk)]),
+        ('ingest_memory_available_bytes', 'gauge', 'RAM currently available to the pod', [({}, available_memory())]),
+        ('ingest_disk_available_bytes', 'gauge', 'Disk space currently free in the temporary folder',
+         [({}, available_disk())]),
+        ('ingest_backlog_bytes', 'gauge', 'Size of the blobs of the jobs waiting for a worker slot',
+         [({}, sum(job.size or 0 for job in waiting))]),
+        ('ingest_draining', 'gauge', 'Whether the consumer is draining', [({}, int(consumer.draining.is_set()))]),
+    ]
+    predictions = [consumer.ledger.predict(blob_path=job.blob_path, size=job.size) for job in waiting]
+    if None not in predictions or not waiting:
+        # only exported once the ledger has a model, an autoscaler treats a missing series as no data
+        metrics.append(('ingest_backlog_seconds', 'gauge', 'Predicted runtime of the jobs waiting for a worker slot',
+                        [({}, round(sum(predictions), 1))]))
+    if consumer.prefetcher is not None:
+        metrics.append(('ingest_prefetch_spool_bytes', 'gauge', 'Bytes of the blobs prefetched into the spool',
+                        [({}, consumer.prefetcher.used_bytes)]))
+    if consumer.monitor is not None:
+        loop_stats = consumer.monitor.stats()
+        metrics += [
+            ('ingest_loop_lag_seconds', 'gauge', 'How late the event loop ran the last heartbeat',
+             [(dict(quantile='last'), round(loop_stats['lag_last'], 4)),
+              (dict(quantile='0.95'), round(loop_stats['lag_p95'], 4)),
+              (dict(quantile='max'), round(loop_stats['lag_max'], 4))]),
+            ('ingest_loop_stalls_total', 'counter', 'Times the event loop was blocked longer than the threshold',
+             [({}, loop_stats['stalls'])]),
+        ]
+    user_stats = scheduler.stats()
+    metrics += [
+        ('ingest_user_jobs_running', 'gauge', 'Running jobs per user',
+         [(dict(user=user), stats['running']) for user, stats in user_stats.items()]),
+        ('ingest_user_jobs_waiting', 'gauge', 'Received jobs waiting for a worker slot per user',
+         [(dict(user=user), stats['waiting']) for user, stats in user_stats.items()]),
+        ('ingest_user_wait_seconds', 'gauge', 'Time the recent jobs of a user waited for a worker slot',
+         [(dict(user=user, quantile=quantile), round(stats[key], 3)) for user, stats in user_stats.items()
+          if 'wait_mean' in stats
+          for quantile, key in (('mean', 'wait_mean'), ('0.95', 'wait_p95'), ('max', 'wait_max'))]),
+    ]
+    lock_stats = consumer.locks.stats()
+    metrics += [
+        ('ingest_lock_renewals_total', 'counter', 'Message lock renewals', [({}, lock_stats['renewals'])]),
+        ('ingest_lock_renewal_failures_total', 'counter', 'Failed message lock renewals',
+         [({}, lock_stats['failures'])]),
+    ]
+    return metrics
+
+
+class MetricsServer:
+    """
+    A minimal HTTP endpoint serving the metrics of the consumer on GET /metrics. It runs on the event loop of the
+    consumer and is only meant to be scraped from inside the cluster.
+    """
+
+    def __init__(self, consumer=None, host: str = '0.0.0.0', port: int = None):
+        self.consumer = consumer
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, host=self.host, port=self.port)
+        logger.info(f'Serving the metrics on http://{self.host}:{self.port}/metrics')
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader = None, writer: asyncio.StreamWriter = None):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            while (await asyncio.wait_for(reader.readline(), timeout=10)).strip():
+                # the headers are not used
+                pass
+            method, path, *_ = request_line.decode('latin-1').split()
+            if method == 'GET' and path.split('?')[0] == '/metrics':
+                status = '200 OK'
+                body = format_metrics(collect_metrics(consumer=self.consumer)).encode()
+            else:
+                status = '404 Not Found'
+                body = b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f'Failed to serve a metrics request: {e}')
+        finally:
+            writer.close()
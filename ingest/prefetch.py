@@ -0,0 +1,126 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from ingest.azblob import download_blob_sync
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetch:
+    def __init__(self, blob_path: str = None, folder: str = None, size: int = 0):
+        self.blob_path = blob_path
+        self.folder = folder
+        self.size = size
+        self.stop_event = threading.Event()
+        self.task = None
+        # the messages (and the job threads, see Prefetcher.hold) using the prefetched file
+        self.refs = 1
+
+
+class Prefetcher:
+    """
+    Downloads the blobs of the messages waiting for a free worker into a local spool folder so the download of the
+    next job overlaps the conversion of the current one. The spool is capped at max_bytes. A blob that does not fit
+    is not prefetched and its job downloads it the usual way once it starts.
+
+    The messages pointing to the same blob share one download. Every prefetch and hold takes a reference to it and
+    the folder of the download is removed once the last reference is released. Every download has a folder of its
+    own, a blob prefetched again while an older download is still held does not share its folder.
+    """
+
+    def __init__(self, spool_dir: str = None, max_bytes: int = None, conn_string: str = None):
+        self.spool_dir = spool_dir
+        self.max_bytes = max_bytes
+        self.conn_string = conn_string
+        self.used_bytes = 0
+        self.prefetches = dict()
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    def prefetch(self, blob_path: str = None, size: int = 0) -> bool:
+        """
+        Start to download blob_path in the background if it fits in the spool
+        @param blob_path: str, the full relative path (including the container) to the blob
+        @param size: int, the size of the blob in bytes
+        @return: True if the download was started (or is shared with another message), release has to be called then
+        """
+        prefetch = self.prefetches.get(blob_path)
+        if prefetch is not None:
+            prefetch.refs += 1
+            return True
+        if self.used_bytes + size > self.max_bytes:
+            logger.info(f'Not prefetching {blob_path}, the spool has {self.max_bytes - self.used_bytes} bytes left '
+                        f'and the blob has {size} bytes')
+            return False
+        folder = tempfile.mkdtemp(dir=self.spool_dir, prefix=f'{hashlib.md5(blob_path.encode()).hexdigest()}-')
+        prefetch = Prefetch(blob_path=blob_path, folder=folder, size=size)
+        prefetch.task = asyncio.ensure_future(
+            asyncio.to_thread(download_blob_sync, src_blob_path=blob_path, local_folder=folder,
+                              conn_string=self.conn_string, timeout_event=prefetch.stop_event)
+        )
+        self.prefetches[blob_path] = prefetch
+        self.used_bytes += size
+        logger.info(f'Prefetching {blob_path} into {folder}')
+        return True
+
+    async def take(self, blob_path: str = None):
+        """
+        Wait for the prefetched download of blob_path to finish
+        @return: the abs path to the downloaded file or None if the blob was not (successfully) prefetched
+        """
+        prefetch = self.prefetches.get(blob_path)
+        if prefetch is None:
+            return
+        try:
+            return await asyncio.shield(prefetch.task)
+        except Exception as e:
+            logger.error(f'Prefetching {blob_path} has failed: {e}. It will be downloaded again.')
+
+    def hold(self, blob_path: str = None):
+        """
+        Take one more reference to the prefetched blob_path for a user that can outlive the message, the thread of a
+        job that does not stop in time (see ingest.stop_ingest)
+        @return: a function releasing the reference, callable from any thread
+        """
+        prefetch = self.prefetches.get(blob_path)
+        if prefetch is None:
+            return lambda: None
+        prefetch.refs += 1
+        loop = asyncio.get_running_loop()
+
+        def _release_():
+            try:
+                loop.call_soon_threadsafe(asyncio.ensure_future, self.unref(prefetch))
+            except RuntimeError:
+                # the loop has been closed, the process is exiting
+                pass
+
+        return _release_
+
+    async def release(self, blob_path: str = None):
+        """
+        Release the reference of a message to the prefetched blob_path. Once there are no references left the download
+        is stopped if still running and its space in the spool is freed
+        """
+        prefetch = self.prefetches.get(blob_path)
+        if prefetch is None:
+            return
+        await self.unref(prefetch)
+
+    async def unref(self, prefetch: Prefetch = None):
+        prefetch.refs -= 1
+        if prefetch.refs > 0:
+            return
+        if self.prefetches.get(prefetch.blob_path) is prefetch:
+            del self.prefetches[prefetch.blob_path]
+        prefetch.stop_event.set()
+        try:
+            await prefetch.task
+        except Exception:
+            pass
+        await asyncio.to_thread(shutil.rmtree, prefetch.folder, ignore_errors=True)
+        self.used_bytes -= prefetch.size
@@ -1,3 +1,5 @@
+import concurrent.futures
+import functools
 import io
 import multiprocessing
 import os.path
@@ -7,18 +9,22 @@ from osgeo import gdal, osr, ogr
 from pmtiles.reader import Reader, MmapSource
 import typing
 import tempfile
-from ingest.config import gdal_configs, attribution, AZURE_WEBPUBSUB_GROUP_NAME
+from ingest.config import gdal_configs, attribution
 from rio_cogeo import cog_validate, cog_translate
 from rio_cogeo.profiles import cog_profiles
 import morecantile
-from azure.messaging.webpubsubclient.models import WebPubSubDataType
 import logging
 from ingest.utils import (
     prepare_arch_path,
     get_local_cog_path,
     get_azure_blob_path, chop_blob_url, get_progress
 )
-from ingest.azblob import upload_blob, upload_content_to_blob, upload_ingesting_blob, set_blob_metadata
+from ingest.azblob import upload_ingesting_blob
+from ingest.workers import in_pool_worker
+from ingest.checkpoint import JobCheckpoint
+from ingest.diagnostics import JobDiagnostics, report_error
+from ingest.progress import publish_progress, UnitProgress
+from ingest.upload_queue import UploadQueue, with_upload_queue
 from traceback import print_exc
 
 gdal.UseExceptions()
@@ -26,6 +32,12 @@ import subprocess
 
 logger = logging.getLogger(__name__)
 
+# the share of the conversion of a vector unit taken by the FlatGeobuf stage, tippecanoe takes the rest
+FGB_STAGE_SHARE = 0.4
+
+# the tiling progress tippecanoe writes to stderr, e.g. "  42.7%  10/512/341"
+TIPPECANOE_PROGRESS = re.compile(r'(\d+(?:\.\d+)?)%')
+
 config, output_profile = gdal_configs()
 
 for varname, varval in config.items():
@@ -61,21 +73,23 @@ def should_reproject(src_srs: osr.SpatialReference = None, dst_srs: osr.SpatialR
     return not proj_are_equal
 
 
-def tippecanoe(tippecanoe_cmd: str = None, timeout_event=None):
+def tippecanoe(tippecanoe_cmd: str = None, timeout_event=None, progress: UnitProgress = None):
     """
     tippecanoe is a bit peculiar. It redirects the status and live logging to stderr
     see https://github.com/mapbox/tippecanoe/issues/874
 
     As a result the line buffering  has to be enabled (bufsize=1) and the output is set as text (universal_new_line)
     This allows to follow the conversion logs in real time.
+    Inside a pool worker tippecanoe stays in the process group of the worker so it is killed together with it.
     @param tippecanoe_cmd: str, the
     @param timeout_event:
+    @param progress: optional, instance of UnitProgress the tiling progress is reported to
     @return:
     """
     logger.debug(' '.join(tippecanoe_cmd))
     with subprocess.Popen(tippecanoe_cmd, stdout=subprocess.PIPE,
                           stderr=subprocess.STDOUT,
-                          start_new_session=True,
+                          start_new_session=not in_pool_worker(),
                           universal_newlines=True,
                           bufsize=1
                           ) as proc:
@@ -88,6 +102,9 @@ def tippecanoe(tippecanoe_cmd: str = None, timeout_event=None):
                 if output:
                     logger.debug(output)
                     if err != output: err = output
+                    match = TIPPECANOE_PROGRESS.search(output)
+                    if progress and match:
+                        progress.update(float(match.group(1)) / 100)
                 if timeout_event and timeout_event.is_set():
                     logger.error(f'tippecanoe process has been signalled to stop ')
                     proc.terminate()
@@ -104,7 +121,9 @@ def dataset2fgb(fgb_dir: str = None,
                 conn_string: str = None,
                 blob_url: str = None,
                 timeout_event=None,
-                silent_mode=False):
+                silent_mode=False,
+                progress: UnitProgress = None,
+                diagnostics: JobDiagnostics = None):
     """
     Convert one or more layers from src_ds into FlatGeobuf format in a (temporary) directory featuring dst_prj_epsg
     projection. The layer is possibly reprojected. In case errors are encountered an error blob is uploaded for now
@@ -117,13 +136,15 @@ def dataset2fgb(fgb_dir: str = None,
     @param blob_url: the url of the blob to be ingested
     @param timeout_event:
     @param silent_mode: if True, it will not upload error file
+    @param progress: optional, instance of UnitProgress the conversion progress is reported to
+    @param diagnostics: optional, instance of JobDiagnostics the errors are recorded in
     @return:
     """
     dst_srs = osr.SpatialReference()
     dst_srs.ImportFromEPSG(dst_prj_epsg)
     src_path = os.path.abspath(src_ds.GetDescription())
     converted_layers = dict()
-    for lname in layers:
+    for layer_index, lname in enumerate(layers):
         try:
             # if '_' in lname:raise Exception(f'Simulated exception on {lname}')
             dst_path = os.path.join(fgb_dir, f'{lname}.fgb')
@@ -154,7 +175,12 @@ def dataset2fgb(fgb_dir: str = None,
                                           srcDS=src_ds,
                                           reproject=reproject,
                                           options=' '.join(fgb_opts),
-                                          callback=gdal_callback,
+                                          callback=functools.partial(
+                                              gdal_callback,
+                                              progress=progress.span(layer_index / len(layers),
+                                                                     (layer_index + 1) / len(layers))
+                                              if progress else None
+                                          ),
                                           callback_data=timeout_event
                                           )
             converted_features = fgb_ds.GetLayerByName(lname).GetFeatureCount()
@@ -167,18 +193,12 @@ def dataset2fgb(fgb_dir: str = None,
             del fgb_ds
             #issue a warning in case the out features are 0 or there is
             if converted_features == 0 or converted_features!= original_features and conn_string:
-                # upload error blob
-                blob_name = chop_blob_url(blob_url=blob_url)
-                container_name, *rest, blob_name = blob_name.split("/")
-                error_blob_path = f'{"/".join(rest)}/{blob_name}.error'
-                logger.info(f'Uploading error message to {error_blob_path}')
                 error_message = f'There could be issues with layer "{lname}".\nOriginal number of features/geometries ={original_features} while converted={converted_features}'
                 if silent_mode:
                     logger.info(f"skipped uploading error file")
                 else:
-                    upload_content_to_blob(content=error_message, connection_string=conn_string,
-                                           container_name=container_name,
-                                           dst_blob_path=error_blob_path)
+                    report_error(message=error_message, blob_url=blob_url, conn_string=conn_string,
+                                 unit=f'layer:{lname}', level='warning', diagnostics=diagnostics)
 
 
 
@@ -197,24 +217,56 @@ def dataset2fgb(fgb_dir: str = None,
                     msg += f'gdal_error_message: {error_message}'
                     logger.error(msg)
                     if conn_string :
-                        # upload error blob
-                        blob_name = chop_blob_url(blob_url=blob_url)
-                        container_name, *rest, blob_name = blob_name.split("/")
-                        error_blob_path = f'{"/".join(rest)}/{blob_name}.error'
-                        logger.info(f'Uploading error message to {error_blob_path}')
                         if silent_mode:
                             logger.info(f"skipped uploading error file")
                         else:
-                            upload_content_to_blob(content=error_message, connection_string=conn_string,
-                                                   container_name=container_name,
-                                                   dst_blob_path=error_blob_path)
+                            report_error(message=error_message, blob_url=blob_url, conn_string=conn_string,
+                                         unit=f'layer:{lname}', diagnostics=diagnostics)
 
 
     return converted_layers
 
 
+def upload_outputs(uploads: UploadQueue = None, files: typing.Dict[str, str] = None, blob_url: str = None,
+                   conn_string: str = None, container_name: str = None, ingesting_blob_path: str = None,
+                   keep: typing.Iterable[str] = (), unit: str = None, diagnostics: JobDiagnostics = None) -> dict:
+    """
+    Queue the upload of the outputs of a unit. The .ingesting blob is uploaded once they have all been uploaded, a
+    failed upload is reported as an error of the unit
+    @param uploads: instance of UploadQueue
+    @param files: dict, the blob paths of the outputs and their local path
+    @param keep: the local paths that are kept once uploaded (the outputs written to dst_directory)
+    @param unit: str, the unit the errors are reported for
+    @return: dict, the blob paths of the outputs and the futures of their upload
+    """
+    outputs = dict()
+    for dst_blob_path, src_path in files.items():
+        logger.info(f'Uploading {src_path} to {dst_blob_path}')
+        outputs[dst_blob_path] = uploads.submit(src_path=src_path, connection_string=conn_string,
+                                                container_name=container_name, dst_blob_path=dst_blob_path,
+                                                remove=src_path not in keep)
+
+    def uploaded(etags: dict = None, error: Exception = None):
+        if error is None:
+            upload_ingesting_blob(ingesting_blob_path, container_name=container_name, connection_string=conn_string)
+            return
+        if isinstance(error, concurrent.futures.CancelledError):
+            # the job was cancelled, see UploadQueue.cancel
+            logger.info(f'The upload of the outputs of {unit} was cancelled')
+            return
+        error_message = f'Failed to upload the outputs of {unit}: {error}'
+        logger.error(error_message)
+        report_error(message=error_message, blob_url=blob_url, conn_string=conn_string, unit=unit,
+                     diagnostics=diagnostics)
+
+    uploads.when_done(outputs=outputs, callback=uploaded)
+    return outputs
+
+
+@with_upload_queue
 def fgb2pmtiles(blob_url=None, fgb_layers: typing.Dict[str, str] = None, pmtiles_file_name: str = None,
-                timeout_event=multiprocessing.Event, conn_string: str = None, dst_directory: str = None):
+                timeout_event=multiprocessing.Event, conn_string: str = None, dst_directory: str = None,
+                progress: UnitProgress = None, diagnostics: JobDiagnostics = None, uploads: UploadQueue = None):
     """
     Converts all FlatGeobuf files from fgb_layers dict into PMtile format and uploads the result to Azure
     blob. Supports cancellation through event arg
@@ -222,11 +274,17 @@ def fgb2pmtiles(blob_url=None, fgb_layers: typing.Dict[str, str] = None, pmtiles
     @param pmtiles_file_name: the name of the output PMTiles file. If supplied all layers will be added to this file
     @param timeout_event: arg to signalize to Tippecanoe a timeout/interrupt
     @param conn_string: the connection string used t connect to the Azure storage account
-    @return:
+    @param progress: optional, instance of UnitProgress the tiling progress is reported to
+    @param diagnostics: optional, instance of JobDiagnostics the errors are recorded in
+    @param uploads: optional, instance of UploadQueue the outputs are uploaded by in the background. Without it they
+    are uploaded before returning
+    @return: dict, the uploaded blobs and their ETag, or the futures of their upload when uploads is supplied. The
+    PMTiles files written to dst_directory are kept, the FlatGeobuf files and the other PMTiles files are removed once
+    uploaded
     """
-
+    outputs = dict()
     if pmtiles_file_name is None:
-        for layer_name, fgb_layer_path in fgb_layers.items():
+        for layer_index, (layer_name, fgb_layer_path) in enumerate(fgb_layers.items()):
             try:
                 if dst_directory:
 
@@ -253,7 +311,9 @@ def fgb2pmtiles(blob_url=None, fgb_layers: typing.Dict[str, str] = None, pmtiles
                     f'--attribution={attribution}',
                     fgb_layer_path,
                 ]
-                tippecanoe(tippecanoe_cmd=tippecanoe_cmd, timeout_event=timeout_event)
+                layer_progress = progress.span(layer_index / len(fgb_layers),
+                                               (layer_index + 1) / len(fgb_layers)) if progress else None
+                tippecanoe(tippecanoe_cmd=tippecanoe_cmd, timeout_event=timeout_event, progress=layer_progress)
                 with open(layer_pmtiles_path, 'r+b') as f:
                     reader = Reader(MmapSource(f))
                     mdict = reader.metadata()
@@ -269,17 +329,14 @@ def fgb2pmtiles(blob_url=None, fgb_layers: typing.Dict[str, str] = None, pmtiles
                 if conn_string is not None:
                     container_name, pmtiles_blob_path = get_azure_blob_path(blob_url=blob_url,
                                                                             local_path=layer_pmtiles_path)
-                    logger.info(f'Uploading {layer_pmtiles_path} to {pmtiles_blob_path}')
-                    upload_blob(src_path=layer_pmtiles_path, connection_string=conn_string,
-                                container_name=container_name,
-                                dst_blob_path=pmtiles_blob_path, )
-
-                    upload_blob(src_path=fgb_layer_path, connection_string=conn_string,
-                                container_name=container_name,
-                                dst_blob_path=f"{pmtiles_blob_path}.fgb", )
-
-                    upload_ingesting_blob(pmtiles_blob_path, container_name=container_name,
-                                          connection_string=conn_string)
+                    # the upload overlaps the conversion of the next layer
+                    outputs.update(upload_outputs(uploads=uploads, files={pmtiles_blob_path: layer_pmtiles_path,
+                                                                          f"{pmtiles_blob_path}.fgb": fgb_layer_path},
+                                                  blob_url=blob_url, conn_string=conn_string,
+                                                  container_name=container_name,
+                                                  ingesting_blob_path=pmtiles_blob_path,
+                                                  keep=[layer_pmtiles_path] if dst_directory else [],
+                                                  unit=f'layer:{layer_name}', diagnostics=diagnostics))
 
 
 
@@ -298,16 +355,8 @@ def fgb2pmtiles(blob_url=None, fgb_layers: typing.Dict[str, str] = None, pmtiles
                     msg += f'layer: {layer_name}\n'
                     msg += f'gdal_error_message: {error_message}'
                     logger.error(msg)
-                    # upload error file
-                    if conn_string is not None:
-
-                        blob_name = chop_blob_url(blob_url=blob_url)
-                        container_name, *rest, blob_name = blob_name.split("/")
-                        error_blob_path = f'{"/".join(rest)}/{blob_name}.error'
-                        logger.info(f'Uploading error message to {error_blob_path}')
-                        upload_content_to_blob(content=error_message, connection_string=conn_string,
-                                               container_name=container_name,
-                                               dst_blob_path=error_blob_path)
+                    report_error(message=error_message, blob_url=blob_url, conn_string=conn_string,
+                                 unit=f'layer:{layer_name}', diagnostics=diagnostics)
                 if len(fgb_layers) > 1: logger.error(f'Moving to next layer')
 
 
@@ -345,7 +394,7 @@ def fgb2pmtiles(blob_url=None, fgb_layers: typing.Dict[str, str] = None, pmtiles
             ]
 
             tippecanoe_cmd += fgb_sources
-            tippecanoe(tippecanoe_cmd=tippecanoe_cmd, timeout_event=timeout_event)
+            tippecanoe(tippecanoe_cmd=tippecanoe_cmd, timeout_event=timeout_event, progress=progress)
             with open(pmtiles_path, 'r+b') as f:
                 reader = Reader(MmapSource(f))
                 mdict = reader.metadata()
@@ -364,15 +413,13 @@ def fgb2pmtiles(blob_url=None, fgb_layers: typing.Dict[str, str] = None, pmtiles
             if conn_string is not None:
                 container_name, pmtiles_blob_path = get_azure_blob_path(blob_url=blob_url,
                                                                         local_path=pmtiles_path)
-                logger.info(f'Uploading {pmtiles_path} to {pmtiles_blob_path}')
-                upload_blob(src_path=pmtiles_path, connection_string=conn_string, container_name=container_name,
-                            dst_blob_path=pmtiles_blob_path)
-
+                files = {pmtiles_blob_path: pmtiles_path}
                 for layer_name, fgb_layer_path in fgb_layers.items():
-                    upload_blob(src_path=fgb_layer_path, connection_string=conn_string, container_name=container_name,
-                                dst_blob_path=f"{pmtiles_blob_path}.{layer_name}.fgb")
-
-                upload_ingesting_blob(pmtiles_blob_path, container_name=container_name, connection_string=conn_string)
+                    files[f"{pmtiles_blob_path}.{layer_name}.fgb"] = fgb_layer_path
+                outputs = upload_outputs(uploads=uploads, files=files, blob_url=blob_url, conn_string=conn_string,
+                                         container_name=container_name, ingesting_blob_path=pmtiles_blob_path,
+                                         keep=[pmtiles_path] if dst_directory else [], unit='layers',
+                                         diagnostics=diagnostics)
 
 
         except subprocess.TimeoutExpired as te:
@@ -391,24 +438,23 @@ def fgb2pmtiles(blob_url=None, fgb_layers: typing.Dict[str, str] = None, pmtiles
                 logger.error(msg)
 
 
-                # upload error file
-                if conn_string is not None:
-                    blob_name = chop_blob_url(blob_url=blob_url)
-                    container_name, *rest, blob_name = blob_name.split("/")
-                    error_blob_path = f'{"/".join(rest)}/{blob_name}.error'
-                    logger.info(f'Uploading error message to {error_blob_path}')
-                    upload_content_to_blob(content=error_message, connection_string=conn_string,
-                                           container_name=container_name,
-                                           dst_blob_path=error_blob_path)
+                report_error(message=error_message, blob_url=blob_url, conn_string=conn_string, unit='layers',
+                             diagnostics=diagnostics)
+            return dict()
+    return outputs
 
 
+@with_upload_queue
 def dataset2pmtiles(blob_url: str = None,
                     src_ds: gdal.Dataset = None,
                     layers: typing.List[str] = None,
                     conn_string: str = None,
                     pmtiles_file_name: typing.Optional[str] = None,
                     timeout_event: multiprocessing.Event = None,
-                    dst_directory: str = None):
+                    dst_directory: str = None,
+                    progress: UnitProgress = None,
+                    diagnostics: JobDiagnostics = None,
+                    uploads: UploadQueue = None):
     """
     Converts the layer/s contained in src_ds GDAL dataset  to PMTiles and uploads them to Azure
 
@@ -419,7 +465,10 @@ def dataset2pmtiles(blob_url: str = None,
     @param pmtiles_file_name: optional, the output PMtiles file name. If supplied all vector layers
     will ve stored in one multilayer PMTile file
     @param timeout_event: instance of multiprocessing.Event used to interrupt the processing
-    @return: None
+    @param progress: optional, instance of UnitProgress the progress of both stages is reported to
+    @param diagnostics: optional, instance of JobDiagnostics the errors are recorded in
+    @param uploads: optional, instance of UploadQueue, see fgb2pmtiles
+    @return: dict, the uploaded blobs and their ETag, or the futures of their upload when uploads is supplied
 
     The conversion is implemented in two stages
 
@@ -428,31 +477,45 @@ def dataset2pmtiles(blob_url: str = None,
         a) if pmtiles_file_name arg is supplied a multilayer OMTile file is created
         b) else each layer is extracted to it;s own OMTiles file
 
-    Last, the PMTile files are uploaded to Azure
+    Last, the PMTile files are uploaded to Azure. The temporary folder of the conversion is removed once they have
+    been uploaded
 
     """
-    with tempfile.TemporaryDirectory() as temp_dir:
+    temp_dir = tempfile.mkdtemp()
+    outputs = dict()
+    try:
         fgb_layers = dataset2fgb(fgb_dir=temp_dir,
                                  src_ds=src_ds,
                                  layers=layers,
                                  timeout_event=timeout_event,
                                  conn_string=conn_string,
-                                 blob_url=blob_url)
+                                 blob_url=blob_url,
+                                 progress=progress.span(0, FGB_STAGE_SHARE) if progress else None,
+                                 diagnostics=diagnostics)
         if fgb_layers:
-            fgb2pmtiles(blob_url=blob_url, fgb_layers=fgb_layers, pmtiles_file_name=pmtiles_file_name,
-                        timeout_event=timeout_event, conn_string=conn_string, dst_directory=dst_directory)
+            outputs = fgb2pmtiles(blob_url=blob_url, fgb_layers=fgb_layers, pmtiles_file_name=pmtiles_file_name,
+                                  timeout_event=timeout_event, conn_string=conn_string, dst_directory=dst_directory,
+                                  progress=progress.span(FGB_STAGE_SHARE, 1) if progress else None,
+                                  diagnostics=diagnostics, uploads=uploads)
+        return outputs
+    finally:
+        uploads.remove_when_done(path=temp_dir, outputs=outputs)
+
 
 
-def gdal_callback(complete, message, timeout_event):
+def gdal_callback(complete, message, timeout_event, progress: UnitProgress = None):
     logger.debug(f'{complete * 100:.2f}%')
+    if progress:
+        progress.update(complete)
     if timeout_event and timeout_event.is_set():
         logger.info(f'GDAL received timeout signal')
         return 0
 
 class TimeoutProgress(io.StringIO):    
-    def __init__(self, timeout_event=None):
+    def __init__(self, timeout_event=None, progress: UnitProgress = None):
         super().__init__()
         self.timeout_event = timeout_event
+        self.progress = progress
         
     def write(self, s):
         if self.timeout_event and self.timeout_event.is_set():
@@ -462,12 +525,16 @@ class TimeoutProgress(io.StringIO):
         if '%' in s:
             percentage = int(re.findall(r"\d+%", s)[-1].replace("%", ""))
             logger.debug(f'{percentage:.2f}%')
+            if self.progress:
+                self.progress.update(percentage / 100)
         
         return super().write(s)
 
 
+@with_upload_queue
 def dataset2cog(blob_url=None, src_ds: gdal.Dataset = None, bands: typing.List[int] = None, timeout_event=None,
-                conn_string=None, dst_directory=None):
+                conn_string=None, dst_directory=None, progress: UnitProgress = None,
+                diagnostics: JobDiagnostics = None, uploads: UploadQueue = None):
     """
     Convert a GDAL dataset or a subdataset to a COG
     @param conn_string:
@@ -475,51 +542,59 @@ def dataset2cog(blob_url=None, src_ds: gdal.Dataset = None, bands: typing.List[i
     @param src_ds: an instance of gdal.Dataset
     @param bands: list of band numbers
     @param timeout_event: object used to signal a timeout
-    @return:
+    @param progress: optional, instance of UnitProgress the conversion progress is reported to
+    @param diagnostics: optional, instance of JobDiagnostics the errors are recorded in
+    @param uploads: optional, instance of UploadQueue the COG is uploaded by in the background. Without it the COG is
+    uploaded before returning
+    @return: dict, the uploaded blobs and their ETag, or the futures of their upload when uploads is supplied. A COG
+    written to dst_directory is kept, otherwise it is removed with its temporary folder once uploaded
     """
     src_path = os.path.abspath(src_ds.GetDescription())
+    outputs = dict()
+    temp_dir = tempfile.mkdtemp()
 
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-
-            band = bands[0] if bands and len(bands) == 1 else None
-            dst_folder = dst_directory if dst_directory else temp_dir
-            cog_path = get_local_cog_path(src_path=src_path, dst_folder=dst_folder, band=band)
-
-            output_profile = cog_profiles.get("ZSTD")
-            output_profile.update({
-                "BIGTIFF": "YES",
-            })
-
-            progress_callback = TimeoutProgress(timeout_event)
-
-            cog_translate(
-                src_path,
-                cog_path,
-                output_profile,
-                indexes=bands,
-                resampling="nearest",
-                overview_resampling="nearest",
-                in_memory=False,
-                forward_band_tags=True,
-                use_cog_driver=True,
-                tms=morecantile.tms.get("WebMercatorQuad"),
-                quiet=False,
-                progress_out=progress_callback,
-            )
-
-            is_valid, errors, warnings = cog_validate(src_path=cog_path, quiet=True)
-            if not is_valid:
-                sep = '\n'
-                raise Exception(f'Invalid COG {cog_path}. Errors are {f"{sep}".join(errors)}')
-            logger.info(f'Created COG {cog_path} from {src_path}')
-            # upload to azure
-            if conn_string is not None:
-                container_name, cog_blob_path = get_azure_blob_path(blob_url=blob_url, local_path=cog_path)
-                logger.info(f'Uploading {cog_path} to {cog_blob_path}')
-                upload_blob(src_path=cog_path, connection_string=conn_string, container_name=container_name,
-                            dst_blob_path=cog_blob_path, )
-                upload_ingesting_blob(cog_blob_path, container_name=container_name, connection_string=conn_string)
+        band = bands[0] if bands and len(bands) == 1 else None
+        dst_folder = dst_directory if dst_directory else temp_dir
+        cog_path = get_local_cog_path(src_path=src_path, dst_folder=dst_folder, band=band)
+
+        output_profile = cog_profiles.get("ZSTD")
+        output_profile.update({
+            "BIGTIFF": "YES",
+        })
+
+        progress_callback = TimeoutProgress(timeout_event, progress=progress)
+
+        cog_translate(
+            src_path,
+            cog_path,
+            output_profile,
+            indexes=bands,
+            resampling="nearest",
+            overview_resampling="nearest",
+            in_memory=False,
+            forward_band_tags=True,
+            use_cog_driver=True,
+            tms=morecantile.tms.get("WebMercatorQuad"),
+            quiet=False,
+            progress_out=progress_callback,
+        )
+
+        is_valid, errors, warnings = cog_validate(src_path=cog_path, quiet=True)
+        if not is_valid:
+            sep = '\n'
+            raise Exception(f'Invalid COG {cog_path}. Errors are {f"{sep}".join(errors)}')
+        logger.info(f'Created COG {cog_path} from {src_path}')
+        # upload to azure
+        if conn_string is not None:
+            container_name, cog_blob_path = get_azure_blob_path(blob_url=blob_url, local_path=cog_path)
+            # the upload overlaps the conversion of the next band
+            outputs = upload_outputs(uploads=uploads, files={cog_blob_path: cog_path}, blob_url=blob_url,
+                                     conn_string=conn_string, container_name=container_name,
+                                     ingesting_blob_path=cog_blob_path,
+                                     keep=[cog_path] if dst_directory else [],
+                                     unit=f'bands:{",".join(map(str, bands))}' if bands else 'bands',
+                                     diagnostics=diagnostics)
 
     except (RuntimeError, Exception) as re:
         if 'user terminated' in str(re).lower():
@@ -541,21 +616,142 @@ def dataset2cog(blob_url=None, src_ds: gdal.Dataset = None, bands: typing.List[i
                 msg+= f'bands: {bands}\n'
                 msg += f'gdal_error_message: {gdal_error_message}'
                 logger.error(msg)
-                # upload error blob
-                if conn_string is not None:
-                    blob_name = chop_blob_url(blob_url=blob_url)
-                    container_name, *rest, blob_name = blob_name.split("/")
-                    error_blob_path = f'{"/".join(rest)}/{blob_name}.error'
-                    logger.info(f'Uploading error message to {error_blob_path}')
-                    upload_content_to_blob(content=msg, connection_string=conn_string,
-                                           container_name=container_name,
-                                           dst_blob_path=error_blob_path)
+                report_error(message=msg, blob_url=blob_url, conn_string=conn_string,
+                             unit=f'bands:{",".join(map(str, bands))}' if bands else 'bands', diagnostics=diagnostics)
+        return dict()
+    finally:
+        uploads.remove_when_done(path=temp_dir, outputs=outputs)
+    return outputs
+
+
+def convert_unit(unit: str = None, checkpoint: JobCheckpoint = None, convert=None,
+                 diagnostics: JobDiagnostics = None, uploads: UploadQueue = None, **kwargs):
+    """
+    Convert one unit (vector layer, raster band, subdataset) of a job unless the checkpoint of the job records it
+    as finished. A unit whose outputs have been uploaded is recorded in the checkpoint, the diagnostics of the job
+    are written along with it.
+    @param unit: str, the id of the unit
+    @param checkpoint: optional, instance of JobCheckpoint
+    @param convert: the conversion function (dataset2pmtiles or dataset2cog), called with kwargs
+    @param diagnostics: optional, instance of JobDiagnostics the errors of the unit are recorded in
+    @param uploads: optional, instance of UploadQueue. The unit returns once converted, it is recorded in the
+    checkpoint by the upload queue once its outputs have been uploaded
+    @return: None
+    """
+    if checkpoint is not None and checkpoint.is_done(unit):
+        logger.info(f'Skipping {unit}, it was ingested before')
+        return
+
+    def uploaded(etags: dict = None, error: Exception = None):
+        if checkpoint is not None and etags and error is None:
+            checkpoint.mark_done(unit=unit, outputs=etags)
+
+    outputs = convert(diagnostics=diagnostics, uploads=uploads, **kwargs)
+    if uploads is not None:
+        uploads.when_done(outputs=outputs, callback=uploaded)
+    else:
+        uploaded(etags=outputs)
+    if diagnostics is not None:
+        diagnostics.checkpoint()
+
+
+def list_units(src_file_path: str = None, join_vector_tiles: bool = False) -> typing.List[str]:
+    """
+    List the units (vector layers, raster bands, subdatasets) process_geo_file would convert from src_file_path,
+    in the same order. Used to split a large file into sub-jobs, see process_unit.
+    @param src_file_path: input raster or vector file GDAL
+    @param join_vector_tiles: if True all vector layers make one unit
+    @return: list of unit ids
+    """
+    src_file_path = prepare_arch_path(src_path=src_file_path)
+    units = list()
+    try:
+        vdataset = gdal.OpenEx(src_file_path, gdal.OF_VECTOR)
+        nvector_layers = vdataset.GetLayerCount()
+        if nvector_layers > 0:
+            if join_vector_tiles:
+                units.append('layers')
+            else:
+                units += [f'layer:{vdataset.GetLayerByIndex(i).GetName()}' for i in range(nvector_layers)]
+        del vdataset
+    except RuntimeError:
+        pass
+    try:
+        rdataset = gdal.OpenEx(src_file_path, gdal.OF_RASTER)
+    except RuntimeError:
+        return units
+    for subdataset_index, (subdataset_path, _) in enumerate(rdataset.GetSubDatasets(), start=1):
+        subds = gdal.Open(subdataset_path.replace('\"', ''))
+        subds_bands = [b + 1 for b in range(subds.RasterCount)]
+        if len(subds_bands) >= 3 or subds.GetMetadataItem('PHOTOMETRIC') is not None:
+            units.append(f'subdataset:{subdataset_index}')
+        else:
+            units += [f'subdataset:{subdataset_index}:band:{band_no}' for band_no in subds_bands]
+        del subds
+    if rdataset.RasterCount:
+        bands = [b + 1 for b in range(rdataset.RasterCount)]
+        colorinterp = [rdataset.GetRasterBand(b).GetColorInterpretation() for b in bands]
+        if max(colorinterp) >= 3 or rdataset.GetMetadataItem('PHOTOMETRIC') is not None:
+            units.append('bands')
+        else:
+            units += [f'band:{band_no}' for band_no in bands]
+    del rdataset
+    return units
+
+
+def process_unit(src_file_path: str = None, blob_url: str = None, unit: str = None,
+                 conn_string: str = None, timeout_event: multiprocessing.Event = None, dst_directory=None,
+                 diagnostics: JobDiagnostics = None) -> dict:
+    """
+    Convert one unit listed by list_units from src_file_path and upload its outputs
+    @param src_file_path: input raster or vector file GDAL
+    @param blob_url: the url (azure) of the file that was downloaded to src_file_path
+    @param unit: str, the unit id
+    @param conn_string: the connection string to the Azure storage account
+    @param timeout_event: object to signalize interruption
+    @param diagnostics: optional, instance of JobDiagnostics the errors are recorded in
+    @return: dict, the uploaded blobs and their ETag. Empty if the conversion has failed
+    """
+    src_file_path = prepare_arch_path(src_path=src_file_path)
+    kind, _, arg = unit.partition(':')
+    if kind in ('layer', 'layers'):
+        vdataset = gdal.OpenEx(src_file_path, gdal.OF_VECTOR)
+        try:
+            if kind == 'layer':
+                return dataset2pmtiles(blob_url=blob_url, src_ds=vdataset, layers=[arg], timeout_event=timeout_event,
+                                       conn_string=conn_string, dst_directory=dst_directory,
+                                       diagnostics=diagnostics)
+            _, file_name = os.path.split(vdataset.GetDescription())
+            fname, *ext = file_name.split(os.extsep)
+            layer_names = [vdataset.GetLayerByIndex(i).GetName() for i in range(vdataset.GetLayerCount())]
+            return dataset2pmtiles(blob_url=blob_url, src_ds=vdataset, layers=layer_names, pmtiles_file_name=fname,
+                                   timeout_event=timeout_event, conn_string=conn_string, dst_directory=dst_directory,
+                                   diagnostics=diagnostics)
+        finally:
+            del vdataset
+    rdataset = gdal.OpenEx(src_file_path, gdal.OF_RASTER)
+    try:
+        if kind == 'subdataset':
+            subdataset_index, *band = arg.split(':band:')
+            subdataset_path, _ = rdataset.GetSubDatasets()[int(subdataset_index) - 1]
+            subds = gdal.Open(subdataset_path.replace('\"', ''))
+            try:
+                return dataset2cog(blob_url=blob_url, src_ds=subds, bands=[int(b) for b in band] or None,
+                                   timeout_event=timeout_event, conn_string=conn_string, dst_directory=dst_directory,
+                                   diagnostics=diagnostics)
+            finally:
+                del subds
+        return dataset2cog(blob_url=blob_url, src_ds=rdataset, bands=[int(arg)] if kind == 'band' else None,
+                           timeout_event=timeout_event, conn_string=conn_string, dst_directory=dst_directory,
+                           diagnostics=diagnostics)
+    finally:
+        del rdataset
 
 
 def process_geo_file(src_file_path: str = None, blob_url=None, join_vector_tiles: bool = False,
                      conn_string: str = None, timeout_event: multiprocessing.Event = None,
-                     dst_directory=None, websocket_client = None
-                     ):
+                     dst_directory=None, websocket_client = None, checkpoint: JobCheckpoint = None,
+                     diagnostics: JobDiagnostics = None):
     """
     Converts the vector layers from the input src_file_path to PMtiles and the raster bands to
     COGs.  In case errors are encountered an error blob containing the error message is uploaded.
@@ -566,7 +762,13 @@ def process_geo_file(src_file_path: str = None, blob_url=None, join_vector_tiles
     @param join_vector_tiles: False, if True and the src_file_path  is a vector dataset with multiple  layers
     @param conn_string: optional, if provided the dst_file_path will be uploaded to the azure
     @param timeout_event: object to signalize interruption
+    @param checkpoint: optional, instance of JobCheckpoint. The units it records as finished are skipped
+    @param diagnostics: optional, instance of JobDiagnostics the errors are recorded in. Without it the errors are
+    uploaded to the .error blob right away
     @return: None
+
+    The outputs of every unit are uploaded in the background (see UploadQueue) while the next unit is converted, the
+    job is reported as processed and the function returns once they have all been uploaded
     """
     assert src_file_path not in ['', None], f'Invalid geospatial data file path: {src_file_path}'
     src_file_path = prepare_arch_path(src_path=src_file_path)
@@ -579,6 +781,41 @@ def process_geo_file(src_file_path: str = None, blob_url=None, join_vector_tiles
         container_name, user, *rest, blob_name = blob_path.split("/")
         container_rel_blob_path = os.path.join(user, *rest, blob_name)
 
+    # the outputs of a unit are uploaded while the next one is converted
+    uploads = UploadQueue()
+
+    def finish(stage: str = 'processed', progress: int = 100):
+        """
+        Publish the final stage of the job once the outputs of its units have been uploaded and its errors written
+        """
+        if stage == 'Cancelled':
+            # the outputs still queued are not uploaded, only the uploads in flight are waited for
+            uploads.cancel()
+        uploads.wait()
+        if diagnostics is not None:
+            diagnostics.flush()
+        payload = dict(user=user, url=blob_url, stage=stage, progress=progress)
+        publish_progress(payload=payload, websocket_client=websocket_client, conn_string=conn_string)
+
+    def cancel():
+        report_error(message=f'Datafile {blob_url} has timed out or was cancelled', blob_url=blob_url,
+                     conn_string=conn_string, diagnostics=diagnostics)
+        finish(stage='Cancelled')
+
+    def converted(index: int = None):
+        """
+        Publish the progress of the job once the unit(s) owning the entries up to index of progressl are converted,
+        the job is processed once the outputs of all its units have been uploaded
+        """
+        if is_cli or not websocket_client:
+            return
+        progrs = progressl[index]
+        if progrs >= 100:
+            finish(progress=progrs)
+            return
+        payload = dict(user=user, url=blob_url, stage='processing', progress=progrs)
+        publish_progress(payload=payload, websocket_client=websocket_client, conn_string=conn_string)
+
     try:
         progressl, gdal_error_message = get_progress(offset_perc=30, src_path=src_file_path)
         if not progressl and websocket_client:
@@ -592,27 +829,24 @@ def process_geo_file(src_file_path: str = None, blob_url=None, join_vector_tiles
             msg = f'gdal_error_message: {gdal_error_message}'
 
             logger.error(gdal_error_message)
-            # upload error blob
-            if conn_string is not None:
-                error_blob_path = f'{"/".join([user]+rest)}/{blob_name}.error'
-                upload_content_to_blob(content=msg, connection_string=conn_string,
-                                       container_name=container_name,
-                                       dst_blob_path=error_blob_path)
-
-            payload = dict(user=user, url=blob_url, stage='processed', progress=100)
-
-            websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME,
-                                           content=json.dumps(payload),
-                                           data_type=WebPubSubDataType.JSON)
-
-            set_blob_metadata(connection_string=conn_string, container_name=container_name,
-                              dst_blob_path=container_rel_blob_path,
-                              metadata={'stage': payload['stage'], 'progress': payload['progress']})
+            report_error(message=msg, blob_url=blob_url, conn_string=conn_string, diagnostics=diagnostics)
+            finish()
             return
 
 
 
         progress_index = 0
+
+        def unit_progress(first: int = None, last: int = None):
+            """
+            The progress reporter of the unit(s) owning the entries first to last of progressl
+            """
+            if is_cli or not websocket_client:
+                return None
+            return UnitProgress(payload=dict(user=user, url=blob_url), websocket_client=websocket_client,
+                                conn_string=conn_string, start=progressl[first - 1] if first else 30,
+                                end=progressl[last])
+
         # handle vectors first
         logger.debug(f'Opening {src_file_path}')
         try:
@@ -635,43 +869,25 @@ def process_geo_file(src_file_path: str = None, blob_url=None, join_vector_tiles
 
                     for li, layer_name in enumerate(layer_names):
                         logger.info(f'Ingesting vector layer "{layer_name}".')
-                        dataset2pmtiles(blob_url=blob_url, src_ds=vdataset, layers=[layer_name],
-                                        timeout_event=timeout_event, conn_string=conn_string,
-                                        dst_directory=dst_directory)
-                        if not is_cli and websocket_client:
-                            progrs = progressl[progress_index]
-                            stage = 'processing' if progrs < 100 else 'processed'
-                            payload = dict(user=user, url=blob_url, stage=stage, progress=progrs)
-
-                            websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME,
-                                                               content=json.dumps(payload),
-                                                               data_type=WebPubSubDataType.JSON)
-
-                            set_blob_metadata(connection_string=conn_string, container_name=container_name,
-                                              dst_blob_path=container_rel_blob_path,
-                                              metadata={'stage': payload['stage'], 'progress': payload['progress']})
-
-                            progress_index += 1
+                        convert_unit(unit=f'layer:{layer_name}', checkpoint=checkpoint, convert=dataset2pmtiles,
+                                     diagnostics=diagnostics, uploads=uploads,
+                                     blob_url=blob_url, src_ds=vdataset, layers=[layer_name],
+                                     timeout_event=timeout_event, conn_string=conn_string,
+                                     dst_directory=dst_directory,
+                                     progress=unit_progress(progress_index, progress_index))
+                        converted(progress_index)
+                        progress_index += 1
                 else:
                     logger.info(f'Ingesting all vector layers into one multilayer PMtiles file')
                     fname, *ext = file_name.split(os.extsep)
-                    dataset2pmtiles(blob_url=blob_url, src_ds=vdataset, layers=layer_names,
-                                    pmtiles_file_name=fname, timeout_event=timeout_event, conn_string=conn_string,
-                                    dst_directory=dst_directory)
-                    if not is_cli and websocket_client:
-                        progress_index += nvector_layers-1
-                        progrs = progressl[progress_index]
-                        stage = 'processing' if progrs < 100 else 'processed'
-                        payload = dict(user=user, url=blob_url, stage=stage, progress=progrs)
-                        #with websocket_client:
-                        websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME,
-                                                           content=json.dumps(payload),
-                                                           data_type=WebPubSubDataType.JSON)
-
-                        set_blob_metadata(connection_string=conn_string, container_name=container_name,
-                                          dst_blob_path=container_rel_blob_path,
-                                          metadata={'stage': payload['stage'], 'progress': payload['progress']})
-                        progress_index += 1
+                    convert_unit(unit='layers', checkpoint=checkpoint, convert=dataset2pmtiles,
+                                 diagnostics=diagnostics, uploads=uploads,
+                                 blob_url=blob_url, src_ds=vdataset, layers=layer_names,
+                                 pmtiles_file_name=fname, timeout_event=timeout_event, conn_string=conn_string,
+                                 dst_directory=dst_directory,
+                                 progress=unit_progress(progress_index, progress_index + nvector_layers - 1))
+                    progress_index += nvector_layers
+                    converted(progress_index - 1)
             else:
                 logger.info(f'{src_file_path} contains {nvector_layers} vector layers')
             del vdataset
@@ -696,22 +912,7 @@ def process_geo_file(src_file_path: str = None, blob_url=None, join_vector_tiles
         # Driver.getMetadataItem(gdal.DCAP_SUBTADASETS) is not reliable so it is better to try
         subdatasets = rdataset.GetSubDatasets()
         if timeout_event.is_set():
-            if conn_string is not None:
-                error_blob_path = f'{"/".join([user]+rest)}/{blob_name}.error'
-                upload_content_to_blob(content=f'Datafile {blob_url} has timed out or was cancelled',
-                                       connection_string=conn_string,
-                                       container_name=container_name,
-                                       dst_blob_path=error_blob_path)
-
-            payload = dict(user=user, url=blob_url, stage='Cancelled', progress=100)
-
-            websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME,
-                                           content=json.dumps(payload),
-                                           data_type=WebPubSubDataType.JSON)
-
-            set_blob_metadata(connection_string=conn_string, container_name=container_name,
-                              dst_blob_path=container_rel_blob_path,
-                              metadata={'stage': payload['stage'], 'progress': payload['progress']})
+            cancel()
             return
 
         if subdatasets:
@@ -725,51 +926,34 @@ def process_geo_file(src_file_path: str = None, blob_url=None, join_vector_tiles
                     subds_colorinterp = [subds.GetRasterBand(b).GetColorInterpretation() for b in subds_bands]
                 subds_photometric = subds.GetMetadataItem('PHOTOMETRIC')
                 subds_no_colorinterp_bands = len(subds_colorinterp)
+                subds_progress = unit_progress(progress_index, progress_index)
 
                 # RGB COGS,more work needs to be done here too look into RGB subdatasets
                 if subds_no_colorinterp_bands >= 3 or subds_photometric is not None:
                     logger.info(f'Ingesting multiband(RGB) subdataset {subdataset_path}')
-                    dataset2cog(blob_url=blob_url, src_ds=subds, timeout_event=timeout_event,
-                                conn_string=conn_string, dst_directory=dst_directory)
+                    convert_unit(unit=f'subdataset:{subdataset_index}', checkpoint=checkpoint, convert=dataset2cog,
+                                 diagnostics=diagnostics, uploads=uploads,
+                                 blob_url=blob_url, src_ds=subds, timeout_event=timeout_event,
+                                 conn_string=conn_string, dst_directory=dst_directory, progress=subds_progress)
                 else:
 
-                    for band_no in subds_bands:
+                    for band_index, band_no in enumerate(subds_bands):
                         logger.info(f'Ingesting band {band_no} from {subdataset_path}')
-                        dataset2cog(blob_url=blob_url, src_ds=subds, bands=[band_no], timeout_event=timeout_event,
-                                    conn_string=conn_string, dst_directory=dst_directory)
+                        convert_unit(unit=f'subdataset:{subdataset_index}:band:{band_no}', checkpoint=checkpoint,
+                                     diagnostics=diagnostics, uploads=uploads,
+                                     convert=dataset2cog, blob_url=blob_url, src_ds=subds, bands=[band_no],
+                                     timeout_event=timeout_event, conn_string=conn_string,
+                                     dst_directory=dst_directory,
+                                     progress=subds_progress.span(band_index / len(subds_bands),
+                                                                  (band_index + 1) / len(subds_bands))
+                                     if subds_progress else None)
 
                 del subds
-                if not is_cli and websocket_client:
-                    progrs = progressl[progress_index]
-                    stage = 'processing' if progrs < 100 else 'processed'
-                    payload = dict(user=user, url=blob_url, stage=stage, progress=progrs)
-
-                    #with websocket_client:
-                    websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME,
-                                                       content=json.dumps(payload),
-                                                       data_type=WebPubSubDataType.JSON)
-                    set_blob_metadata(connection_string=conn_string, container_name=container_name,
-                                      dst_blob_path=container_rel_blob_path,
-                                      metadata={'stage': payload['stage'], 'progress': payload['progress']})
-
-                    progress_index += 1
+                converted(progress_index)
+                progress_index += 1
 
         if timeout_event.is_set():
-            if conn_string is not None:
-                error_blob_path = f'{"/".join([user]+rest)}/{blob_name}.error'
-                upload_content_to_blob(content=f'Datafile {blob_url} has timed out or was cancelled',
-                                       connection_string=conn_string,
-                                       container_name=container_name,
-                                       dst_blob_path=error_blob_path)
-
-            payload = dict(user=user, url=blob_url, stage='Cancelled', progress=100)
-
-            websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME,
-                                           content=json.dumps(payload),
-                                           data_type=WebPubSubDataType.JSON)
-            set_blob_metadata(connection_string=conn_string, container_name=container_name,
-                              dst_blob_path=container_rel_blob_path,
-                              metadata={'stage': payload['stage'], 'progress': payload['progress']})
+            cancel()
             return
 
         if nraster_bands:  # raster data is located at root
@@ -782,20 +966,13 @@ def process_geo_file(src_file_path: str = None, blob_url=None, join_vector_tiles
             photometric = rdataset.GetMetadataItem('PHOTOMETRIC')
             if max(colorinterp) >= 3 or photometric is not None:
                 logger.info(f'Ingesting bands {bands} as a multiband COG')
-                dataset2cog(blob_url=blob_url, src_ds=rdataset, timeout_event=timeout_event,
-                            conn_string=conn_string, dst_directory=dst_directory)
-                if not is_cli and websocket_client:
-                    progress_index += no_colorinterp_bands-1
-                    progrs = progressl[progress_index]
-                    stage = 'processing' if progrs < 100 else 'processed'
-                    payload = dict(user=user, url=blob_url, stage=stage, progress=progrs)
-                    websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME,
-                                                       content=json.dumps(payload),
-                                                       data_type=WebPubSubDataType.JSON)
-                    set_blob_metadata(connection_string=conn_string, container_name=container_name,
-                                      dst_blob_path=container_rel_blob_path,
-                                      metadata={'stage': payload['stage'], 'progress': payload['progress']})
-                    progress_index+=1
+                convert_unit(unit='bands', checkpoint=checkpoint, convert=dataset2cog,
+                             diagnostics=diagnostics, uploads=uploads,
+                             blob_url=blob_url, src_ds=rdataset, timeout_event=timeout_event,
+                             conn_string=conn_string, dst_directory=dst_directory,
+                             progress=unit_progress(progress_index, progress_index + no_colorinterp_bands - 1))
+                progress_index += no_colorinterp_bands
+                converted(progress_index - 1)
 
             else:
                 logger.info(f'Ingesting {nraster_bands} raster bands')
@@ -803,19 +980,12 @@ def process_geo_file(src_file_path: str = None, blob_url=None, join_vector_tiles
                 for band_index, band_no in enumerate(bands):
 
                     logger.info(f'Ingesting band {band_no} from {src_file_path}')
-                    dataset2cog(blob_url=blob_url, src_ds=rdataset, bands=[band_no],
-                                timeout_event=timeout_event, conn_string=conn_string, dst_directory=dst_directory)
-                    if not is_cli and websocket_client:
-                        progrs = progressl[progress_index]
-                        stage = 'processing' if progrs < 100 else 'processed'
-                        payload = dict(user=user, url=blob_url, stage=stage, progress=progrs)
-
-                        websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME,
-                                                           content=json.dumps(payload),
-                                                           data_type=WebPubSubDataType.JSON)
-                        set_blob_metadata(connection_string=conn_string, container_name=container_name,
-                                          dst_blob_path=container_rel_blob_path,
-                                          metadata={'stage': payload['stage'], 'progress': payload['progress']})
+                    convert_unit(unit=f'band:{band_no}', checkpoint=checkpoint, convert=dataset2cog,
+                                 diagnostics=diagnostics, uploads=uploads,
+                                 blob_url=blob_url, src_ds=rdataset, bands=[band_no],
+                                 timeout_event=timeout_event, conn_string=conn_string, dst_directory=dst_directory,
+                                 progress=unit_progress(progress_index, progress_index))
+                    converted(progress_index)
                     progress_index += 1
 
         del rdataset
@@ -824,3 +994,5 @@ def process_geo_file(src_file_path: str = None, blob_url=None, join_vector_tiles
         if 'vdataset' in locals(): del vdataset
         if 'rdataset' in locals(): del rdataset
         raise
+    finally:
+        uploads.close()
@@ -0,0 +1,350 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import typing
+
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceModifiedError
+from azure.messaging.webpubsubclient.models import WebPubSubDataType
+
+from ingest.azlog import current_blob_url
+from ingest.clients import blob_service_client
+from ingest.config import (
+    AZURE_WEBPUBSUB_GROUP_NAME,
+    INGEST_PROGRESS_METADATA_INTERVAL,
+    INGEST_PROGRESS_MAX_BLOBS,
+    INGEST_PROGRESS_TAGS,
+    INGEST_PROGRESS_UPDATE_INTERVAL,
+    INGEST_PROGRESS_UPDATE_STEP
+)
+from ingest.utils import chop_blob_url
+
+logger = logging.getLogger(__name__)
+
+# the characters allowed in the value of a blob index tag
+TAG_VALUE_INVALID = re.compile(r'[^a-zA-Z0-9 +\-./:=_]')
+
+
+def job_id(blob_url: str = None) -> str:
+    """
+    The id of the job ingesting blob_url, stable across the deliveries of its message and the consumers
+    """
+    return hashlib.md5(chop_blob_url(blob_url).encode()).hexdigest()
+
+
+def progress_tags(payload: dict = None) -> dict:
+    """
+    The index tags of a raw blob for a progress payload. The progress is zero padded so the tag queries can compare it,
+    e.g. "ingest_progress < '050'"
+    """
+    return dict(ingest_stage=TAG_VALUE_INVALID.sub('_', str(payload['stage']))[:256],
+                ingest_progress=f'{int(payload["progress"]):03d}',
+                ingest_user=TAG_VALUE_INVALID.sub('_', str(payload.get('user', '')))[:256],
+                ingest_job=job_id(payload['url']))
+
+
+def find_jobs(conn_string: str = None, stage: str = None, user: str = None, container_name: str = None) -> list:
+    """
+    Find the raw blobs by the ingest tags, e.g. all the blobs being processed, without listing the container
+    @param stage: optional, the stage of the jobs (processing, processed, Cancelled, ...)
+    @param user: optional, the user the blobs belong to
+    @param container_name: optional, only look into this container
+    @return: list of azure.storage.blob.FilteredBlob, their tags hold the latest stage and progress
+    """
+    conditions = [f"\"ingest_stage\" = '{TAG_VALUE_INVALID.sub('_', stage)}'" if stage else "\"ingest_stage\" >= ''"]
+    if user:
+        conditions.append(f"\"ingest_user\" = '{TAG_VALUE_INVALID.sub('_', user)}'")
+    if container_name:
+        conditions.append(f"@container = '{container_name}'")
+    return list(blob_service_client(conn_string).find_blobs_by_tags(filter_expression=' AND '.join(conditions)))
+
+
+class BlobProgress:
+    """
+    The latest progress of a blob and what has been published of it
+    """
+
+    def __init__(self, blob_url: str = None):
+        self.blob_url = blob_url
+        self.payload = None
+        self.websocket_client = None
+        self.conn_string = None
+        self.send_pending = False
+        self.write_pending = False
+        self.in_flight = False
+        self.written_at = 0
+        # the metadata and the ETag of the raw blob as of the last metadata write
+        self.metadata = None
+        self.etag = None
+        # the index tags of the raw blob as of the last tag write
+        self.tags = None
+
+    @property
+    def final(self) -> bool:
+        return self.payload['progress'] >= 100
+
+    @property
+    def pending(self) -> bool:
+        return self.send_pending or self.write_pending or self.in_flight
+
+
+class ProgressPublisher:
+    """
+    Publishes the progress of the jobs (websocket message and stage/progress metadata of the raw blob) from a
+    background thread so the conversion never waits for the network.
+
+    Only the latest progress of a blob is kept, the updates superseded before the thread got to them are dropped.
+    The websocket messages are sent as soon as possible while the metadata of a blob is written at most every
+    metadata_interval seconds, except for the final stage. The metadata is updated with an ETag conditional write
+    based on the metadata read (once) or written last, so a write costs one request instead of a read and a write.
+    At most max_blobs blobs are tracked, the progress of further blobs is dropped until the final stage.
+    If tags is True the stage, progress, user and job id are written to the index tags of the raw blob together with
+    the metadata (see progress_tags and find_jobs). Writing the tags does not change the ETag of the blob.
+    """
+
+    def __init__(self, metadata_interval: float = INGEST_PROGRESS_METADATA_INTERVAL,
+                 max_blobs: int = INGEST_PROGRESS_MAX_BLOBS, tags: bool = INGEST_PROGRESS_TAGS):
+        self.metadata_interval = metadata_interval
+        self.max_blobs = max_blobs
+        self.tags = tags
+        # the storage accounts that do not support index tags
+        self.untagged = set()
+        self.blobs = dict()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='progress-publisher', daemon=True)
+        self.thread.start()
+
+    def publish(self, payload: dict = None, websocket_client=None, conn_string: str = None):
+        """
+        Queue the progress of a blob, returns right away
+        @param payload: dict(user, url, stage, progress)
+        @param websocket_client: the webpubsub client (or stand-in) the message is sent with
+        @param conn_string: the connection string of the storage account the raw blob is stored in
+        """
+        blob_url = payload['url']
+        with self.condition:
+            state = self.blobs.get(blob_url)
+            if state is None:
+                if len(self.blobs) >= self.max_blobs and payload['progress'] < 100:
+                    logger.debug(f'Dropping the progress of {blob_url}, {len(self.blobs)} blobs are being published')
+                    return
+                state = self.blobs[blob_url] = BlobProgress(blob_url=blob_url)
+            state.payload = dict(payload)
+            state.websocket_client = websocket_client
+            state.conn_string = conn_string
+            state.send_pending = websocket_client is not None
+            state.write_pending = conn_string is not None
+            self.condition.notify_all()
+
+    def flush(self, blob_url: str = None, timeout: float = 30) -> bool:
+        """
+        Wait until the progress of blob_url (of all the blobs if None) has been published. A blob is forgotten once
+        its job has flushed it
+        @return: False if the timeout has expired
+        """
+        with self.condition:
+            self.condition.notify_all()
+            flushed = self.condition.wait_for(
+                lambda: not any(state.pending for url, state in self.blobs.items() if blob_url in (None, url)),
+                timeout=timeout
+            )
+            if flushed and blob_url is not None:
+                self.blobs.pop(blob_url, None)
+            return flushed
+
+    def due(self, state: BlobProgress = None) -> float:
+        """
+        The time the metadata of a blob can be written next
+        """
+        return 0 if state.final else state.written_at + self.metadata_interval
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    ready = [state for state in self.blobs.values()
+                             if state.send_pending or (state.write_pending and self.due(state) <= now)]
+                    if ready:
+                        break
+                    deadlines = [self.due(state) for state in self.blobs.values() if state.write_pending]
+                    self.condition.wait(timeout=min(deadlines) - now if deadlines else None)
+                work = list()
+                for state in ready:
+                    write = state.write_pending and self.due(state) <= now
+                    work.append((state, dict(state.payload), state.send_pending, write))
+                    state.in_flight = True
+                    state.send_pending = False
+                    if write:
+                        state.write_pending = False
+                        state.written_at = now
+            for state, payload, send, write in work:
+                # the records of the publisher are routed to the log blob of the job it is publishing for
+                token = current_blob_url.set(state.blob_url)
+                try:
+                    if send:
+                        self.send(state=state, payload=payload)
+                    if write:
+                        self.write(state=state, payload=payload)
+                finally:
+                    current_blob_url.reset(token)
+            with self.condition:
+                for state, payload, _, _ in work:
+                    state.in_flight = False
+                    if not state.pending and state.final and self.blobs.get(state.blob_url) is state:
+                        del self.blobs[state.blob_url]
+                self.condition.notify_all()
+
+    def send(self, state: BlobProgress = None, payload: dict = None):
+        try:
+            state.websocket_client.send_to_group(AZURE_WEBPUBSUB_GROUP_NAME, content=json.dumps(payload),
+                                                 data_type=WebPubSubDataType.JSON)
+        except Exception as e:
+            logger.error(f'Failed to send the progress of {state.blob_url}: {e}')
+
+    def write(self, state: BlobProgress = None, payload: dict = None, attempts: int = 3):
+        container_name, *rest = chop_blob_url(state.blob_url).split("/")
+        blob_client = blob_service_client(state.conn_string).get_blob_client(container=container_name,
+                                                                             blob="/".join(rest))
+        for attempt in range(1, attempts + 1):
+            try:
+                if state.metadata is None:
+                    properties = blob_client.get_blob_properties()
+                    state.metadata, state.etag = properties.metadata, properties.etag
+                metadata = dict(state.metadata, stage=str(payload['stage']), progress=str(payload['progress']))
+                response = blob_client.set_blob_metadata(metadata=metadata, etag=state.etag,
+                                                         match_condition=MatchConditions.IfNotModified)
+                state.metadata, state.etag = metadata, response['etag']
+                logger.debug(f'Updated the metadata of {state.blob_url} to {payload["stage"]} {payload["progress"]}')
+                if self.tags and state.conn_string not in self.untagged:
+                    self.write_tags(state=state, payload=payload, blob_client=blob_client)
+                return
+            except ResourceModifiedError:
+                # the blob was changed by somebody else, its metadata is read again
+                state.metadata = None
+            except Exception as e:
+                state.metadata = None
+                logger.debug(f'Failed to update the metadata of {state.blob_url} in attempt no {attempt}: {e}')
+        logger.error(f'Failed to update the metadata of {state.blob_url} after {attempts} attempts')
+
+    def write_tags(self, state: BlobProgress = None, payload: dict = None, blob_client=None, attempts: int = 3):
+        """
+        Merge the ingest tags into the index tags of the raw blob. Set Blob Tags replaces all the tags, so it is only
+        applied if the tags are still the ones read (or written) last, the tags are read again if somebody else has
+        changed them in between
+        """
+        for attempt in range(1, attempts + 1):
+            try:
+                if state.tags is None:
+                    state.tags = blob_client.get_blob_tags()
+                tags = dict(state.tags, **progress_tags(payload))
+                blob_client.set_blob_tags(tags=tags, if_tags_match_condition=tags_condition(state.tags))
+                state.tags = tags
+                return
+            except ResourceModifiedError:
+                state.tags = None
+                logger.debug(f'The tags of {state.blob_url} were changed in attempt no {attempt}, reading them again')
+            except HttpResponseError as e:
+                state.tags = None
+                if e.error_code in ('FeatureNotSupportedForAccount', 'BlobOperationNotSupportedForAccount'):
+                    logger.warning(f'The storage account of {state.blob_url} does not support blob index tags, '
+                                   f'the progress is only kept in the metadata')
+                    self.untagged.add(state.conn_string)
+                elif e.error_code == 'AuthorizationPermissionMismatch':
+                    logger.warning(f'The credentials of {state.blob_url} are not allowed to read or write blob index '
+                                   f'tags, the progress is only kept in the metadata')
+                    self.untagged.add(state.conn_string)
+                else:
+                    logger.error(f'Failed to update the tags of {state.blob_url}: {e}')
+                return
+            except Exception as e:
+                state.tags = None
+                logger.error(f'Failed to update the tags of {state.blob_url}: {e}')
+                return
+        logger.error(f'Failed to update the tags of {state.blob_url} after {attempts} attempts')
+
+
+def tags_condition(tags: dict = None) -> typing.Optional[str]:
+    """
+    The tag condition (x-ms-if-tags) matching the blobs having exactly the values of tags, None for no tags. The keys
+    and values of blob index tags can not contain quotes
+    """
+    return ' AND '.join(f'"{key}" = \'{value}\'' for key, value in sorted(tags.items())) or None
+
+
+class UnitProgress:
+    """
+    Turns the progress of the conversion of a unit (a layer, band or subdataset), a fraction between 0 and 1 reported
+    by GDAL, rio-cogeo or tippecanoe, into the progress of the job. The unit owns the share [start, end) of the
+    progress of the job (see ingest.utils.compute_progress), end itself is published by the caller once the unit has
+    been uploaded. An update is published at most every interval seconds and only once the progress has advanced by
+    step percent, so a long unit moves smoothly without flooding pubsub. The updates arrive from the conversion
+    threads, a unit is converted by one thread at a time.
+    """
+
+    def __init__(self, payload: dict = None, websocket_client=None, conn_string: str = None, start: int = 30,
+                 end: int = 100, interval: float = INGEST_PROGRESS_UPDATE_INTERVAL,
+                 step: int = INGEST_PROGRESS_UPDATE_STEP, parent=None):
+        self.payload = payload
+        self.websocket_client = websocket_client
+        self.conn_string = conn_string
+        self.start = start
+        self.end = end
+        self.interval = interval
+        self.step = step
+        self.parent = parent
+        self.published = start
+        self.published_at = 0
+
+    def span(self, low: float = 0, high: float = 1):
+        """
+        The share [low, high) of this unit, e.g. one of the stages of the conversion or one layer of several
+        @return: instance of UnitProgress reporting into this one
+        """
+        return UnitProgress(start=low, end=high, parent=self)
+
+    def update(self, fraction: float = None):
+        """
+        @param fraction: float, how much of the unit has been converted, between 0 and 1
+        """
+        fraction = min(max(fraction, 0), 1)
+        if self.parent is not None:
+            self.parent.update(self.start + (self.end - self.start) * fraction)
+            return
+        progress = min(self.start + int((self.end - self.start) * fraction), self.end - 1)
+        now = time.monotonic()
+        if progress - self.published < self.step or now - self.published_at < self.interval:
+            return
+        self.published, self.published_at = progress, now
+        publish_progress(payload=dict(self.payload, stage='processing', progress=progress),
+                         websocket_client=self.websocket_client, conn_string=self.conn_string)
+
+
+_publisher = None
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher() -> ProgressPublisher:
+    """
+    The publisher of this process (the pool workers have their own)
+    """
+    global _publisher, _publisher_pid
+    with _publisher_lock:
+        if _publisher is None or _publisher_pid != os.getpid():
+            _publisher, _publisher_pid = ProgressPublisher(), os.getpid()
+        return _publisher
+
+
+def publish_progress(payload: dict = None, websocket_client=None, conn_string: str = None):
+    get_publisher().publish(payload=payload, websocket_client=websocket_client, conn_string=conn_string)
+
+
+def flush_progress(blob_url: str = None, timeout: float = 30) -> bool:
+    if _publisher is None or _publisher_pid != os.getpid():
+        return True
+    return _publisher.flush(blob_url=blob_url, timeout=timeout)
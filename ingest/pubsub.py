@@ -0,0 +1,141 @@
+import contextlib
+import json
+import logging
+import multiprocessing
+import threading
+import time
+
+from azure.messaging.webpubsubclient import WebPubSubClient, WebPubSubClientCredential
+from azure.messaging.webpubsubclient.models import CallbackType, WebPubSubDataType
+
+from ingest.config import get_azurewebsubpub_client_token, AZURE_WEBPUBSUB_GROUP_NAME
+from ingest.utils import cancel_processing
+
+logger = logging.getLogger(__name__)
+
+
+class PubSubHub:
+    """
+    The single webpubsub connection of the pod shared by all the ingest jobs.
+    The client access token is cached and a new one is requested refresh_margin seconds before it expires, the client
+    asks for it whenever it (re)connects.
+    One listener receives the group messages and routes the cancel requests to the cancel event of the job ingesting
+    the blob through a dict lookup. The hub also stands in for the websocket client of the jobs (send_to_group) and
+    adds the ETA of the job to the progress messages.
+    The jobs send from several threads. A lost connection is re-opened by the first sender noticing it, the
+    connection generation it saw tells the other senders the connection has already been replaced.
+    """
+
+    def __init__(self, group_name: str = AZURE_WEBPUBSUB_GROUP_NAME, token_minutes: int = 60,
+                 refresh_margin: int = 300):
+        self.group_name = group_name
+        self.token_minutes = token_minutes
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.token_expires = 0
+        self.client = None
+        self.jobs = dict()
+        # blob url -> (start time, predicted runtime in seconds)
+        self.expectations = dict()
+        self.lock = threading.Lock()
+        self.connect_lock = threading.Lock()
+        # incremented whenever the connection is re-opened
+        self.generation = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def client_access_url(self) -> str:
+        with self.lock:
+            if self.token is None or time.time() >= self.token_expires - self.refresh_margin:
+                logger.debug('Requesting a new webpubsub client access token')
+                self.token = get_azurewebsubpub_client_token(group_name=self.group_name,
+                                                             minutes_to_expire=self.token_minutes)
+                self.token_expires = time.time() + self.token_minutes * 60
+            return self.token['url']
+
+    def open(self):
+        self.client = WebPubSubClient(WebPubSubClientCredential(client_access_url_provider=self.client_access_url))
+        self.client.subscribe(CallbackType.GROUP_MESSAGE, listener=self.on_group_message)
+        self.client.open()
+        self.client.join_group(self.group_name)
+        logger.info(f'Joined webpubsub group {self.group_name}')
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+    def reconnect(self, generation: int = None):
+        """
+        Re-open the connection unless it has been re-opened since the sender saw generation
+        """
+        with self.connect_lock:
+            if self.generation != generation:
+                return
+            logger.info('The webpubsub connection was lost, reconnecting')
+            self.close()
+            self.open()
+            self.generation += 1
+
+    def on_group_message(self, event=None):
+        message_data = event.data
+        if not isinstance(message_data, dict) or 'url' not in message_data:
+            return
+        blob_url = message_data['url']
+        with self.lock:
+            cancel_events = list(self.jobs.get(blob_url, ()))
+        for cancel_event in cancel_events:
+            cancel_processing(event=event, blob_url=blob_url, cancel_event=cancel_event)
+
+    @contextlib.contextmanager
+    def track(self, blob_url: str = None, cancel_event: multiprocessing.Event = None, expected_seconds: float = None):
+        """
+        Route the cancel requests for blob_url to cancel_event while the block runs
+        @param expected_seconds: optional, the predicted runtime of the job used to compute its ETA
+        @return: the hub, to be used as the websocket client of the job
+        """
+        with self.lock:
+            self.jobs.setdefault(blob_url, set()).add(cancel_event)
+            if expected_seconds is not None:
+                self.expectations[blob_url] = (time.monotonic(), expected_seconds)
+        try:
+            yield self
+        finally:
+            with self.lock:
+                cancel_events = self.jobs.get(blob_url, set())
+                cancel_events.discard(cancel_event)
+                if not cancel_events:
+                    self.jobs.pop(blob_url, None)
+                    self.expectations.pop(blob_url, None)
+
+    def eta(self, blob_url: str = None, progress: float = None) -> float:
+        """
+        The seconds left until the job ingesting blob_url is expected to finish. Once the job runs longer than
+        predicted the remaining time is extrapolated from its progress
+        """
+        with self.lock:
+            if blob_url not in self.expectations:
+                return None
+            started, expected = self.expectations[blob_url]
+        elapsed = time.monotonic() - started
+        if elapsed < expected:
+            return expected - elapsed
+        return elapsed * (100 - progress) / max(progress, 1)
+
+    def send_to_group(self, group_name: str = None, content=None, data_type=None, **kwargs):
+        if data_type == WebPubSubDataType.JSON:
+            payload = json.loads(content)
+            if isinstance(payload, dict) and 'progress' in payload and payload['progress'] < 100:
+                eta = self.eta(blob_url=payload.get('url'), progress=payload['progress'])
+                if eta is not None:
+                    payload['eta'] = round(eta)
+                    content = json.dumps(payload)
+        generation, client = self.generation, self.client
+        if not client.is_connected():
+            self.reconnect(generation=generation)
+            client = self.client
+        client.send_to_group(group_name, content=content, data_type=data_type, **kwargs)
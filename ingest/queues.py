@@ -0,0 +1,334 @@
+import abc
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import sqlite3
+import sys
+import time
+import urllib.parse
+import uuid
+
+from azure.servicebus import ServiceBusMessage
+from azure.servicebus.aio import ServiceBusClient
+
+from ingest.config import (
+    INGEST_QUEUE_BACKEND,
+    INGEST_LOCAL_QUEUE_PATH,
+    INGEST_LOCAL_QUEUE_LOCK_SECONDS,
+    INGEST_LOCAL_QUEUE_MAX_DELIVERY_COUNT
+)
+from ingest.ingest_exceptions import MessageLockLostError
+
+logger = logging.getLogger(__name__)
+
+
+class MessageQueue(abc.ABC):
+    """
+    The queue ingest_message consumes from. The methods mirror the azure ServiceBusReceiver so the messages are
+    received in peek-lock mode, their lock has to be renewed while they are processed and they are settled by
+    completing, abandoning (redelivered) or dead-lettering them.
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    @abc.abstractmethod
+    async def receive_messages(self, max_message_count: int = 1, max_wait_time: float = None) -> list:
+        """
+        Receive up to max_message_count messages and lock them, waiting at most max_wait_time seconds for the first
+        """
+
+    @abc.abstractmethod
+    async def renew_message_lock(self, message=None) -> datetime.datetime:
+        """
+        @return: the time the renewed lock of message expires
+        """
+
+    @abc.abstractmethod
+    async def complete_message(self, message=None):
+        """
+        Remove a processed message from the queue
+        """
+
+    @abc.abstractmethod
+    async def abandon_message(self, message=None):
+        """
+        Release the lock of message so it is delivered again
+        """
+
+    @abc.abstractmethod
+    async def dead_letter_message(self, message=None, reason: str = None, error_description: str = None):
+        """
+        Move message to the dead-letter sub-queue
+        """
+
+    @abc.abstractmethod
+    async def send_messages(self, bodies: list = None):
+        """
+        Send a message for each of the bodies
+        """
+
+
+class ServiceBusQueue(MessageQueue):
+    """
+    Azure Service Bus queue. The locks of the received messages are renewed by the LockRenewalScheduler.
+    """
+
+    def __init__(self, connection_string: str = None, queue_name: str = None):
+        self.connection_string = connection_string
+        self.queue_name = queue_name
+        self.client = None
+        self.receiver = None
+
+    async def __aenter__(self):
+        self.client = ServiceBusClient.from_connection_string(conn_str=self.connection_string, logging_enable=True)
+        await self.client.__aenter__()
+        self.receiver = self.client.get_queue_receiver(
+            queue_name=self.queue_name,
+            # prefetch_count=0,
+        )  # get one message without caching
+        await self.receiver.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.receiver.__aexit__(exc_type, exc_val, exc_tb)
+        await self.client.__aexit__(exc_type, exc_val, exc_tb)
+
+    async def receive_messages(self, max_message_count: int = 1, max_wait_time: float = None) -> list:
+        return await self.receiver.receive_messages(max_message_count=max_message_count,
+                                                    max_wait_time=max_wait_time)
+
+    async def renew_message_lock(self, message=None) -> datetime.datetime:
+        return await self.receiver.renew_message_lock(message=message)
+
+    async def complete_message(self, message=None):
+        await self.receiver.complete_message(message)
+
+    async def abandon_message(self, message=None):
+        await self.receiver.abandon_message(message)
+
+    async def dead_letter_message(self, message=None, reason: str = None, error_description: str = None):
+        await self.receiver.dead_letter_message(message, reason=reason, error_description=error_description)
+
+    async def send_messages(self, bodies: list = None):
+        async with self.client.get_queue_sender(queue_name=self.queue_name) as sender:
+            await sender.send_messages([ServiceBusMessage(body) for body in bodies])
+
+
+class LocalMessage:
+    """
+    A message received from a LocalQueue. Like a ServiceBusReceivedMessage its str() is the body.
+    """
+
+    def __init__(self, message_id: int = None, body: str = None, lock_token: str = None,
+                 locked_until: float = None, delivery_count: int = None):
+        self.message_id = message_id
+        self.body = body
+        self.lock_token = lock_token
+        self.locked_until = locked_until
+        self.delivery_count = delivery_count
+
+    @property
+    def locked_until_utc(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.locked_until, tz=datetime.timezone.utc)
+
+    def __str__(self):
+        return self.body
+
+
+class LocalQueue(MessageQueue):
+    """
+    A queue stored in a SQLite database with the same peek-lock semantics as a service bus queue.
+    A received message is locked for lock_seconds. A message that is not settled before its lock expires is delivered
+    again and after max_delivery_count deliveries it is dead-lettered. Several consumers (processes) can share
+    the database file.
+    """
+
+    def __init__(self, path: str = None, lock_seconds: int = 60, max_delivery_count: int = 10,
+                 poll_interval: float = 0.5):
+        self.path = path
+        self.lock_seconds = lock_seconds
+        self.max_delivery_count = max_delivery_count
+        self.poll_interval = poll_interval
+
+    @contextlib.contextmanager
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            yield connection
+        finally:
+            connection.close()
+
+    async def __aenter__(self):
+        await asyncio.to_thread(self.create)
+        return self
+
+    def create(self):
+        with self.connect() as connection:
+            connection.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    body TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'active',
+                    enqueued_at REAL NOT NULL,
+                    locked_until REAL NOT NULL DEFAULT 0,
+                    lock_token TEXT,
+                    delivery_count INTEGER NOT NULL DEFAULT 0,
+                    settled_at REAL,
+                    dead_letter_reason TEXT,
+                    dead_letter_error_description TEXT
+                )
+                '''
+            )
+
+    def _receive(self, max_message_count: int = 1) -> list:
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(
+                '''
+                UPDATE messages SET state = 'deadlettered', settled_at = ?,
+                    dead_letter_reason = 'MaxDeliveryCountExceeded'
+                WHERE state = 'active' AND locked_until < ? AND delivery_count >= ?
+                ''', (now, now, self.max_delivery_count)
+            )
+            rows = connection.execute(
+                '''
+                SELECT id, body, delivery_count FROM messages
+                WHERE state = 'active' AND locked_until < ? ORDER BY id LIMIT ?
+                ''', (now, max_message_count)
+            ).fetchall()
+            messages = list()
+            for message_id, body, delivery_count in rows:
+                message = LocalMessage(message_id=message_id, body=body, lock_token=uuid.uuid4().hex,
+                                       locked_until=now + self.lock_seconds, delivery_count=delivery_count + 1)
+                connection.execute(
+                    'UPDATE messages SET locked_until = ?, lock_token = ?, delivery_count = ? WHERE id = ?',
+                    (message.locked_until, message.lock_token, message.delivery_count, message_id)
+                )
+                messages.append(message)
+            connection.execute('COMMIT')
+            return messages
+
+    def _update_locked(self, message: LocalMessage = None, assignments: str = None, params: tuple = ()):
+        """
+        Update a message if this receiver still holds its lock
+        """
+        with self.connect() as connection:
+            cursor = connection.execute(
+                f'''
+                UPDATE messages SET {assignments}
+                WHERE id = ? AND lock_token = ? AND state = 'active' AND locked_until >= ?
+                ''', params + (message.message_id, message.lock_token, time.time())
+            )
+            if cursor.rowcount == 0:
+                raise MessageLockLostError(f'The lock on message {message.message_id} has expired or was lost')
+
+    async def receive_messages(self, max_message_count: int = 1, max_wait_time: float = None) -> list:
+        deadline = time.monotonic() + (max_wait_time or 0)
+        while True:
+            messages = await asyncio.to_thread(self._receive, max_message_count=max_message_count)
+            if messages or time.monotonic() >= deadline:
+                return messages
+            await asyncio.sleep(self.poll_interval)
+
+    async def renew_message_lock(self, message: LocalMessage = None) -> datetime.datetime:
+        locked_until = time.time() + self.lock_seconds
+        await asyncio.to_thread(self._update_locked, message=message, assignments='locked_until = ?',
+                                params=(locked_until,))
+        message.locked_until = locked_until
+        return message.locked_until_utc
+
+    async def complete_message(self, message: LocalMessage = None):
+        await asyncio.to_thread(self._update_locked, message=message,
+                                assignments="state = 'completed', settled_at = ?", params=(time.time(),))
+
+    async def abandon_message(self, message: LocalMessage = None):
+        await asyncio.to_thread(self._update_locked, message=message, assignments='locked_until = 0, lock_token = NULL')
+
+    async def dead_letter_message(self, message: LocalMessage = None, reason: str = None,
+                                  error_description: str = None):
+        await asyncio.to_thread(
+            self._update_locked, message=message,
+            assignments="state = 'deadlettered', settled_at = ?, dead_letter_reason = ?, "
+                        "dead_letter_error_description = ?",
+            params=(time.time(), reason, error_description)
+        )
+
+    def _send(self, bodies: list = None):
+        now = time.time()
+        with self.connect() as connection:
+            connection.executemany('INSERT INTO messages (body, enqueued_at) VALUES (?, ?)',
+                                   [(body, now) for body in bodies])
+
+    async def send_messages(self, bodies: list = None):
+        await asyncio.to_thread(self._send, bodies=bodies)
+
+    def stats(self) -> dict:
+        """
+        Count the messages per state and compute the throughput of the settled ones
+        """
+        with self.connect() as connection:
+            counts = dict(connection.execute('SELECT state, COUNT(*) FROM messages GROUP BY state').fetchall())
+            first, last, nsettled = connection.execute(
+                "SELECT MIN(enqueued_at), MAX(settled_at), COUNT(*) FROM messages WHERE state != 'active'"
+            ).fetchone()
+        stats = dict(counts=counts)
+        if nsettled and last > first:
+            stats['messages_per_hour'] = nsettled / (last - first) * 3600
+        return stats
+
+
+def open_queue(connection_string: str = None, queue_name: str = None) -> MessageQueue:
+    """
+    Create the queue selected through INGEST_QUEUE_BACKEND
+    """
+    if INGEST_QUEUE_BACKEND == 'local':
+        logger.info(f'Consuming from the local queue {INGEST_LOCAL_QUEUE_PATH}')
+        return LocalQueue(path=INGEST_LOCAL_QUEUE_PATH, lock_seconds=INGEST_LOCAL_QUEUE_LOCK_SECONDS,
+                          max_delivery_count=INGEST_LOCAL_QUEUE_MAX_DELIVERY_COUNT)
+    return ServiceBusQueue(connection_string=connection_string, queue_name=queue_name)
+
+
+def compose_message(blob_url: str = None, token: str = '', join_vector_tiles: bool = False, unit: str = None) -> str:
+    """
+    Compose the body of an ingest message the same way geohub does
+    @param unit: str, the unit (layer, band, subdataset) a sub-job of a split job ingests
+    """
+    body = f'{blob_url};{token};join_vector_tiles={str(join_vector_tiles).lower()}'
+    if unit is not None:
+        body = f'{body};unit={urllib.parse.quote(unit, safe="")}'
+    return json.dumps(body)
+
+
+async def _main(args):
+    async with LocalQueue(path=args.path) as queue:
+        if args.command == 'send':
+            bodies = [compose_message(blob_url=blob_url, join_vector_tiles=args.join_vector_tiles)
+                      for blob_url in args.blob_urls] * args.repeat
+            await queue.send_messages(bodies=bodies)
+            print(f'Sent {len(bodies)} messages to {args.path}')
+        else:
+            print(json.dumps(await asyncio.to_thread(queue.stats), indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Feed and inspect the local (SQLite) ingest queue. Set '
+                                                 'INGEST_QUEUE_BACKEND=local to consume it with the pipeline.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-p', '--path', default=INGEST_LOCAL_QUEUE_PATH, help='Path to the SQLite queue file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    send_parser = subparsers.add_parser('send', help='Enqueue ingest messages for one or more blobs')
+    send_parser.add_argument('blob_urls', nargs='+', help='Urls of the blobs to ingest')
+    send_parser.add_argument('-j', '--join-vector-tiles', action='store_true', default=False)
+    send_parser.add_argument('-r', '--repeat', type=int, default=1, help='Send every message this many times')
+    subparsers.add_parser('stats', help='Print the number of messages per state and the throughput')
+    asyncio.run(_main(parser.parse_args(args=None if sys.argv[1:] else ['--help'])))
@@ -0,0 +1,282 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import os
+import statistics
+import time
+
+from ingest.admission import MB
+from ingest.ledger import JobLedger
+from ingest.config import (
+    INGEST_MAX_WORKERS,
+    INGEST_HEAVY_JOB_MB,
+    INGEST_HEAVY_WORKERS,
+    INGEST_SJF_AGING_MB,
+    INGEST_MAX_JOBS_PER_USER,
+    INGEST_USER_WEIGHTS,
+    JOB_RESOURCE_FACTORS,
+    DEFAULT_JOB_RESOURCE_FACTORS
+)
+
+logger = logging.getLogger(__name__)
+
+
+def job_cost(blob_path: str = None, size: int = None, ledger: JobLedger = None) -> float:
+    """
+    Estimate how much work ingesting a blob takes from its size and format. The runtime predicted by the ledger is
+    used once it has a model, until then the disk factor of the format (how much data is written per byte of input)
+    is used as the weight.
+    @param blob_path: str, the path of the blob, used to find out the format
+    @param size: int, the size of the blob in bytes
+    @param ledger: optional, instance of JobLedger
+    @return: float, the cost in bytes
+    """
+    cost = ledger.cost(blob_path=blob_path, size=size) if ledger is not None else None
+    if cost is not None:
+        return cost
+    _, ext = os.path.splitext(blob_path.lower())
+    _, disk_factor = JOB_RESOURCE_FACTORS.get(ext, DEFAULT_JOB_RESOURCE_FACTORS)
+    return (size or 0) * disk_factor
+
+
+def blob_user(blob_path: str = None) -> str:
+    """
+    The user a blob belongs to, the first folder after the container
+    """
+    container_name, user, *rest = blob_path.split("/")
+    return user
+
+
+class WaitingJob:
+    def __init__(self, blob_path: str = None, size: int = None, user: str = None, service: float = None,
+                 future=None):
+        self.blob_path = blob_path
+        self.size = size
+        self.user = user
+        self.service = service
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class User:
+    """
+    The scheduling state and the wait time metrics of a user
+    """
+
+    def __init__(self, name: str = None, weight: float = 1):
+        self.name = name
+        self.weight = weight
+        # the service (cost / weight) received so far, the user with the least service is served first
+        self.virtual_time = 0
+        self.running = 0
+        self.waiting = 0
+        self.started = 0
+        self.waits = collections.deque(maxlen=1000)
+        # the last time a job of the user was queued or finished, the idle users are dropped (see prune)
+        self.last_active = time.monotonic()
+
+    @property
+    def active(self) -> bool:
+        return self.running > 0 or self.waiting > 0
+
+
+class Lane:
+    def __init__(self, name: str = None, slots: int = 1):
+        self.name = name
+        self.slots = slots
+        self.running = 0
+        # user -> heap of (priority, seq, WaitingJob)
+        self.waiting = dict()
+
+    def full(self) -> bool:
+        return self.running >= self.slots
+
+
+class JobScheduler:
+    """
+    Decides the order in which the received jobs get a worker.
+
+    The free workers are shared fairly between the users (weighted fair queueing). Every user has a virtual time, the
+    service (cost of the jobs started for the user divided by the user's weight) received while being active, and the
+    next job is taken from the user with the smallest virtual time. A user with max_jobs_per_user jobs running is
+    passed over while the jobs of other users are waiting in the lane, so a bulk upload of hundreds of files only holds
+    back its own jobs. The cap is work-conserving, when nobody else is waiting the free workers go to the capped user.
+    The other users can only be served if their messages are received, which needs a receive lookahead
+    (INGEST_SCHEDULER_LOOKAHEAD or INGEST_PREFETCH_COUNT) beyond the worker slots.
+
+    The waiting jobs of a user are started shortest job first. Their priority is the time they were queued plus their
+    cost divided by aging_rate, so a job waiting long enough eventually overtakes the smaller jobs arriving after it.
+    Blobs larger than heavy_threshold bytes are scheduled in a separate heavy lane with heavy_slots workers of its own
+    so a huge upload never occupies the workers the small ones are waiting for.
+    """
+
+    def __init__(self, slots: int = 1, heavy_slots: int = 0, heavy_threshold: int = None, aging_rate: float = None,
+                 max_jobs_per_user: int = 0, user_weights: dict = None, ledger: JobLedger = None,
+                 user_retention: float = 3600):
+        self.lanes = dict(normal=Lane(name='normal', slots=slots))
+        if heavy_slots > 0:
+            self.lanes['heavy'] = Lane(name='heavy', slots=heavy_slots)
+        self.heavy_threshold = heavy_threshold
+        self.aging_rate = aging_rate
+        self.max_jobs_per_user = max_jobs_per_user
+        self.user_weights = user_weights or dict()
+        self.ledger = ledger
+        self.users = dict()
+        # the users without running or waiting jobs for user_retention seconds are forgotten
+        self.user_retention = user_retention
+        self.counter = itertools.count()
+
+    @classmethod
+    def from_config(cls, ledger: JobLedger = None):
+        return cls(slots=INGEST_MAX_WORKERS, heavy_slots=INGEST_HEAVY_WORKERS, heavy_threshold=INGEST_HEAVY_JOB_MB * MB,
+                   aging_rate=INGEST_SJF_AGING_MB * MB, max_jobs_per_user=INGEST_MAX_JOBS_PER_USER,
+                   user_weights=INGEST_USER_WEIGHTS, ledger=ledger)
+
+    @property
+    def capacity(self) -> int:
+        """
+        The number of jobs that can run at the same time over all lanes
+        """
+        return sum(lane.slots for lane in self.lanes.values())
+
+    def lane(self, size: int = None) -> Lane:
+        if 'heavy' in self.lanes and (size or 0) >= self.heavy_threshold:
+            return self.lanes['heavy']
+        return self.lanes['normal']
+
+    def user(self, name: str = None) -> User:
+        if name not in self.users:
+            self.users[name] = User(name=name, weight=self.user_weights.get(name, 1))
+        return self.users[name]
+
+    def capped(self, user: User = None) -> bool:
+        return 0 < self.max_jobs_per_user <= user.running
+
+    def must_wait(self, blob_path: str = None, size: int = None) -> bool:
+        """
+        Whether a job for a blob of size bytes would have to wait for a worker
+        """
+        lane = self.lane(size=size)
+        return lane.full() or any(lane.waiting.values())
+
+    async def acquire(self, blob_path: str = None, size: int = None) -> Lane:
+        """
+        Wait until the job can be started
+        @param blob_path: str, the path of the blob
+        @param size: int, the size of the blob in bytes
+        @return: the lane the job runs in, to be released when the job has finished
+        """
+        lane = self.lane(size=size)
+        user = self.user(blob_user(blob_path))
+        if not user.active:
+            # a user becoming active starts level with the active users instead of cashing in the time it was idle
+            active_times = [u.virtual_time for u in self.users.values() if u.active]
+            if active_times:
+                user.virtual_time = max(user.virtual_time, min(active_times))
+        cost = job_cost(blob_path=blob_path, size=size, ledger=self.ledger) / self.aging_rate
+        job = WaitingJob(blob_path=blob_path, size=size, user=user.name, service=1 + cost,
+                         future=asyncio.get_running_loop().create_future())
+        heapq.heappush(lane.waiting.setdefault(user.name, list()), (job.enqueued_at + cost, next(self.counter), job))
+        user.waiting += 1
+        user.last_active = time.monotonic()
+        self.dispatch()
+        if not job.future.done():
+            logger.debug(f'{blob_path} is waiting in the {lane.name} lane')
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if job.future.done() and not job.future.cancelled():
+                # the slot was handed over right before the cancellation
+                self.release(lane=lane, blob_path=blob_path)
+            else:
+                user.waiting -= 1
+            raise
+        return lane
+
+    def release(self, lane: Lane = None, blob_path: str = None):
+        """
+        Free the slot of a finished job and hand the free slots over to the waiting jobs
+        """
+        lane.running -= 1
+        user = self.user(blob_user(blob_path))
+        user.running -= 1
+        user.last_active = time.monotonic()
+        self.dispatch()
+        self.prune()
+
+    def prune(self):
+        """
+        Forget the users that have had no running or waiting jobs for user_retention seconds
+        """
+        now = time.monotonic()
+        for name, user in list(self.users.items()):
+            if not user.active and now - user.last_active > self.user_retention:
+                del self.users[name]
+                for lane in self.lanes.values():
+                    # only the jobs cancelled while waiting can be left
+                    lane.waiting.pop(name, None)
+
+    def head(self, lane: Lane = None, user: str = None):
+        """
+        The next job of user in lane, the jobs that were cancelled while waiting are dropped
+        """
+        jobs = lane.waiting.get(user)
+        while jobs and jobs[0][2].future.done():
+            heapq.heappop(jobs)
+        if not jobs:
+            lane.waiting.pop(user, None)
+            return
+        return jobs[0]
+
+    def waiting_jobs(self, lane: Lane = None) -> list:
+        """
+        The jobs waiting for a worker in lane, in all lanes if lane is None
+        """
+        lanes = [lane] if lane is not None else self.lanes.values()
+        return [job for lane in lanes for jobs in lane.waiting.values() for _, _, job in jobs if not job.future.done()]
+
+    def dispatch(self):
+        """
+        Start the waiting jobs while there are free slots, taking them from the user with the least service among the
+        users below max_jobs_per_user, or among all the users if only capped users are waiting
+        """
+        for lane in self.lanes.values():
+            while not lane.full():
+                candidates = list()
+                for name in list(lane.waiting):
+                    head = self.head(lane=lane, user=name)
+                    if head is None:
+                        continue
+                    user = self.users[name]
+                    candidates.append((self.capped(user), user.virtual_time, head[0], head[1], name))
+                if not candidates:
+                    break
+                *_, name = min(candidates)
+                _, _, job = heapq.heappop(lane.waiting[name])
+                user = self.users[name]
+                user.waiting -= 1
+                user.running += 1
+                user.started += 1
+                user.virtual_time += job.service / user.weight
+                lane.running += 1
+                wait = time.monotonic() - job.enqueued_at
+                user.waits.append(wait)
+                if wait > 1:
+                    logger.info(f'{job.blob_path} has waited {wait:.0f} seconds for a worker')
+                job.future.set_result(None)
+
+    def stats(self) -> dict:
+        """
+        The number of running/waiting/started jobs and the wait times (seconds) of the recent jobs of every user
+        """
+        stats = dict()
+        for name, user in self.users.items():
+            user_stats = dict(running=user.running, waiting=user.waiting, started=user.started)
+            if user.waits:
+                waits = sorted(user.waits)
+                user_stats.update(wait_mean=statistics.fmean(waits), wait_p95=waits[int(0.95 * (len(waits) - 1))],
+                                  wait_max=waits[-1])
+            stats[name] = user_stats
+        return stats
@@ -0,0 +1,40 @@
+import asyncio
+
+from ingest.admission import MB, ResourceBudget, estimate_job_resources
+from ingest.config import JOB_BASE_MEMORY
+
+
+def test_estimate_job_resources_uses_the_factors_of_the_format():
+    assert estimate_job_resources(blob_path='c/u/raw/a.tif', size=100 * MB) == (JOB_BASE_MEMORY + 25 * MB, 250 * MB)
+    # unknown formats use the default factors
+    assert estimate_job_resources(blob_path='c/u/raw/a.xyz', size=100 * MB) == (JOB_BASE_MEMORY + 100 * MB, 400 * MB)
+    assert estimate_job_resources(blob_path='c/u/raw/a.tif', size=None) == (JOB_BASE_MEMORY, 0)
+
+
+def test_budget_admits_the_jobs_that_fit():
+    async def run():
+        budget = ResourceBudget(memory=100, disk=100)
+        await budget.acquire(memory=60, disk=10)
+        assert (budget.free_memory, budget.free_disk, budget.njobs) == (40, 90, 1)
+        assert budget.fits(memory=40, disk=90)
+        assert not budget.fits(memory=41, disk=0)
+        assert not budget.fits(memory=0, disk=91)
+        await budget.release(memory=60, disk=10)
+        assert (budget.used_memory, budget.used_disk, budget.njobs) == (0, 0, 0)
+
+    asyncio.run(run())
+
+
+def test_budget_waits_for_room_and_admits_a_job_larger_than_the_budget_alone():
+    async def run():
+        budget = ResourceBudget(memory=100, disk=100)
+        # nothing is running, a job larger than the whole budget is not starved
+        await budget.acquire(memory=500, disk=500)
+        waiting = asyncio.ensure_future(budget.acquire(memory=10, disk=10))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        await budget.release(memory=500, disk=500)
+        await asyncio.wait_for(waiting, 1)
+        assert (budget.used_memory, budget.used_disk, budget.njobs) == (10, 10, 1)
+
+    asyncio.run(run())
@@ -0,0 +1,141 @@
+import datetime
+import itertools
+import json
+import types
+
+import pytest
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+from ingest.checkpoint import JobCheckpoint, checkpoint_blob_path
+
+BLOB_URL = 'https://test.blob.core.windows.net/userdata/user/raw/a.gpkg'
+
+
+class FakeBlob:
+    def __init__(self, service=None, path: str = None):
+        self.service = service
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def get_blob_properties(self):
+        return types.SimpleNamespace(size=100, creation_time=self.service.created,
+                                     content_settings=types.SimpleNamespace(content_md5=None))
+
+    def download_blob(self):
+        if self.path not in self.service.blobs:
+            raise ResourceNotFoundError('not found')
+        data, etag = self.service.blobs[self.path]
+        return types.SimpleNamespace(readall=lambda: data, properties=types.SimpleNamespace(etag=etag))
+
+    def upload_blob(self, data=None, overwrite: bool = False, etag: str = None, match_condition=None, **kwargs):
+        if self.service.interfere:
+            # another writer updates the blob between the read and the write of this one
+            interfere, self.service.interfere = self.service.interfere, None
+            interfere()
+        if self.path in self.service.blobs:
+            if not overwrite:
+                raise ResourceExistsError('exists')
+            if etag is not None and etag != self.service.blobs[self.path][1]:
+                raise ResourceModifiedError('modified')
+        elif etag is not None:
+            raise ResourceNotFoundError('not found')
+        self.service.blobs[self.path] = data, str(next(self.service.etags))
+
+    def delete_blob(self):
+        if self.path not in self.service.blobs:
+            raise ResourceNotFoundError('not found')
+        del self.service.blobs[self.path]
+
+
+class FakeBlobService:
+    """
+    An in-memory storage account with the ETag conditions of the blob service
+    """
+
+    def __init__(self):
+        self.blobs = dict()
+        self.etags = itertools.count()
+        self.created = datetime.datetime(2024, 1, 1)
+        self.interfere = None
+
+    def get_blob_client(self, container: str = None, blob: str = None) -> FakeBlob:
+        return FakeBlob(service=self, path=f'{container}/{blob}')
+
+    def manifest(self) -> dict:
+        container_name, manifest_path = checkpoint_blob_path(blob_url=BLOB_URL)
+        data, _ = self.blobs[f'{container_name}/{manifest_path}']
+        return json.loads(data)
+
+
+@pytest.fixture
+def service(monkeypatch) -> FakeBlobService:
+    service = FakeBlobService()
+    monkeypatch.setattr('ingest.checkpoint.shared_blob_service_client', lambda conn_string=None: service)
+    return service
+
+
+def test_manifest_is_stored_next_to_the_outputs():
+    assert checkpoint_blob_path(blob_url=BLOB_URL) == ('userdata', 'user/datasets/a.gpkg/a.gpkg.checkpoint.json')
+
+
+def test_finished_units_are_skipped_when_the_job_resumes(service):
+    checkpoint = JobCheckpoint.load(blob_url=BLOB_URL)
+    checkpoint.mark_done('layer:roads', outputs={'roads.pmtiles': '"0x1"'})
+    checkpoint.mark_done('layer:rivers', status='failed')
+    resumed = JobCheckpoint.load(blob_url=BLOB_URL)
+    assert resumed.is_done('layer:roads')
+    assert resumed.units['layer:roads']['outputs'] == {'roads.pmtiles': '"0x1"'}
+    # the failed units are ingested again
+    assert not resumed.is_done('layer:rivers')
+    assert not resumed.is_done('layer:lakes')
+
+
+def test_manifest_of_another_version_of_the_blob_is_disregarded(service):
+    JobCheckpoint.load(blob_url=BLOB_URL).mark_done('layer:roads')
+    service.created = datetime.datetime(2024, 1, 2)
+    resumed = JobCheckpoint.load(blob_url=BLOB_URL)
+    assert resumed.units == {}
+    resumed.mark_done('layer:rivers')
+    assert list(service.manifest()['units']) == ['layer:rivers']
+
+
+def test_concurrent_writers_merge_their_units_and_one_finishes_the_job(service):
+    planner = JobCheckpoint.load(blob_url=BLOB_URL)
+    planner.set_plan(['layer:roads', 'layer:rivers'])
+    assert planner.progress == 30
+    first, second = JobCheckpoint.load(blob_url=BLOB_URL), JobCheckpoint.load(blob_url=BLOB_URL)
+    # the second writer updates the manifest while the first one is writing, the first one retries on top of it
+    service.interfere = lambda: second.mark_done('layer:rivers')
+    first.mark_done('layer:roads')
+    assert set(service.manifest()['units']) == {'layer:roads', 'layer:rivers'}
+    assert service.manifest()['plan'] == ['layer:roads', 'layer:rivers']
+    assert (first.finisher, second.finisher) == (True, False)
+    assert first.progress == 100
+
+
+def test_failed_flush_keeps_the_units_for_the_next_one(service):
+    checkpoint = JobCheckpoint.load(blob_url=BLOB_URL)
+
+    def fail():
+        raise IOError('connection reset')
+
+    service.interfere = fail
+    checkpoint.mark_done('layer:roads')
+    assert 'layer:roads' in checkpoint.pending
+    checkpoint.flush()
+    assert not checkpoint.pending
+    assert list(service.manifest()['units']) == ['layer:roads']
+
+
+def test_delete_removes_the_manifest(service):
+    checkpoint = JobCheckpoint.load(blob_url=BLOB_URL)
+    checkpoint.mark_done('layer:roads')
+    checkpoint.delete()
+    assert JobCheckpoint.load(blob_url=BLOB_URL).units == {}
+    # deleting a manifest that does not exist is not an error
+    checkpoint.delete()
@@ -0,0 +1,283 @@
+import datetime
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+import types
+
+import pytest
+
+from ingest.download import (
+    ALIGNMENT, INITIAL_RANGE, MAX_RANGE, MB, MIN_RANGE, RangeDownloader, download_blob_ranges, remove_shared_copy,
+    shared_copy
+)
+from ingest.ingest_exceptions import DownloadIntegrityError
+from ingest.transfer import TransferController
+
+
+class FakeDownload:
+    def __init__(self, data: bytes = None):
+        self.data = data
+
+    def readall(self) -> bytes:
+        return self.data
+
+
+class FakeBlobClient:
+    """
+    Serves the range requests of a RangeDownloader from memory, failing the first failures requests
+    """
+
+    def __init__(self, data: bytes = None, failures: int = 0, delay: float = 0):
+        self.blob_name = 'raw/a.bin'
+        self.account_name = 'test'
+        self.data = data
+        self.failures = failures
+        self.delay = delay
+        self.ranges = list()
+        self.lock = threading.Lock()
+
+    def download_blob(self, offset: int = None, length: int = None, **kwargs) -> FakeDownload:
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise IOError('connection reset')
+            self.ranges.append((offset, length))
+        time.sleep(self.delay)
+        return FakeDownload(data=self.data[offset:offset + length])
+
+    def get_blob_properties(self):
+        return types.SimpleNamespace(size=len(self.data), creation_time=datetime.datetime(2024, 1, 1),
+                                     content_settings=types.SimpleNamespace(content_md5=None))
+
+
+def downloader(tmp_path, data: bytes = None, client: FakeBlobClient = None, concurrency: int = 4,
+               **kwargs) -> RangeDownloader:
+    client = client or FakeBlobClient(data=data)
+    controller = TransferController(account='test', direction='download', concurrency=concurrency,
+                                    max_concurrency=concurrency, state_path=None)
+    return RangeDownloader(blob_client=client, dst_file=str(tmp_path / 'a.bin'), size=len(client.data),
+                           controller=controller, **kwargs)
+
+
+def test_first_ranges_are_a_share_of_the_blob(tmp_path):
+    small = downloader(tmp_path, data=bytes(8 * MB))
+    # too small to split in four ranges per stream, the smallest range is used
+    assert small.range_size() == MIN_RANGE
+    large = downloader(tmp_path, data=bytes(256 * MB))
+    assert large.range_size() == INITIAL_RANGE
+
+
+def test_ranges_follow_the_measured_rate_within_bounds(tmp_path):
+    download = downloader(tmp_path, data=bytes(1024 * MB), range_seconds=0.5)
+    download.rate = 20 * MB
+    assert download.range_size() == 10 * MB
+    download.rate = 10 * MB + 1
+    assert download.range_size() % ALIGNMENT == 0
+    download.rate = 1000 * MB
+    assert download.range_size() == MAX_RANGE
+    download.rate = 1
+    assert download.range_size() == MIN_RANGE
+    # near the end the streams share what is left so they finish together
+    download.rate = 1000 * MB
+    download.gaps = [[0, 40 * MB]]
+    assert download.range_size() == 10 * MB
+
+
+def test_ranges_cover_the_blob_once(tmp_path):
+    size = 37 * MB + 12345
+    download = downloader(tmp_path, data=bytes(size))
+    ranges = list()
+    while (item := download.next_range()) is not None:
+        ranges.append(item)
+    assert ranges[0][0] == 0
+    assert all(offset + length == following for (offset, length), (following, _) in zip(ranges, ranges[1:]))
+    assert sum(length for _, length in ranges) == size
+    assert download.gaps == []
+
+
+def test_download_writes_every_range_at_its_offset(tmp_path):
+    data = os.urandom(21 * MB + 777)
+    download = downloader(tmp_path, data=data, content_md5=hashlib.md5(data).digest())
+    path = download.run()
+    with open(path, 'rb') as result:
+        assert result.read() == data
+    assert len(download.blob_client.ranges) > 1
+
+
+def test_failed_ranges_are_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr('ingest.download.BACKOFF', 0.01)
+    data = os.urandom(5 * MB)
+    client = FakeBlobClient(data=data, failures=3)
+    path = downloader(tmp_path, client=client).run()
+    with open(path, 'rb') as result:
+        assert result.read() == data
+
+
+def test_download_fails_once_a_range_runs_out_of_attempts(tmp_path, monkeypatch):
+    monkeypatch.setattr('ingest.download.BACKOFF', 0.01)
+    client = FakeBlobClient(data=os.urandom(2 * MB), failures=100)
+    with pytest.raises(IOError):
+        downloader(tmp_path, client=client, concurrency=1, attempts=2).run()
+
+
+def write_partial(tmp_path, data: bytes = None, ranges: list = None, version: str = 'v1'):
+    """
+    Write the ranges of data to the file and the sidecar of an interrupted download
+    """
+    with open(tmp_path / 'a.bin', 'wb') as partial:
+        partial.truncate(len(data))
+        for offset, length in ranges:
+            partial.seek(offset)
+            partial.write(data[offset:offset + length])
+    with open(tmp_path / 'a.bin.ranges.json', 'w') as sidecar:
+        json.dump(dict(version=version, size=len(data), ranges=ranges), sidecar)
+
+
+def test_interrupted_download_resumes_the_missing_ranges(tmp_path):
+    data = os.urandom(12 * MB)
+    write_partial(tmp_path, data=data, ranges=[[0, 3 * MB], [6 * MB, 2 * MB]])
+    download = downloader(tmp_path, data=data, sidecar=str(tmp_path / 'a.bin.ranges.json'), version='v1',
+                          content_md5=hashlib.md5(data).digest())
+    with open(download.run(), 'rb') as result:
+        assert result.read() == data
+    fetched = sorted(download.blob_client.ranges)
+    assert sum(length for _, length in fetched) == 7 * MB
+    assert all(not (offset < 3 * MB or 6 * MB <= offset < 8 * MB) for offset, _ in fetched)
+    with open(tmp_path / 'a.bin.ranges.json') as sidecar:
+        assert json.load(sidecar)['ranges'] == [[0, 12 * MB]]
+
+
+def test_sidecar_of_another_version_is_ignored(tmp_path):
+    data = os.urandom(4 * MB)
+    write_partial(tmp_path, data=bytes(4 * MB), ranges=[[0, 4 * MB]], version='v0')
+    download = downloader(tmp_path, data=data, sidecar=str(tmp_path / 'a.bin.ranges.json'), version='v1')
+    with open(download.run(), 'rb') as result:
+        assert result.read() == data
+    assert sum(length for _, length in download.blob_client.ranges) == 4 * MB
+
+
+def test_md5_mismatch_fails_the_download(tmp_path):
+    data = os.urandom(6 * MB)
+    # the resumed part of the file is corrupt
+    write_partial(tmp_path, data=bytes(MB) + data[MB:], ranges=[[0, 2 * MB]])
+    download = downloader(tmp_path, data=data, sidecar=str(tmp_path / 'a.bin.ranges.json'), version='v1',
+                          content_md5=hashlib.md5(data).digest())
+    with pytest.raises(DownloadIntegrityError):
+        download.run()
+
+
+def test_empty_blob_is_created_without_requests(tmp_path):
+    download = downloader(tmp_path, data=b'', content_md5=hashlib.md5(b'').digest())
+    assert os.path.getsize(download.run()) == 0
+    assert download.blob_client.ranges == []
+    with pytest.raises(DownloadIntegrityError):
+        downloader(tmp_path, data=b'', content_md5=hashlib.md5(b'x').digest()).run()
+
+
+def test_cancelled_download_keeps_the_resume_folder_locked_until_its_streams_stop(tmp_path, monkeypatch):
+    client = FakeBlobClient(data=os.urandom(8 * MB), delay=0.5)
+    monkeypatch.setattr('ingest.download.blob_client', lambda **kwargs: client)
+    cancel_event = multiprocessing.Event()
+    threading.Timer(0.1, cancel_event.set).start()
+    controller = TransferController(account='test', direction='download', concurrency=4, max_concurrency=4,
+                                    state_path=None)
+    (tmp_path / 'out').mkdir()
+    with pytest.raises(TimeoutError):
+        download_blob_ranges(src_blob_path='c/raw/a.bin', local_folder=str(tmp_path / 'out'),
+                             cancel_event=cancel_event, resume_dir=str(tmp_path / 'resume'), controller=controller)
+    folder, = (tmp_path / 'resume').iterdir()
+
+    def locked() -> bool:
+        with open(folder / '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return False
+            except OSError:
+                return True
+
+    assert locked()
+    deadline = time.monotonic() + 5
+    while locked() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not locked()
+    # the last stream has written the sidecar before releasing the lock
+    assert (folder / 'a.bin.ranges.json').exists()
+
+
+def test_jobs_share_one_copy_of_a_blob(tmp_path):
+    downloads = list()
+
+    def download(local_folder):
+        downloads.append(local_folder)
+        time.sleep(0.2)
+        path = os.path.join(local_folder, 'download.tmp')
+        with open(path, 'wb') as copy:
+            copy.write(b'data')
+        return path
+
+    def job():
+        with shared_copy(cache_dir=str(tmp_path), key='c/raw/a.gpkg:v1', file_name='a.gpkg', download=download,
+                         max_age=3600) as path:
+            with open(path, 'rb') as copy:
+                contents.append(copy.read())
+            # the copy is not removed while it is in use
+            assert not remove_shared_copy(cache_dir=str(tmp_path), key='c/raw/a.gpkg:v1')
+
+    contents = list()
+    threads = [threading.Thread(target=job) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert contents == [b'data'] * 4
+    assert len(downloads) == 1
+    assert remove_shared_copy(cache_dir=str(tmp_path), key='c/raw/a.gpkg:v1')
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_waiting_for_a_shared_copy_is_cancelled(tmp_path):
+    started = threading.Event()
+
+    def download(local_folder):
+        started.set()
+        time.sleep(0.5)
+        path = os.path.join(local_folder, 'a.gpkg')
+        with open(path, 'wb'):
+            pass
+        return path
+
+    def job():
+        with shared_copy(cache_dir=str(tmp_path), key='k', file_name='a.gpkg', download=download, max_age=3600):
+            pass
+
+    thread = threading.Thread(target=job)
+    thread.start()
+    assert started.wait(1)
+    cancel_event = multiprocessing.Event()
+    cancel_event.set()
+    with pytest.raises(TimeoutError):
+        with shared_copy(cache_dir=str(tmp_path), key='k', file_name='a.gpkg', download=download,
+                         cancel_event=cancel_event, max_age=3600):
+            pass
+    thread.join()
+
+
+def test_stale_shared_copies_are_removed(tmp_path):
+    stale = tmp_path / 'stale'
+    stale.mkdir()
+    (stale / 'a.gpkg').write_bytes(b'data')
+    os.utime(stale, (time.time() - 7200, time.time() - 7200))
+
+    def download(local_folder):
+        path = os.path.join(local_folder, 'b.gpkg')
+        with open(path, 'wb'):
+            pass
+        return path
+
+    with shared_copy(cache_dir=str(tmp_path), key='k', file_name='b.gpkg', download=download, max_age=3600):
+        pass
+    assert not stale.exists()
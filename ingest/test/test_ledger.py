@@ -0,0 +1,61 @@
+import pytest
+
+from ingest.ledger import MB, JobLedger
+from ingest.scheduler import job_cost
+
+
+def record_jobs(ledger: JobLedger = None):
+    """
+    Record jobs taking 1 second per MB for the GeoTIFFs and 3 seconds per MB for the zip files
+    """
+    for size_mb in (1, 2, 4, 8, 16, 32, 64):
+        ledger.record(blob_path=f'c/u/raw/{size_mb}.tif', size=size_mb * MB, total_seconds=size_mb)
+        ledger.record(blob_path=f'c/u/raw/{size_mb}.zip', size=size_mb * MB, total_seconds=3 * size_mb)
+
+
+def test_no_model_before_min_jobs(tmp_path):
+    ledger = JobLedger(path=str(tmp_path / 'ledger.sqlite'), min_jobs=20, timeout=3600)
+    record_jobs(ledger=ledger)
+    ledger.fit()
+    assert ledger.model is None
+    assert ledger.predict(blob_path='c/u/raw/a.tif', size=MB) is None
+    assert ledger.timeout(blob_path='c/u/raw/a.tif', size=MB) == 3600
+    assert ledger.cost(blob_path='c/u/raw/a.tif', size=MB) is None
+    # the scheduler falls back to the disk factor of the format
+    assert job_cost(blob_path='c/u/raw/a.tif', size=MB, ledger=ledger) == 2.5 * MB
+
+
+def test_fit_predicts_the_runtime_from_the_size_and_the_format(tmp_path):
+    ledger = JobLedger(path=str(tmp_path / 'ledger.sqlite'), min_jobs=10)
+    record_jobs(ledger=ledger)
+    # the failed jobs are not used to fit the model
+    ledger.record(blob_path='c/u/raw/failed.tif', size=MB, total_seconds=1000, status='timeout')
+    ledger.fit()
+    assert ledger.model is not None
+    assert ledger.predict(blob_path='c/u/raw/a.tif', size=16 * MB) == pytest.approx(16, rel=0.3)
+    assert ledger.predict(blob_path='c/u/raw/a.zip', size=16 * MB) == pytest.approx(48, rel=0.3)
+    assert ledger.predict(blob_path='c/u/raw/a.zip', size=16 * MB) > ledger.predict(blob_path='c/u/raw/a.tif',
+                                                                                    size=16 * MB)
+    # a format never seen gets the overall estimate
+    unknown = ledger.predict(blob_path='c/u/raw/a.gpkg', size=16 * MB)
+    assert 16 * 0.7 < unknown < 48 * 1.3
+    # the slower format costs more than its size
+    assert ledger.cost(blob_path='c/u/raw/a.zip', size=MB) > ledger.cost(blob_path='c/u/raw/a.tif', size=MB)
+
+
+def test_timeout_is_the_clamped_prediction_times_the_factor(tmp_path):
+    ledger = JobLedger(path=str(tmp_path / 'ledger.sqlite'), min_jobs=10, timeout_factor=3, timeout_min=60,
+                       timeout_max=600)
+    record_jobs(ledger=ledger)
+    ledger.fit()
+    predicted = ledger.predict(blob_path='c/u/raw/a.tif', size=64 * MB)
+    assert ledger.timeout(blob_path='c/u/raw/a.tif', size=64 * MB) == pytest.approx(predicted * 3)
+    assert ledger.timeout(blob_path='c/u/raw/a.tif', size=MB) == 60
+    assert ledger.timeout(blob_path='c/u/raw/a.zip', size=1024 * MB) == 600
+
+
+def test_record_never_fails_the_job(tmp_path):
+    ledger = JobLedger(path=str(tmp_path / 'missing' / 'ledger.sqlite'))
+    ledger.record(blob_path='c/u/raw/a.tif', size=MB, total_seconds=1)
+    ledger.fit()
+    assert ledger.model is None
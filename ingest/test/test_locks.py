@@ -0,0 +1,95 @@
+import asyncio
+import datetime
+import multiprocessing
+import time
+
+import pytest
+
+from ingest.ingest_exceptions import MessageLockLostError
+from ingest.locks import LockRenewalScheduler
+
+
+class FakeMessage:
+    def __init__(self, lock_seconds: float = None):
+        self.lock_seconds = lock_seconds
+        self.locked_until = time.time() + lock_seconds
+        self.renewed_at = list()
+
+    @property
+    def locked_until_utc(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.locked_until, tz=datetime.timezone.utc)
+
+
+class FakeQueue:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+
+    async def renew_message_lock(self, message: FakeMessage = None):
+        now = time.time()
+        if self.fail or now > message.locked_until:
+            raise RuntimeError('lock lost')
+        message.renewed_at.append(now)
+        message.locked_until = now + message.lock_seconds
+        return message.locked_until_utc
+
+
+def test_heap_is_ordered_by_the_renewal_deadline():
+    async def run():
+        scheduler = LockRenewalScheduler(margin=1, batch_window=0, min_interval=0)
+        scheduler.wakeup = asyncio.Event()
+        renewals = [scheduler.register(queue=FakeQueue(), message=FakeMessage(lock_seconds=seconds), name=str(seconds))
+                    for seconds in (30, 10, 20)]
+        assert scheduler.wakeup.is_set()
+        due, _, first = scheduler.heap[0]
+        assert first is renewals[1]
+        assert due == pytest.approx(first.message.locked_until - 1)
+        assert scheduler.stats()['registered'] == 3
+
+    asyncio.run(run())
+
+
+def test_locks_are_renewed_before_they_expire():
+    async def run():
+        async with LockRenewalScheduler(margin=0.1, batch_window=0, min_interval=0) as scheduler:
+            message = FakeMessage(lock_seconds=0.2)
+            timeout_event = multiprocessing.Event()
+            renewal = scheduler.register(queue=FakeQueue(), message=message, timeout_event=timeout_event, name='a')
+            await asyncio.sleep(0.5)
+            scheduler.unregister(renewal)
+            assert len(message.renewed_at) >= 3
+            assert not timeout_event.is_set()
+            assert not renewal.lost.done()
+            renewed = len(message.renewed_at)
+            await asyncio.sleep(0.3)
+            # an unregistered message is dropped when it falls due
+            assert len(message.renewed_at) <= renewed + 1
+            assert scheduler.stats()['registered'] == 0
+
+    asyncio.run(run())
+
+
+def test_locks_falling_due_together_are_renewed_in_one_batch():
+    async def run():
+        async with LockRenewalScheduler(margin=0.1, batch_window=0.1, min_interval=0) as scheduler:
+            messages = [FakeMessage(lock_seconds=0.2), FakeMessage(lock_seconds=0.25)]
+            for n, message in enumerate(messages):
+                scheduler.register(queue=FakeQueue(), message=message, name=str(n))
+            await asyncio.sleep(0.15)
+            assert [len(message.renewed_at) for message in messages] == [1, 1]
+            assert scheduler.batches == 1
+
+    asyncio.run(run())
+
+
+def test_failed_renewal_cancels_the_job():
+    async def run():
+        async with LockRenewalScheduler(margin=0.1, batch_window=0, min_interval=0) as scheduler:
+            timeout_event = multiprocessing.Event()
+            renewal = scheduler.register(queue=FakeQueue(fail=True), message=FakeMessage(lock_seconds=0.2),
+                                         timeout_event=timeout_event, name='a')
+            with pytest.raises(MessageLockLostError):
+                await asyncio.wait_for(renewal.wait(), 1)
+            assert timeout_event.is_set()
+            assert scheduler.failures == 1
+
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from ingest.prefetch import Prefetcher
+
+
+@pytest.fixture
+def downloads(monkeypatch) -> list:
+    downloads = list()
+
+    def download_blob_sync(src_blob_path=None, local_folder=None, conn_string=None, timeout_event=None):
+        downloads.append(src_blob_path)
+        path = os.path.join(local_folder, os.path.basename(src_blob_path))
+        with open(path, 'wb') as downloaded:
+            downloaded.write(b'data')
+        return path
+
+    monkeypatch.setattr('ingest.prefetch.download_blob_sync', download_blob_sync)
+    return downloads
+
+
+def test_messages_of_the_same_blob_share_one_download(tmp_path, downloads):
+    async def run():
+        prefetcher = Prefetcher(spool_dir=str(tmp_path), max_bytes=100)
+        assert prefetcher.prefetch(blob_path='c/u/raw/a.gpkg', size=60)
+        assert prefetcher.prefetch(blob_path='c/u/raw/a.gpkg', size=60)
+        # the spool is full
+        assert not prefetcher.prefetch(blob_path='c/u/raw/b.gpkg', size=60)
+        path = await prefetcher.take(blob_path='c/u/raw/a.gpkg')
+        assert await prefetcher.take(blob_path='c/u/raw/a.gpkg') == path
+        assert downloads == ['c/u/raw/a.gpkg']
+        await prefetcher.release(blob_path='c/u/raw/a.gpkg')
+        # the other message still uses the file
+        assert os.path.exists(path)
+        await prefetcher.release(blob_path='c/u/raw/a.gpkg')
+        assert not os.path.exists(path)
+        assert prefetcher.used_bytes == 0
+        assert list(tmp_path.iterdir()) == []
+
+    asyncio.run(run())
+
+
+def test_held_download_outlives_its_message(tmp_path, downloads):
+    async def run():
+        prefetcher = Prefetcher(spool_dir=str(tmp_path), max_bytes=100)
+        prefetcher.prefetch(blob_path='c/u/raw/a.gpkg', size=10)
+        path = await prefetcher.take(blob_path='c/u/raw/a.gpkg')
+        release = prefetcher.hold(blob_path='c/u/raw/a.gpkg')
+        await prefetcher.release(blob_path='c/u/raw/a.gpkg')
+        assert os.path.exists(path)
+        # a new message for the blob shares the held download
+        prefetcher.prefetch(blob_path='c/u/raw/a.gpkg', size=10)
+        assert await prefetcher.take(blob_path='c/u/raw/a.gpkg') == path
+        await prefetcher.release(blob_path='c/u/raw/a.gpkg')
+        assert os.path.exists(path)
+        assert downloads == ['c/u/raw/a.gpkg']
+        # the thread of the job releases it
+        thread = threading.Thread(target=release)
+        thread.start()
+        thread.join()
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+        assert not os.path.exists(path)
+        assert prefetcher.used_bytes == 0
+
+    asyncio.run(run())
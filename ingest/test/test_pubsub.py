@@ -0,0 +1,70 @@
+import json
+import threading
+import time
+import types
+
+from azure.messaging.webpubsubclient.models import WebPubSubDataType
+
+from ingest.pubsub import PubSubHub
+
+BLOB_URL = 'https://test.blob.core.windows.net/userdata/user/raw/a.gpkg'
+OTHER_BLOB_URL = 'https://test.blob.core.windows.net/userdata/user/raw/b.gpkg'
+
+
+class FakeClient:
+    def __init__(self, connected: bool = True):
+        self.connected = connected
+        self.sent = list()
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def send_to_group(self, group_name, content=None, data_type=None, **kwargs):
+        self.sent.append(content)
+
+
+def cancel_message(blob_url: str = None):
+    return types.SimpleNamespace(data=dict(user='user', url=blob_url, cancel=True))
+
+
+def test_cancel_is_routed_to_the_job_of_the_blob():
+    hub = PubSubHub()
+    cancel_event, other_cancel_event = threading.Event(), threading.Event()
+    with hub.track(blob_url=BLOB_URL, cancel_event=cancel_event), \
+            hub.track(blob_url=OTHER_BLOB_URL, cancel_event=other_cancel_event):
+        hub.on_group_message(event=cancel_message(blob_url=BLOB_URL))
+        assert cancel_event.is_set()
+        assert not other_cancel_event.is_set()
+    assert hub.jobs == dict()
+    # the cancel requests arriving once the job has finished are dropped
+    cancel_event.clear()
+    hub.on_group_message(event=cancel_message(blob_url=BLOB_URL))
+    assert not cancel_event.is_set()
+
+
+def test_concurrent_senders_reconnect_once():
+    hub = PubSubHub()
+    hub.client = FakeClient(connected=False)
+    opened = list()
+
+    def open_connection():
+        time.sleep(0.1)
+        hub.client = FakeClient()
+        opened.append(hub.client)
+
+    hub.open = open_connection
+    hub.close = lambda: None
+    barrier = threading.Barrier(8)
+
+    def send(n):
+        barrier.wait()
+        hub.send_to_group('group', content=json.dumps(dict(n=n)), data_type=WebPubSubDataType.JSON)
+
+    senders = [threading.Thread(target=send, args=(n,)) for n in range(8)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join(5)
+    assert len(opened) == 1
+    assert hub.generation == 1
+    assert len(opened[0].sent) == 8
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import pytest
+
+from ingest.ingest_exceptions import MessageLockLostError
+from ingest.queues import LocalQueue, MessageQueue
+
+
+def local_queue(tmp_path, **kwargs) -> LocalQueue:
+    return LocalQueue(path=str(tmp_path / 'queue.sqlite'), poll_interval=0.01, **kwargs)
+
+
+def test_message_queue_is_abstract():
+    with pytest.raises(TypeError):
+        MessageQueue()
+
+
+def test_received_message_is_locked_until_settled(tmp_path):
+    async def run():
+        async with local_queue(tmp_path, lock_seconds=60) as queue:
+            await queue.send_messages(bodies=['a', 'b'])
+            first, = await queue.receive_messages(max_message_count=1)
+            assert (str(first), first.delivery_count) == ('a', 1)
+            second, = await queue.receive_messages(max_message_count=5)
+            assert str(second) == 'b'
+            # both are locked
+            assert await queue.receive_messages(max_message_count=5) == []
+            await queue.complete_message(first)
+            await queue.abandon_message(second)
+            again, = await queue.receive_messages(max_message_count=5)
+            assert (str(again), again.delivery_count) == ('b', 2)
+            await queue.dead_letter_message(again, reason='test', error_description='failed')
+            assert await queue.receive_messages(max_message_count=5) == []
+            assert queue.stats()['counts'] == dict(completed=1, deadlettered=1)
+
+    asyncio.run(run())
+
+
+def test_renewed_lock_keeps_the_message(tmp_path):
+    async def run():
+        async with local_queue(tmp_path, lock_seconds=0.3) as queue:
+            await queue.send_messages(bodies=['a'])
+            message, = await queue.receive_messages()
+            locked_until = message.locked_until
+            await asyncio.sleep(0.2)
+            await queue.renew_message_lock(message)
+            assert message.locked_until > locked_until
+            await asyncio.sleep(0.2)
+            assert await queue.receive_messages() == []
+            await queue.complete_message(message)
+
+    asyncio.run(run())
+
+
+def test_expired_lock_is_lost_and_the_message_delivered_again(tmp_path):
+    async def run():
+        async with local_queue(tmp_path, lock_seconds=0.1) as queue:
+            await queue.send_messages(bodies=['a'])
+            message, = await queue.receive_messages()
+            await asyncio.sleep(0.15)
+            redelivered, = await queue.receive_messages()
+            assert redelivered.delivery_count == 2
+            with pytest.raises(MessageLockLostError):
+                await queue.complete_message(message)
+            await queue.complete_message(redelivered)
+
+    asyncio.run(run())
+
+
+def test_message_is_dead_lettered_after_max_delivery_count(tmp_path):
+    async def run():
+        async with local_queue(tmp_path, lock_seconds=0.05, max_delivery_count=2) as queue:
+            await queue.send_messages(bodies=['a'])
+            for delivery_count in (1, 2):
+                message, = await queue.receive_messages()
+                assert message.delivery_count == delivery_count
+                await asyncio.sleep(0.1)
+            assert await queue.receive_messages() == []
+            assert queue.stats()['counts'] == dict(deadlettered=1)
+
+    asyncio.run(run())
+
+
+def test_receive_waits_for_a_message(tmp_path):
+    async def run():
+        async with local_queue(tmp_path) as queue:
+            started = time.monotonic()
+            assert await queue.receive_messages(max_wait_time=0.1) == []
+            assert time.monotonic() - started >= 0.1
+            receiving = asyncio.ensure_future(queue.receive_messages(max_wait_time=5))
+            await asyncio.sleep(0.05)
+            await queue.send_messages(bodies=['a'])
+            message, = await asyncio.wait_for(receiving, 1)
+            assert str(message) == 'a'
+
+    asyncio.run(run())
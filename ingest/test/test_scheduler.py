@@ -0,0 +1,213 @@
+import asyncio
+
+from ingest.admission import MB
+from ingest.scheduler import JobScheduler, job_cost
+
+
+def run_test(test):
+    asyncio.run(asyncio.wait_for(test(), 5))
+
+
+async def start_jobs(scheduler: JobScheduler = None, jobs: list = None, started: list = None) -> dict:
+    """
+    Queue the (blob_path, size) jobs in order, every job appends its blob_path to started once it gets a slot
+    @return: dict of the blob paths and the tasks of their jobs
+    """
+    async def job(blob_path, size):
+        lane = await scheduler.acquire(blob_path=blob_path, size=size)
+        started.append(blob_path)
+        return lane
+
+    tasks = dict()
+    for blob_path, size in jobs:
+        tasks[blob_path] = asyncio.ensure_future(job(blob_path, size))
+        await asyncio.sleep(0)
+    return tasks
+
+
+async def finish(scheduler: JobScheduler = None, tasks: dict = None, blob_path: str = None):
+    """
+    Release the slot of the started job of blob_path
+    """
+    scheduler.release(lane=await tasks[blob_path], blob_path=blob_path)
+    await asyncio.sleep(0)
+
+
+def test_job_cost_weights_the_size_with_the_disk_factor():
+    assert job_cost(blob_path='c/u/raw/a.zip', size=MB) == 6 * MB
+    assert job_cost(blob_path='c/u/raw/a.tif', size=MB) == 2.5 * MB
+    assert job_cost(blob_path='c/u/raw/a.tif', size=None) == 0
+
+
+def test_shortest_job_first():
+    async def run():
+        scheduler = JobScheduler(slots=1, aging_rate=MB)
+        started = list()
+        jobs = [('c/u/raw/running.gpkg', MB), ('c/u/raw/large.gpkg', 100 * MB), ('c/u/raw/small.gpkg', MB),
+                ('c/u/raw/medium.gpkg', 10 * MB)]
+        tasks = await start_jobs(scheduler=scheduler, jobs=jobs, started=started)
+        assert started == ['c/u/raw/running.gpkg']
+        assert scheduler.must_wait(blob_path='c/u/raw/b.gpkg', size=MB)
+        for n in range(len(jobs)):
+            await finish(scheduler=scheduler, tasks=tasks, blob_path=started[n])
+        assert started == ['c/u/raw/running.gpkg', 'c/u/raw/small.gpkg', 'c/u/raw/medium.gpkg', 'c/u/raw/large.gpkg']
+        assert not scheduler.must_wait(blob_path='c/u/raw/b.gpkg', size=MB)
+
+    run_test(run)
+
+
+def test_waiting_job_ages_past_the_smaller_jobs():
+    async def run():
+        # every second waited is worth 1000 MB of cost
+        scheduler = JobScheduler(slots=1, aging_rate=1000 * MB)
+        started = list()
+        jobs = [('c/u/raw/running.gpkg', MB), ('c/u/raw/large.gpkg', 10 * MB)]
+        tasks = await start_jobs(scheduler=scheduler, jobs=jobs, started=started)
+        await asyncio.sleep(0.2)
+        tasks.update(await start_jobs(scheduler=scheduler, jobs=[('c/u/raw/small.gpkg', MB)], started=started))
+        await finish(scheduler=scheduler, tasks=tasks, blob_path='c/u/raw/running.gpkg')
+        assert started == ['c/u/raw/running.gpkg', 'c/u/raw/large.gpkg']
+        tasks['c/u/raw/small.gpkg'].cancel()
+
+    run_test(run)
+
+
+def test_heavy_lane_does_not_hold_up_the_small_jobs():
+    async def run():
+        scheduler = JobScheduler(slots=1, heavy_slots=1, heavy_threshold=100 * MB, aging_rate=MB)
+        assert scheduler.capacity == 2
+        started = list()
+        jobs = [('c/u/raw/huge1.tif', 500 * MB), ('c/u/raw/huge2.tif', 500 * MB), ('c/u/raw/small.tif', MB)]
+        tasks = await start_jobs(scheduler=scheduler, jobs=jobs, started=started)
+        assert started == ['c/u/raw/huge1.tif', 'c/u/raw/small.tif']
+        assert [job.blob_path for job in scheduler.waiting_jobs()] == ['c/u/raw/huge2.tif']
+        assert (await tasks['c/u/raw/huge1.tif']).name == 'heavy'
+        assert (await tasks['c/u/raw/small.tif']).name == 'normal'
+        await finish(scheduler=scheduler, tasks=tasks, blob_path='c/u/raw/huge1.tif')
+        assert started[-1] == 'c/u/raw/huge2.tif'
+
+    run_test(run)
+
+
+def test_cancelled_waiting_job_is_dropped():
+    async def run():
+        scheduler = JobScheduler(slots=1, aging_rate=MB)
+        started = list()
+        jobs = [('c/u/raw/running.gpkg', MB), ('c/u/raw/cancelled.gpkg', MB), ('c/u/raw/next.gpkg', 2 * MB)]
+        tasks = await start_jobs(scheduler=scheduler, jobs=jobs, started=started)
+        tasks['c/u/raw/cancelled.gpkg'].cancel()
+        await asyncio.sleep(0)
+        assert scheduler.users['u'].waiting == 1
+        await finish(scheduler=scheduler, tasks=tasks, blob_path='c/u/raw/running.gpkg')
+        assert started == ['c/u/raw/running.gpkg', 'c/u/raw/next.gpkg']
+        assert scheduler.lanes['normal'].running == 1
+
+    run_test(run)
+
+
+def test_users_share_the_workers_fairly():
+    async def run():
+        scheduler = JobScheduler(slots=1, aging_rate=MB)
+        started = list()
+        bulk = [(f'c/bulk/raw/{n}.gpkg', MB) for n in range(4)]
+        tasks = await start_jobs(scheduler=scheduler, jobs=bulk, started=started)
+        tasks.update(await start_jobs(scheduler=scheduler, jobs=[('c/other/raw/a.gpkg', MB)], started=started))
+        for n in range(5):
+            await finish(scheduler=scheduler, tasks=tasks, blob_path=started[n])
+        # the user arriving behind a bulk upload starts level with it (the tie goes to the job queued first) and is
+        # served next instead of after the whole bulk
+        assert started == ['c/bulk/raw/0.gpkg', 'c/bulk/raw/1.gpkg', 'c/other/raw/a.gpkg', 'c/bulk/raw/2.gpkg',
+                           'c/bulk/raw/3.gpkg']
+        assert scheduler.stats()['bulk']['started'] == 4
+
+    run_test(run)
+
+
+def test_user_weights_share_the_workers_in_proportion():
+    async def run():
+        scheduler = JobScheduler(slots=1, aging_rate=MB, user_weights=dict(heavy=3))
+        started = list()
+        jobs = [(f'c/{user}/raw/{n}.gpkg', MB) for n in range(8) for user in ('heavy', 'light')]
+        tasks = await start_jobs(scheduler=scheduler, jobs=jobs, started=started)
+        for n in range(8):
+            await finish(scheduler=scheduler, tasks=tasks, blob_path=started[n])
+        users = [blob_path.split('/')[1] for blob_path in started[:8]]
+        assert users.count('heavy') == 6
+        for task in tasks.values():
+            task.cancel()
+
+    run_test(run)
+
+
+def test_max_jobs_per_user_leaves_the_workers_to_the_others():
+    async def run():
+        scheduler = JobScheduler(slots=3, aging_rate=MB, max_jobs_per_user=2)
+        started = list()
+        bulk = [(f'c/bulk/raw/{n}.gpkg', MB) for n in range(4)]
+        tasks = await start_jobs(scheduler=scheduler, jobs=bulk, started=started)
+        # nobody else is waiting, the cap does not hold the free worker back
+        assert started == ['c/bulk/raw/0.gpkg', 'c/bulk/raw/1.gpkg', 'c/bulk/raw/2.gpkg']
+        tasks.update(await start_jobs(scheduler=scheduler, jobs=[('c/other/raw/a.gpkg', MB)], started=started))
+        assert 'c/other/raw/a.gpkg' not in started
+        await finish(scheduler=scheduler, tasks=tasks, blob_path='c/bulk/raw/0.gpkg')
+        # bulk still has 2 jobs running, the freed worker goes to the other user ahead of the older bulk/3
+        assert started[-1] == 'c/other/raw/a.gpkg'
+        await finish(scheduler=scheduler, tasks=tasks, blob_path='c/bulk/raw/1.gpkg')
+        assert started[-1] == 'c/bulk/raw/3.gpkg'
+        assert scheduler.users['bulk'].running == 2
+
+    run_test(run)
+
+
+def test_max_jobs_per_user_does_not_idle_the_workers_of_a_single_user():
+    async def run():
+        scheduler = JobScheduler(slots=4, aging_rate=MB, max_jobs_per_user=2)
+        started = list()
+        jobs = [(f'c/bulk/raw/{n}.gpkg', MB) for n in range(5)]
+        tasks = await start_jobs(scheduler=scheduler, jobs=jobs, started=started)
+        assert len(started) == 4
+        assert scheduler.users['bulk'].running == 4
+        await finish(scheduler=scheduler, tasks=tasks, blob_path='c/bulk/raw/0.gpkg')
+        assert started[-1] == 'c/bulk/raw/4.gpkg'
+
+    run_test(run)
+
+
+def test_idle_users_are_forgotten():
+    async def run():
+        scheduler = JobScheduler(slots=1, aging_rate=MB, user_retention=0)
+        started = list()
+        jobs = [('c/early/raw/a.gpkg', MB), ('c/late/raw/a.gpkg', MB)]
+        tasks = await start_jobs(scheduler=scheduler, jobs=jobs, started=started)
+        await finish(scheduler=scheduler, tasks=tasks, blob_path='c/early/raw/a.gpkg')
+        # late is running, early has nothing left
+        assert list(scheduler.stats()) == ['late']
+        await finish(scheduler=scheduler, tasks=tasks, blob_path='c/late/raw/a.gpkg')
+        assert scheduler.stats() == dict()
+
+    run_test(run)
+
+
+def test_user_becoming_active_does_not_cash_in_its_idle_time():
+    async def run():
+        scheduler = JobScheduler(slots=1, aging_rate=MB)
+        started = list()
+        tasks = await start_jobs(scheduler=scheduler, jobs=[('c/early/raw/a.gpkg', MB)], started=started)
+        await finish(scheduler=scheduler, tasks=tasks, blob_path='c/early/raw/a.gpkg')
+        bulk = [(f'c/bulk/raw/{n}.gpkg', MB) for n in range(6)]
+        tasks = await start_jobs(scheduler=scheduler, jobs=bulk, started=started)
+        for n in range(1, 4):
+            await finish(scheduler=scheduler, tasks=tasks, blob_path=started[n])
+        # early starts level with bulk, its virtual time is raised to the one of the active user
+        assert scheduler.users['early'].virtual_time < scheduler.users['bulk'].virtual_time
+        early = [('c/early/raw/b.gpkg', MB), ('c/early/raw/c.gpkg', MB)]
+        tasks.update(await start_jobs(scheduler=scheduler, jobs=early, started=started))
+        assert scheduler.users['early'].virtual_time == scheduler.users['bulk'].virtual_time
+        for n in range(4, 7):
+            await finish(scheduler=scheduler, tasks=tasks, blob_path=started[n])
+        # early alternates with bulk instead of running both of its jobs first
+        assert started[5:] == ['c/bulk/raw/4.gpkg', 'c/early/raw/b.gpkg', 'c/bulk/raw/5.gpkg']
+        for task in tasks.values():
+            task.cancel()
+
+    run_test(run)
@@ -0,0 +1,101 @@
+import threading
+import types
+import uuid
+
+from azure.core.exceptions import HttpResponseError
+
+from ingest.transfer import MB, MIN_BLOCK, TransferController, is_throttled, remembered, upload_block_size
+
+
+def controller(tmp_path, **kwargs) -> TransferController:
+    # every test uses an account of its own, the remembered settings are shared by the process
+    return TransferController(account=uuid.uuid4().hex, direction='download',
+                              state_path=str(tmp_path / 'transfer.json'), **kwargs)
+
+
+def test_throughput_gains_add_one_request_and_losses_remove_one(tmp_path):
+    transfer = controller(tmp_path, concurrency=4, max_concurrency=6)
+    transfer.adjust(throughput=100 * MB)
+    assert transfer.limit == 5
+    transfer.adjust(throughput=110 * MB)
+    assert transfer.limit == 6
+    # capped at max_concurrency
+    transfer.adjust(throughput=200 * MB)
+    assert transfer.limit == 6
+    # within 5% is not an improvement, within 20% not a loss
+    transfer.adjust(throughput=205 * MB)
+    transfer.adjust(throughput=170 * MB)
+    assert transfer.limit == 6
+    transfer.adjust(throughput=100 * MB)
+    assert transfer.limit == 5
+    assert transfer.best == dict(concurrency=6, throughput=205 * MB)
+
+
+def test_throttling_halves_the_requests_once_per_window(tmp_path):
+    transfer = controller(tmp_path, concurrency=16, max_concurrency=32, min_concurrency=3)
+    transfer.throttled()
+    transfer.throttled()
+    assert transfer.limit == 8
+    assert transfer.throttled_count == 2
+    # the throughput of a throttled window does not raise the limit
+    transfer.adjust(throughput=500 * MB)
+    assert transfer.limit == 8
+    assert transfer.best is None
+    transfer.throttled()
+    assert transfer.limit == 4
+    transfer.adjust(throughput=500 * MB)
+    transfer.throttled()
+    assert transfer.limit == 3
+
+
+def test_acquire_blocks_beyond_the_limit_until_stopped(tmp_path):
+    transfer = controller(tmp_path, concurrency=2, window=3600)
+    assert transfer.acquire()
+    assert transfer.acquire()
+    stop_event = threading.Event()
+    stop_event.set()
+    assert not transfer.acquire(stop_event=stop_event)
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: transfer.acquire() and acquired.set())
+    thread.start()
+    assert not acquired.wait(0.3)
+    transfer.release(nbytes=MB)
+    assert acquired.wait(1)
+    thread.join()
+    assert transfer.active == 2
+
+
+def test_close_remembers_the_best_settings_for_the_next_transfer(tmp_path):
+    transfer = controller(tmp_path, concurrency=4, max_concurrency=16)
+    transfer.adjust(throughput=100 * MB)
+    transfer.adjust(throughput=50 * MB)
+    transfer.close()
+    assert remembered(account=transfer.account, direction='download') == dict(concurrency=4, throughput=100 * MB)
+    following = TransferController(account=transfer.account, direction='download', concurrency=8,
+                                   state_path=transfer.state_path)
+    assert following.limit == 4
+
+
+def test_throttled_transfer_remembers_the_limit_it_ended_with(tmp_path):
+    transfer = controller(tmp_path, concurrency=8)
+    transfer.adjust(throughput=100 * MB)
+    transfer.throttled()
+    transfer.close()
+    assert remembered(account=transfer.account, direction='download')['concurrency'] == 4
+
+
+def test_is_throttled():
+    assert is_throttled(response=types.SimpleNamespace(status_code=503, headers={}))
+    assert is_throttled(response=types.SimpleNamespace(status_code=429, headers={}))
+    assert is_throttled(response=types.SimpleNamespace(status_code=500, headers={'x-ms-error-code': 'ServerBusy'}))
+    assert not is_throttled(response=types.SimpleNamespace(status_code=404, headers={}))
+    assert not is_throttled(error=IOError('connection reset'))
+    error = HttpResponseError(message='busy')
+    error.error_code = 'ServerBusy'
+    assert is_throttled(error=error)
+
+
+def test_upload_block_size_depends_only_on_the_file_size():
+    assert upload_block_size(size=MB, max_block_size=100 * MB) == MIN_BLOCK
+    assert upload_block_size(size=1024 * MB, max_block_size=100 * MB) == 16 * MB
+    assert upload_block_size(size=100 * 1024 * MB, max_block_size=100 * MB) == 100 * MB
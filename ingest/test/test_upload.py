@@ -0,0 +1,121 @@
+import json
+import os
+import threading
+import types
+
+import pytest
+
+from ingest.transfer import TransferController
+from ingest.upload import MB, BlockUploader
+
+
+class FakeBlobClient:
+    """
+    Keeps the staged and committed blocks of a block blob in memory, failing the staging of the blocks listed in
+    fail_blocks
+    """
+
+    def __init__(self, fail_blocks: set = None):
+        self.url = 'https://test.blob.core.windows.net/c/a.pmtiles'
+        self.account_name = 'test'
+        self.fail_blocks = fail_blocks or set()
+        self.uncommitted = dict()
+        self.staged_ids = list()
+        self.data = None
+        self.lock = threading.Lock()
+
+    def stage_block(self, block_id: str = None, data=None, length: int = None, **kwargs):
+        if int(block_id.split('-')[1]) in self.fail_blocks:
+            raise IOError('connection reset')
+        with self.lock:
+            self.uncommitted[block_id] = bytes(data)
+            self.staged_ids.append(block_id)
+
+    def get_block_list(self, block_list_type: str = None):
+        return [], [types.SimpleNamespace(id=block_id, size=len(data)) for block_id, data in self.uncommitted.items()]
+
+    def commit_block_list(self, blocks: list = None, **kwargs):
+        self.data = b''.join(self.uncommitted[block.id] for block in blocks)
+        self.uncommitted = dict()
+        return dict(etag='"0x1"')
+
+
+def uploader(src_path: str = None, client: FakeBlobClient = None, **kwargs) -> BlockUploader:
+    controller = TransferController(account='test', direction='upload', concurrency=4, max_concurrency=4,
+                                    state_path=None)
+    return BlockUploader(blob_client=client, src_path=src_path, block_size=MB, controller=controller, **kwargs)
+
+
+@pytest.fixture
+def src_path(tmp_path) -> str:
+    path = tmp_path / 'a.pmtiles'
+    path.write_bytes(os.urandom(10 * MB + 123))
+    return str(path)
+
+
+def test_blocks_are_staged_and_committed_in_order(src_path):
+    client = FakeBlobClient()
+    upload = uploader(src_path=src_path, client=client)
+    assert upload.nblocks == 11
+    assert len({len(upload.block_id(index)) for index in range(upload.nblocks)}) == 1
+    assert upload.run() == dict(etag='"0x1"')
+    with open(src_path, 'rb') as src:
+        assert client.data == src.read()
+    # the record is removed once the blocks are committed
+    assert not os.path.exists(upload.record_path)
+
+
+def test_failed_upload_resumes_from_the_staged_blocks(src_path, monkeypatch):
+    monkeypatch.setattr('ingest.upload.BACKOFF', 0.01)
+    client = FakeBlobClient(fail_blocks={7})
+    with pytest.raises(IOError):
+        uploader(src_path=src_path, client=client, attempts=2).run()
+    with open(f'{src_path}.blocks.json') as record:
+        staged = set(json.load(record)['staged'])
+    assert 7 not in staged and staged
+    client.fail_blocks = set()
+    client.staged_ids = list()
+    upload = uploader(src_path=src_path, client=client)
+    upload.run()
+    # only the blocks that were not staged by the failed attempt are staged again
+    assert {int(block_id.split('-')[1]) for block_id in client.staged_ids} == set(range(11)) - staged
+    with open(src_path, 'rb') as src:
+        assert client.data == src.read()
+
+
+def test_blocks_no_longer_on_the_blob_are_staged_again(src_path, monkeypatch):
+    monkeypatch.setattr('ingest.upload.BACKOFF', 0.01)
+    client = FakeBlobClient(fail_blocks={10})
+    with pytest.raises(IOError):
+        uploader(src_path=src_path, client=client, attempts=1).run()
+    # the uncommitted blocks expired on the blob
+    client.uncommitted = dict()
+    client.fail_blocks = set()
+    client.staged_ids = list()
+    uploader(src_path=src_path, client=client).run()
+    assert len(client.staged_ids) == 11
+
+
+def test_blocks_of_a_modified_file_are_not_resumed(src_path, monkeypatch):
+    monkeypatch.setattr('ingest.upload.BACKOFF', 0.01)
+    client = FakeBlobClient(fail_blocks={10})
+    with pytest.raises(IOError):
+        uploader(src_path=src_path, client=client, attempts=1).run()
+    with open(src_path, 'r+b') as src:
+        src.write(b'changed')
+    os.utime(src_path, ns=(0, os.stat(src_path).st_mtime_ns + 10 ** 9))
+    client.fail_blocks = set()
+    client.staged_ids = list()
+    uploader(src_path=src_path, client=client).run()
+    assert len(client.staged_ids) == 11
+    with open(src_path, 'rb') as src:
+        assert client.data == src.read()
+
+
+def test_empty_file_is_committed_as_one_empty_block(tmp_path):
+    path = tmp_path / 'empty.fgb'
+    path.write_bytes(b'')
+    client = FakeBlobClient()
+    uploader(src_path=str(path), client=client).run()
+    assert client.data == b''
+    assert len(client.staged_ids) == 1
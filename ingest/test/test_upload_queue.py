@@ -0,0 +1,117 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+import pytest
+
+from ingest.upload_queue import UploadQueue, with_upload_queue
+
+
+class FakeUploads:
+    """
+    Replaces azblob.upload_blob, every upload waits for release and the uploads of the blob paths in failing fail
+    """
+
+    def __init__(self, failing: set = None):
+        self.failing = failing or set()
+        self.release = threading.Event()
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def upload_blob(self, src_path=None, connection_string=None, container_name=None, dst_blob_path=None):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            self.release.wait(5)
+            if dst_blob_path in self.failing:
+                raise IOError(f'failed to upload {dst_blob_path}')
+            return f'etag-{dst_blob_path}'
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+@pytest.fixture
+def uploads(monkeypatch) -> FakeUploads:
+    uploads = FakeUploads()
+    monkeypatch.setattr('ingest.upload_queue.upload_blob', uploads.upload_blob)
+    return uploads
+
+
+def output(tmp_path, name: str = None) -> str:
+    path = tmp_path / name
+    path.write_bytes(b'data')
+    return str(path)
+
+
+def test_submit_blocks_once_max_pending_uploads_are_queued(tmp_path, uploads):
+    with UploadQueue(workers=2, max_pending=3) as queue:
+        for n in range(3):
+            queue.submit(src_path=output(tmp_path, f'{n}.fgb'), dst_blob_path=f'{n}.fgb')
+        blocked = threading.Thread(target=queue.submit,
+                                   kwargs=dict(src_path=output(tmp_path, '3.fgb'), dst_blob_path='3.fgb'))
+        blocked.start()
+        blocked.join(0.2)
+        assert blocked.is_alive()
+        uploads.release.set()
+        blocked.join(5)
+        assert not blocked.is_alive()
+    assert uploads.max_running == 2
+    # the local files are removed once uploaded
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_when_done_is_called_once_the_outputs_are_uploaded(tmp_path, uploads):
+    uploads.failing = {'b.fgb'}
+    settled = list()
+    with UploadQueue(workers=2, max_pending=4) as queue:
+        outputs = {name: queue.submit(src_path=output(tmp_path, name), dst_blob_path=name)
+                   for name in ('a.pmtiles', 'b.fgb')}
+        outputs['c.tif'] = 'etag-c.tif'
+        queue.when_done(outputs=outputs, callback=lambda etags, error: settled.append((etags, error)))
+        time.sleep(0.1)
+        assert settled == []
+        uploads.release.set()
+        queue.wait()
+        etags, error = settled[0]
+    assert etags == {'a.pmtiles': 'etag-a.pmtiles', 'c.tif': 'etag-c.tif'}
+    assert isinstance(error, IOError)
+
+
+def test_cancel_drops_the_uploads_that_have_not_started(tmp_path, uploads):
+    settled = list()
+    with UploadQueue(workers=1, max_pending=4) as queue:
+        outputs = {name: queue.submit(src_path=output(tmp_path, name), dst_blob_path=name)
+                   for name in ('a.pmtiles', 'b.fgb', 'c.tif')}
+        queue.when_done(outputs=outputs, callback=lambda etags, error: settled.append((etags, error)))
+        deadline = time.monotonic() + 5
+        while not uploads.running and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert queue.cancel() == 2
+        assert outputs['b.fgb'].cancelled() and outputs['c.tif'].cancelled()
+        assert sorted(path.name for path in tmp_path.iterdir()) == ['a.pmtiles']
+        # the upload in flight is waited for
+        uploads.release.set()
+        queue.wait()
+        assert outputs['a.pmtiles'].result() == 'etag-a.pmtiles'
+        etags, error = settled[0]
+    assert etags == {'a.pmtiles': 'etag-a.pmtiles'}
+    assert isinstance(error, concurrent.futures.CancelledError)
+    assert list(tmp_path.iterdir()) == []
+    assert queue.queued == dict()
+
+
+def test_with_upload_queue_uploads_before_returning(tmp_path, uploads):
+    uploads.release.set()
+
+    @with_upload_queue
+    def convert(name: str = None, uploads: UploadQueue = None) -> dict:
+        return {name: uploads.submit(src_path=output(tmp_path, name), dst_blob_path=name)}
+
+    assert convert(name='a.pmtiles') == {'a.pmtiles': 'etag-a.pmtiles'}
+    uploads.failing = {'b.pmtiles'}
+    assert convert(name='b.pmtiles') == {}
+    assert not os.path.exists(tmp_path / 'a.pmtiles')
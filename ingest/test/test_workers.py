@@ -0,0 +1,73 @@
+import asyncio
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from ingest.workers import ProcessPool, WorkerJobError, WorkerKilledError
+
+
+def run_test(test):
+    asyncio.run(asyncio.wait_for(test(), 60))
+
+
+def worker_pid(**kwargs) -> int:
+    return os.getpid()
+
+
+def run_forever(**kwargs):
+    while True:
+        time.sleep(0.1)
+
+
+def fail(**kwargs):
+    raise ValueError('failed in the worker')
+
+
+def is_alive(pid: int = None) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # a killed worker stays a zombie until it has been joined
+    with open(f'/proc/{pid}/stat') as stat:
+        return stat.read().split(')')[-1].split()[0] != 'Z'
+
+
+def test_cancelled_job_kills_and_replaces_the_worker():
+    async def run():
+        async with ProcessPool(size=1, poll_interval=0.05) as pool:
+            pid = await pool.run(func=worker_pid)
+            cancel_event = multiprocessing.Event()
+            job = asyncio.ensure_future(pool.run(func=run_forever, cancel_event=cancel_event))
+            await asyncio.sleep(0.5)
+            cancel_event.set()
+            with pytest.raises(WorkerKilledError):
+                await job
+            assert not is_alive(pid)
+            new_pid = await pool.run(func=worker_pid)
+            assert new_pid != pid
+
+    run_test(run)
+
+
+def test_worker_is_recycled_after_max_jobs():
+    async def run():
+        async with ProcessPool(size=1, max_jobs=2, poll_interval=0.05) as pool:
+            pids = [await pool.run(func=worker_pid) for _ in range(3)]
+            assert pids[0] == pids[1]
+            assert pids[2] != pids[0]
+
+    run_test(run)
+
+
+def test_job_error_keeps_the_worker():
+    async def run():
+        async with ProcessPool(size=1, poll_interval=0.05) as pool:
+            pid = await pool.run(func=worker_pid)
+            with pytest.raises(WorkerJobError, match='failed in the worker'):
+                await pool.run(func=fail)
+            assert await pool.run(func=worker_pid) == pid
+
+    run_test(run)
@@ -0,0 +1,314 @@
+import argparse
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+
+from ingest.config import (
+    INGEST_TRANSFER_MAX_CONCURRENCY,
+    INGEST_TRANSFER_STATE_PATH,
+    INGEST_UPLOAD_BLOCK_MB
+)
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# the responses of a throttled storage account
+THROTTLING_STATUS_CODES = (429, 503)
+THROTTLING_ERROR_CODES = ('ServerBusy',)
+# the smallest block of an upload, the blocks are sized to have at least TARGET_BLOCKS blocks per file
+MIN_BLOCK = 4 * MB
+TARGET_BLOCKS = 64
+# the well known connection string of the Azurite storage emulator, the benchmark runs against it by default
+AZURITE_CONNECTION_STRING = (
+    'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;'
+    'AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;'
+    'BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;'
+)
+
+_lock = threading.Lock()
+# (account, direction) -> dict(concurrency, throughput), the best settings of every storage account
+_settings = dict()
+
+
+def settings_key(account: str = None, direction: str = None) -> str:
+    return f'{account}:{direction}'
+
+
+def remembered(account: str = None, direction: str = None, path: str = None) -> dict:
+    """
+    The best settings of the transfers in direction (upload, download) to/from the storage account, read from the
+    state file shared by the processes of the pod when this process has none
+    """
+    key = settings_key(account=account, direction=direction)
+    with _lock:
+        if key not in _settings and path:
+            try:
+                with open(path) as state:
+                    _settings.update({k: v for k, v in json.load(state).items() if k not in _settings})
+            except (OSError, ValueError):
+                pass
+        return _settings.get(key)
+
+
+def remember(account: str = None, direction: str = None, settings: dict = None, path: str = None):
+    """
+    Keep the best settings of a storage account and write them to the state file
+    """
+    key = settings_key(account=account, direction=direction)
+    with _lock:
+        _settings[key] = settings
+        if not path:
+            return
+        try:
+            try:
+                with open(path) as state:
+                    merged = json.load(state)
+            except (OSError, ValueError):
+                merged = dict()
+            merged[key] = settings
+            with open(f'{path}.{os.getpid()}.tmp', 'w') as state:
+                json.dump(merged, state)
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+        except OSError as e:
+            logger.error(f'Failed to write the transfer settings to {path}: {e}')
+
+
+def is_throttled(response=None, error: Exception = None) -> bool:
+    """
+    Whether a response or an error tells the storage account is throttling its clients
+    """
+    if error is not None:
+        if not isinstance(error, HttpResponseError):
+            return False
+        response = error.response
+        if getattr(error, 'error_code', None) in THROTTLING_ERROR_CODES:
+            return True
+    if response is None:
+        return False
+    return response.status_code in THROTTLING_STATUS_CODES or \
+        response.headers.get('x-ms-error-code') in THROTTLING_ERROR_CODES
+
+
+def upload_block_size(size: int = None, max_block_size: int = INGEST_UPLOAD_BLOCK_MB * MB) -> int:
+    """
+    The size of the blocks a file of size bytes is uploaded with. It only depends on the size of the file so an
+    upload attempted again stages the same blocks
+    """
+    return min(max(MIN_BLOCK, math.ceil(size / TARGET_BLOCKS / MB) * MB), max(max_block_size, MIN_BLOCK))
+
+
+class TransferController:
+    """
+    Controls how many requests of a transfer (the ranges of a download, the blocks of an upload) are in flight with
+    AIMD, like TCP congestion control:
+
+    - the throughput is measured every window seconds. While it keeps improving by more than 5% one more request is
+      allowed in flight (additive increase). When it drops by more than 20% one less is.
+    - a throttled request (503/ServerBusy, 429) halves the requests in flight (multiplicative decrease), at most once
+      per window. The ranges and blocks are retried by the transfers, which report the throttled requests with
+      observe. The operations left to the retries of the SDK report them through retry_hook.
+
+    The transfer starts as many streams as the size of the transfer can use, up to max_concurrency, and every stream
+    takes a slot with acquire before each request. The number of requests in flight that gave the best throughput is
+    remembered per storage account and direction (see remembered) and the next transfer starts with it.
+    """
+
+    def __init__(self, account: str = None, direction: str = None, concurrency: int = 8, min_concurrency: int = 1,
+                 max_concurrency: int = INGEST_TRANSFER_MAX_CONCURRENCY, window: float = 2,
+                 state_path: str = INGEST_TRANSFER_STATE_PATH):
+        self.account = account
+        self.direction = direction
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(max_concurrency, min_concurrency)
+        self.window = window
+        self.state_path = state_path
+        best = remembered(account=account, direction=direction, path=state_path)
+        if best:
+            concurrency = best['concurrency']
+        self.limit = min(max(concurrency, self.min_concurrency), self.max_concurrency)
+        self.condition = threading.Condition()
+        self.active = 0
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_throttled = False
+        self.last_throughput = None
+        self.best = None
+        self.throttled_count = 0
+
+    @classmethod
+    def for_client(cls, client=None, direction: str = None, concurrency: int = 8):
+        """
+        @param client: the blob client of the transfer, its storage account keys the remembered settings
+        """
+        return cls(account=client.account_name, direction=direction, concurrency=concurrency)
+
+    def streams(self, size: int = None, unit: int = None) -> int:
+        """
+        The number of streams a transfer of size bytes in parts of at least unit bytes can keep busy
+        """
+        return max(1, min(self.max_concurrency, math.ceil(size / unit)))
+
+    def acquire(self, stop_event: threading.Event = None) -> bool:
+        """
+        Wait for a free slot
+        @return: False if stop_event was set while waiting
+        """
+        with self.condition:
+            while self.active >= self.limit:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                self.condition.wait(0.2)
+            self.active += 1
+            return True
+
+    def release(self, nbytes: int = 0):
+        """
+        Free the slot of a finished request that transferred nbytes
+        """
+        with self.condition:
+            self.active -= 1
+            self.window_bytes += nbytes
+            elapsed = time.monotonic() - self.window_start
+            if elapsed >= self.window:
+                self.adjust(throughput=self.window_bytes / elapsed)
+            self.condition.notify_all()
+
+    def adjust(self, throughput: float = None):
+        """
+        Update the limit at the end of a window, called with the condition held
+        """
+        if not self.window_throttled:
+            if self.best is None or throughput > self.best['throughput']:
+                self.best = dict(concurrency=self.limit, throughput=throughput)
+            if self.last_throughput is None or throughput > self.last_throughput * 1.05:
+                self.limit = min(self.limit + 1, self.max_concurrency)
+            elif throughput < self.last_throughput * 0.8:
+                self.limit = max(self.limit - 1, self.min_concurrency)
+        logger.debug(f'{self.direction} throughput {throughput / MB:.1f} MiB/s, {self.limit} requests in flight')
+        self.last_throughput = throughput
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_throttled = False
+
+    def throttled(self):
+        with self.condition:
+            self.throttled_count += 1
+            if self.window_throttled:
+                return
+            self.window_throttled = True
+            self.limit = max(self.limit // 2, self.min_concurrency)
+            logger.info(f'{self.account} is throttling the {self.direction}, {self.limit} requests in flight')
+
+    def retry_hook(self, response=None, error: Exception = None, **kwargs):
+        """
+        Passed as retry_hook to the SDK operations, called before a failed request is retried
+        """
+        if is_throttled(response=response, error=error):
+            self.throttled()
+
+    def observe(self, error: Exception = None):
+        """
+        Account for a request that failed after the retries of the SDK
+        """
+        if is_throttled(error=error):
+            self.throttled()
+
+    def close(self):
+        """
+        Remember the settings that gave the best throughput, a throttled transfer remembers the limit it ended with
+        instead. A transfer shorter than a window has nothing to remember
+        """
+        with self.condition:
+            best = self.best
+            if self.throttled_count:
+                best = dict(concurrency=self.limit, throughput=self.last_throughput or 0)
+            if best is None:
+                return
+        remember(account=self.account, direction=self.direction, settings=best, path=self.state_path)
+
+
+def benchmark(conn_string: str = None, container_name: str = None, sizes: list = None, rounds: int = 3):
+    """
+    Upload and download files of sizes MiB rounds times with the transfer controller and print the throughput and
+    the settings it used, every round starts with the settings remembered by the previous one
+    """
+    from ingest.clients import blob_client, container_client
+    from ingest.download import download_blob_ranges
+    from ingest.upload import BlockUploader
+
+    try:
+        container_client(conn_string=conn_string, container_name=container_name).create_container()
+    except ResourceExistsError:
+        pass
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            src_path = os.path.join(temp_dir, f'{size}MiB.bin')
+            with open(src_path, 'wb') as src:
+                for _ in range(size):
+                    src.write(os.urandom(MB))
+            for n in range(1, rounds + 1):
+                dst_blob_client = blob_client(conn_string=conn_string, container_name=container_name,
+                                              blob_name=os.path.basename(src_path))
+                local_folder = tempfile.mkdtemp(dir=temp_dir)
+                try:
+                    upload_controller = TransferController.for_client(client=dst_blob_client, direction='upload')
+                    started = time.monotonic()
+                    uploader = BlockUploader(blob_client=dst_blob_client, src_path=src_path,
+                                             controller=upload_controller)
+                    uploader.run()
+                    upload_seconds = time.monotonic() - started
+                    download_controller = TransferController.for_client(client=dst_blob_client, direction='download')
+                    started = time.monotonic()
+                    download_blob_ranges(src_blob_path=f'{container_name}/{os.path.basename(src_path)}',
+                                         local_folder=local_folder, conn_string=conn_string,
+                                         controller=download_controller)
+                    download_seconds = time.monotonic() - started
+                finally:
+                    # the test blob is uploaded again by the next round
+                    try:
+                        dst_blob_client.delete_blob()
+                    except ResourceNotFoundError:
+                        pass
+                    shutil.rmtree(local_folder, ignore_errors=True)
+                print(json.dumps(dict(
+                    size_mb=size, round=n, block_mb=uploader.block_size / MB,
+                    upload_mb_s=round(size / upload_seconds, 1), upload_concurrency=upload_controller.limit,
+                    upload_throttled=upload_controller.throttled_count,
+                    download_mb_s=round(size / download_seconds, 1), download_concurrency=download_controller.limit,
+                    download_throttled=download_controller.throttled_count
+                )), flush=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('azure').setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description='Tools of the adaptive blob transfers',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    benchmark_parser = subparsers.add_parser('benchmark', help='Upload and download test files with the transfer '
+                                                               'controller, against Azurite by default')
+    benchmark_parser.add_argument('-c', '--connection-string', default=AZURITE_CONNECTION_STRING,
+                                  help='Connection string of the storage account')
+    benchmark_parser.add_argument('--container', default='transfer-benchmark', help='Container of the test files')
+    benchmark_parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1, 64, 512],
+                                  help='Sizes of the test files in MiB')
+    benchmark_parser.add_argument('-r', '--rounds', type=int, default=3, help='Transfers of every file')
+    subparsers.add_parser('settings', help='Print the remembered settings per storage account')
+    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+    if args.command == 'benchmark':
+        benchmark(conn_string=args.connection_string, container_name=args.container, sizes=args.sizes,
+                  rounds=args.rounds)
+    else:
+        try:
+            with open(INGEST_TRANSFER_STATE_PATH) as state:
+                print(json.dumps(json.load(state), indent=2))
+        except OSError:
+            print(f'No transfer settings in {INGEST_TRANSFER_STATE_PATH}')
@@ -0,0 +1,207 @@
+import contextvars
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import queue
+import random
+import threading
+import time
+
+from azure.core import MatchConditions
+from azure.storage.blob import BlobBlock, BlobClient
+
+from ingest.transfer import TransferController, upload_block_size
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# a block blob has at most MAX_BLOCKS blocks
+MAX_BLOCKS = 50000
+# the staged blocks are written to the record at most every RECORD_INTERVAL seconds
+RECORD_INTERVAL = 2
+# the backoff between the attempts to stage a block, doubled after every attempt
+BACKOFF = 0.5
+MAX_BACKOFF = 16
+
+
+class BlockUploader:
+    """
+    Uploads a large file as explicitly staged blocks (stage_block) committed at the end with commit_block_list, so
+    a transient failure costs the blocks in flight instead of the whole file.
+
+    The blocks are sized from the size of the file (see transfer.upload_block_size) and staged by threads, as many
+    at a time as the TransferController of the upload allows. Each block is a memoryview slice of the memory mapped
+    file sent without copying it into a Python buffer. A block that fails is retried with exponential backoff up to
+    attempts times while the other threads carry on. The staged blocks are recorded in a JSON file next to the
+    source file. When the upload fails anyway and is started again (see azblob.upload_blob) the blocks in the record
+    that are still uncommitted on the blob are not staged again.
+
+    The block ids include a key of the source file (size and modification time) and of the block size, the blocks
+    staged for another version of the file are never committed.
+    """
+
+    def __init__(self, blob_client: BlobClient = None, src_path: str = None, block_size: int = None,
+                 controller: TransferController = None, attempts: int = 5, progress_hook=None):
+        self.blob_client = blob_client
+        self.src_path = src_path
+        self.size = os.path.getsize(src_path)
+        block_size = block_size or upload_block_size(size=self.size)
+        self.block_size = max(block_size, math.ceil(self.size / MAX_BLOCKS / MB) * MB)
+        self.nblocks = max(1, math.ceil(self.size / self.block_size))
+        self.controller = controller or TransferController.for_client(client=blob_client, direction='upload')
+        self.concurrency = self.controller.streams(size=self.size, unit=self.block_size)
+        self.attempts = attempts
+        self.progress_hook = progress_hook
+        self.record_path = f'{src_path}.blocks.json'
+        stat = os.stat(src_path)
+        self.key = hashlib.md5(f'{self.size}:{stat.st_mtime_ns}:{self.block_size}'.encode()).hexdigest()[:16]
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.staged = set()
+        self.uploaded = 0
+        self.error = None
+        self.recorded_at = time.monotonic()
+
+    def block_id(self, index: int = None) -> str:
+        # the ids of the blocks of a blob must all have the same length
+        return f'{self.key}-{index:06d}'
+
+    def block_length(self, index: int = None) -> int:
+        return min(self.block_size, self.size - index * self.block_size)
+
+    def resume(self):
+        """
+        Load the blocks staged by a previous attempt that are still uncommitted on the blob
+        """
+        try:
+            with open(self.record_path) as record:
+                state = json.load(record)
+        except (OSError, ValueError):
+            return
+        if state.get('key') != self.key or state.get('blob') != self.blob_client.url:
+            return
+        try:
+            _, uncommitted = self.blob_client.get_block_list(block_list_type='uncommitted')
+        except Exception as e:
+            logger.info(f'Staging all the blocks of {self.src_path}, the uncommitted blocks could not be listed: {e}')
+            return
+        uncommitted = {block.id: block.size for block in uncommitted}
+        self.staged = {index for index in state.get('staged', [])
+                       if uncommitted.get(self.block_id(index)) == self.block_length(index)}
+        self.uploaded = sum(self.block_length(index) for index in self.staged)
+        if self.staged:
+            logger.info(f'Resuming the upload of {self.src_path}, {len(self.staged)} of {self.nblocks} blocks were '
+                        f'already staged')
+
+    def record(self, force: bool = False):
+        """
+        Write the staged blocks to the record, at most every RECORD_INTERVAL seconds unless forced
+        """
+        with self.lock:
+            if not force and time.monotonic() - self.recorded_at < RECORD_INTERVAL:
+                return
+            self.recorded_at = time.monotonic()
+            state = dict(key=self.key, blob=self.blob_client.url, staged=sorted(self.staged))
+        try:
+            with open(f'{self.record_path}.tmp', 'w') as record:
+                json.dump(state, record)
+            os.replace(f'{self.record_path}.tmp', self.record_path)
+        except OSError as e:
+            logger.error(f'Failed to write {self.record_path}: {e}')
+
+    def stage(self, view: memoryview = None, index: int = None):
+        """
+        Stage a block, retrying with exponential backoff
+        """
+        offset = index * self.block_size
+        length = self.block_length(index)
+        for attempt in range(1, self.attempts + 1):
+            try:
+                with view[offset:offset + length] as block:
+                    # retried here rather than by the SDK, see RangeDownloader.fetch_range
+                    self.blob_client.stage_block(self.block_id(index), block, length=length, retry_total=0)
+                return
+            except Exception as e:
+                self.controller.observe(error=e)
+                if attempt == self.attempts or self.stop_event.is_set():
+                    raise
+                delay = min(BACKOFF * 2 ** (attempt - 1), MAX_BACKOFF) * random.uniform(0.5, 1)
+                logger.info(f'Failed to stage block {index} of {self.src_path} in attempt no {attempt}: {e}. '
+                            f'Trying again in {delay:.1f} seconds... ')
+                if self.stop_event.wait(delay):
+                    raise
+
+    def worker(self, view: memoryview = None, pending: queue.SimpleQueue = None):
+        """
+        Stage the pending blocks until there are none left, runs in a thread of its own
+        """
+        try:
+            while self.controller.acquire(stop_event=self.stop_event):
+                try:
+                    index = pending.get_nowait()
+                except queue.Empty:
+                    self.controller.release()
+                    return
+                try:
+                    self.stage(view=view, index=index)
+                except Exception:
+                    self.controller.release()
+                    raise
+                self.controller.release(nbytes=self.block_length(index))
+                with self.lock:
+                    self.staged.add(index)
+                    self.uploaded += self.block_length(index)
+                    uploaded = self.uploaded
+                if self.progress_hook:
+                    self.progress_hook(uploaded, self.size)
+                self.record()
+        except Exception as e:
+            with self.lock:
+                self.error = self.error or e
+            self.stop_event.set()
+
+    def run(self, overwrite: bool = True) -> dict:
+        """
+        @return: dict, the properties of the committed blob (etag, last_modified)
+        """
+        try:
+            return self.upload(overwrite=overwrite)
+        finally:
+            self.controller.close()
+
+    def upload(self, overwrite: bool = True) -> dict:
+        self.resume()
+        pending = queue.SimpleQueue()
+        for index in range(self.nblocks):
+            if index not in self.staged:
+                pending.put(index)
+        if self.size:
+            with open(self.src_path, 'rb') as src, \
+                    mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                threads = list()
+                for n in range(self.concurrency):
+                    # the records logged by the threads belong to the log of the job
+                    context = contextvars.copy_context()
+                    thread = threading.Thread(target=context.run, args=(self.worker, view, pending),
+                                              name=f'upload-{n}', daemon=True)
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+            self.record(force=True)
+            if self.error:
+                raise self.error
+        else:
+            # an empty file is committed as one empty block
+            self.blob_client.stage_block(self.block_id(0), b'', length=0)
+        conditions = dict() if overwrite else dict(etag='*', match_condition=MatchConditions.IfMissing)
+        committed = self.blob_client.commit_block_list([BlobBlock(block_id=self.block_id(index))
+                                                        for index in range(self.nblocks)], **conditions)
+        try:
+            os.remove(self.record_path)
+        except OSError:
+            pass
+        return committed
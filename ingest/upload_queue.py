@@ -0,0 +1,202 @@
+import concurrent.futures
+import contextvars
+import functools
+import logging
+import os
+import shutil
+import threading
+
+from ingest.azblob import upload_blob
+from ingest.config import INGEST_UPLOAD_QUEUE_SIZE, INGEST_UPLOAD_QUEUE_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+class UploadQueue:
+    """
+    Uploads the outputs of a job (PMTiles, FlatGeobuf, COG files) in the background so the conversion of the next
+    unit starts as soon as the outputs of the previous one are written instead of waiting for their upload.
+
+    The uploads run in a pool of worker threads. At most max_pending outputs are queued or being uploaded, submit
+    blocks the conversion when there are more so the outputs waiting to be uploaded do not fill the disk. The local
+    file of an output is removed as soon as its upload has finished.
+
+    The outputs of a conversion are a dict of blob paths and the futures of their uploads. The work that depends on
+    the outputs being uploaded (the .ingesting blob, the checkpoint of the unit, the errors) is registered with
+    when_done. wait returns once every upload and every callback registered with when_done has finished, the job is
+    reported as processed after it. cancel drops the uploads that have not started (a cancelled job), their futures
+    are cancelled and their local files removed.
+    """
+
+    def __init__(self, workers: int = INGEST_UPLOAD_QUEUE_WORKERS, max_pending: int = INGEST_UPLOAD_QUEUE_SIZE):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1),
+                                                              thread_name_prefix='upload-queue')
+        self.slots = threading.Semaphore(max(max_pending, 1))
+        self.condition = threading.Condition()
+        # the uploads and the when_done callbacks that have not finished yet
+        self.outstanding = 0
+        # the futures of the uploads that have not finished and their (src_path, remove)
+        self.queued = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, src_path: str = None, connection_string: str = None, container_name: str = None,
+               dst_blob_path: str = None, remove: bool = True) -> concurrent.futures.Future:
+        """
+        Queue the upload of src_path to dst_blob_path, see azblob.upload_blob
+        @param remove: bool, remove src_path once it has been uploaded (or has failed to)
+        @return: instance of Future, its result is the ETag of the uploaded blob
+        """
+        self.slots.acquire()
+        with self.condition:
+            self.outstanding += 1
+        # the records logged by the workers belong to the log of the job
+        context = contextvars.copy_context()
+        try:
+            future = self.executor.submit(context.run, self.upload, src_path=src_path,
+                                          connection_string=connection_string, container_name=container_name,
+                                          dst_blob_path=dst_blob_path, remove=remove)
+        except Exception:
+            self.slots.release()
+            self.finished()
+            raise
+        with self.condition:
+            self.queued[future] = src_path, remove
+        future.add_done_callback(self.forget)
+        return future
+
+    def upload(self, src_path: str = None, connection_string: str = None, container_name: str = None,
+               dst_blob_path: str = None, remove: bool = True) -> str:
+        try:
+            return upload_blob(src_path=src_path, connection_string=connection_string, container_name=container_name,
+                               dst_blob_path=dst_blob_path)
+        finally:
+            self.discard(src_path=src_path, remove=remove)
+
+    def discard(self, src_path: str = None, remove: bool = True):
+        """
+        Remove the local file of an upload that has finished or was cancelled and free its slot
+        """
+        if remove:
+            try:
+                os.remove(src_path)
+            except OSError as e:
+                logger.error(f'Failed to remove {src_path}: {e}')
+        self.slots.release()
+        self.finished()
+
+    def forget(self, future: concurrent.futures.Future = None):
+        with self.condition:
+            self.queued.pop(future, None)
+
+    def cancel(self) -> int:
+        """
+        Cancel the uploads that have not started yet and remove their local files. The uploads in flight go on, wait
+        returns once they have finished. The when_done callbacks of the cancelled outputs get a CancelledError
+        @return: the number of cancelled uploads
+        """
+        with self.condition:
+            queued = list(self.queued.items())
+        cancelled = 0
+        for future, (src_path, remove) in queued:
+            # a future that has started can not be cancelled
+            if future.cancel():
+                self.discard(src_path=src_path, remove=remove)
+                cancelled += 1
+        if cancelled:
+            logger.info(f'Cancelled {cancelled} uploads')
+        return cancelled
+
+    def when_done(self, outputs: dict = None, callback=None):
+        """
+        Call callback(etags, error) once the uploads of outputs have finished, in the worker that finished the last
+        one (right away if they all have finished). etags is a dict of the blob paths and their ETag, error is the
+        first error raised by the uploads or None. The outputs that are not futures are taken as uploaded
+        """
+        futures = [value for value in outputs.values() if isinstance(value, concurrent.futures.Future)]
+        with self.condition:
+            self.outstanding += 1
+        pending = [len(futures)]
+        lock = threading.Lock()
+        context = contextvars.copy_context()
+
+        def settle():
+            try:
+                callback(*resolve_outputs(outputs=outputs))
+            except Exception as e:
+                logger.error(f'Failed to settle the uploads of {", ".join(outputs)}: {e}')
+            finally:
+                self.finished()
+
+        def done(_):
+            with lock:
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            context.run(settle)
+
+        if not futures:
+            settle()
+        for future in futures:
+            future.add_done_callback(done)
+
+    def remove_when_done(self, path: str = None, outputs: dict = None):
+        """
+        Remove the folder path (the temporary folder of a conversion) once the uploads of outputs have finished
+        """
+        self.when_done(outputs=outputs, callback=lambda etags, error: shutil.rmtree(path, ignore_errors=True))
+
+    def finished(self):
+        with self.condition:
+            self.outstanding -= 1
+            self.condition.notify_all()
+
+    def wait(self):
+        """
+        Wait for the uploads queued so far and their callbacks
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.outstanding <= 0)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+
+def resolve_outputs(outputs: dict = None):
+    """
+    Wait for the uploads of outputs
+    @return: tuple(dict of the blob paths and their ETag, the first error raised by the uploads or None)
+    """
+    etags = dict()
+    error = None
+    for blob_path, value in outputs.items():
+        if isinstance(value, concurrent.futures.Future):
+            try:
+                value = value.result()
+            except Exception as e:
+                error = error or e
+                continue
+        etags[blob_path] = value
+    return etags, error
+
+
+def with_upload_queue(convert):
+    """
+    Let a conversion function taking an uploads queue (see UploadQueue) be called without one, its outputs are then
+    uploaded before it returns and it returns the uploaded blobs and their ETag, or an empty dict if an upload failed
+    """
+    @functools.wraps(convert)
+    def wrapper(*args, uploads: UploadQueue = None, **kwargs):
+        if uploads is not None:
+            return convert(*args, uploads=uploads, **kwargs)
+        with UploadQueue() as uploads:
+            outputs = convert(*args, uploads=uploads, **kwargs)
+        etags, error = resolve_outputs(outputs=outputs)
+        return dict() if error else etags
+
+    return wrapper
@@ -11,7 +11,6 @@ import logging
 logger = logging.getLogger(__name__)
 from io import StringIO
 from traceback import print_exc
-from osgeo import gdal
 def chop_blob_url(blob_url: str) -> str:
     """
     Safely extract relative path of the blob from its url using urllib
@@ -91,6 +90,8 @@ def get_progress(offset_perc=30, src_path:str = None):
     @param src_path:
     @return:
     """
+    # GDAL is imported where it is used so the blob path helpers above can be imported without it
+    from osgeo import gdal
     emsg = ''
     try:
         ds = gdal.OpenEx(src_path, gdal.OF_VECTOR)
@@ -123,6 +124,35 @@ def get_progress(offset_perc=30, src_path:str = None):
     return compute_progress(offset=offset_perc, nchunks=nchunks), emsg
 
 
+def describe_dataset(src_path: str = None) -> dict:
+    """
+    Count the vector layers, the raster bands (including the bands of the subdatasets) and the features of a GDAL
+    data file. The features are counted only for the layers that know their feature count without a full scan
+    @return: dict(nlayers, nbands, nfeatures)
+    """
+    from osgeo import gdal
+    nlayers = nbands = nfeatures = 0
+    try:
+        ds = gdal.OpenEx(src_path, gdal.OF_VECTOR)
+        nlayers = ds.GetLayerCount()
+        for i in range(nlayers):
+            nfeatures += max(ds.GetLayerByIndex(i).GetFeatureCount(force=0), 0)
+        del ds
+    except RuntimeError:
+        pass
+    try:
+        ds = gdal.OpenEx(src_path, gdal.OF_RASTER)
+        nbands = ds.RasterCount
+        for subdataset_path, _ in ds.GetSubDatasets():
+            subds = gdal.Open(subdataset_path.replace('\"', ''))
+            nbands += subds.RasterCount
+            del subds
+        del ds
+    except RuntimeError:
+        pass
+    return dict(nlayers=nlayers, nbands=nbands, nfeatures=nfeatures)
+
+
 def cancel_processing(event=None, blob_url:str=None, cancel_event:multiprocessing.Event=None):
     message_data = event.data
     if isinstance(message_data, dict) and 'user' in message_data and 'url' in message_data and 'cancel' in message_data:
@@ -0,0 +1,389 @@
+import asyncio
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import resource
+import signal
+import threading
+from io import StringIO
+from traceback import print_exc
+
+from ingest.azlog import current_blob_url
+from ingest.checkpoint import flush_checkpoints
+from ingest.diagnostics import flush_diagnostics
+from ingest.progress import flush_progress
+
+logger = logging.getLogger(__name__)
+
+# set in the environment of the pool workers. Subprocesses started by a worker (tippecanoe) check it to stay in the
+# worker's process group so they are killed together with the worker
+POOL_WORKER_ENV_VAR = 'INGEST_POOL_WORKER'
+
+
+class WorkerJobError(Exception):
+    """
+    A job has raised an exception inside a worker process. Carries the formatted traceback from the worker.
+    """
+    pass
+
+
+class WorkerKilledError(Exception):
+    """
+    A worker process was killed (or has died) while running a job
+    """
+    pass
+
+
+def in_pool_worker() -> bool:
+    return POOL_WORKER_ENV_VAR in os.environ
+
+
+def peak_rss_mb() -> float:
+    """
+    The peak resident set size of the current process in MB (ru_maxrss is in KB on linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Outbox:
+    """
+    The sending end of the pipe a worker uses to talk to the parent. Several threads of the worker can log at once.
+    Every worker has its own pipe, a worker killed in the middle of a send can only corrupt its own channel.
+    """
+
+    def __init__(self, conn=None):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        with self.lock:
+            self.conn.send(item)
+
+
+class WebsocketProxy:
+    """
+    Stands in for the webpubsub client inside a worker process. The messages are forwarded to the
+    parent process where they are sent through the real client of the job.
+    """
+
+    def __init__(self, outbox: Outbox = None, job_id=None):
+        self.outbox = outbox
+        self.job_id = job_id
+
+    def send_to_group(self, group_name, content=None, data_type=None, **kwargs):
+        self.outbox.put(('ws', self.job_id, (group_name, content, data_type)))
+
+
+class JobQueueHandler(logging.handlers.QueueHandler):
+    """
+    Ships the log records of a worker to the parent process tagged with the id of the job being run
+    """
+
+    def __init__(self, outbox: Outbox = None):
+        super().__init__(outbox)
+        self.job_id = None
+
+    def enqueue(self, record):
+        self.queue.put(('log', self.job_id, record))
+
+
+def terminate_worker(signum=None, frame=None):
+    """
+    SIGTERM handler of the worker processes. The units finished by the running job are written to its checkpoint
+    before the worker exits so the job resumes from there when its message is delivered again. The errors recorded
+    by the job are written to its .error blob.
+    """
+    flush_checkpoints()
+    flush_diagnostics()
+    flush_progress(timeout=1)
+    os._exit(1)
+
+
+def worker_main(conn=None, outbox_conn=None, cancel_event=None, log_level=logging.INFO):
+    """
+    The loop of a pool worker process. Receives (job_id, func, kwargs, has_websocket) tuples over conn,
+    runs func(**kwargs) and sends the log records, websocket messages and finally the result (ok, result, peak_rss)
+    of the job to the parent through outbox_conn. A None job stops the worker.
+    """
+    # become the leader of a new process group so the worker and its subprocesses can be killed at once
+    os.setsid()
+    os.environ[POOL_WORKER_ENV_VAR] = '1'
+    signal.signal(signal.SIGTERM, terminate_worker)
+    outbox = Outbox(conn=outbox_conn)
+    root_logger = logging.getLogger()
+    root_logger.handlers.clear()
+    queue_handler = JobQueueHandler(outbox=outbox)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(log_level)
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        job_id, func, kwargs, has_websocket = job
+        queue_handler.job_id = job_id
+        kwargs['timeout_event'] = cancel_event
+        if has_websocket:
+            kwargs['websocket_client'] = WebsocketProxy(outbox=outbox, job_id=job_id)
+        try:
+            result = func(**kwargs)
+            outbox.put(('result', job_id, (True, result, peak_rss_mb())))
+        except BaseException:
+            with StringIO() as m:
+                print_exc(file=m)
+                outbox.put(('result', job_id, (False, m.getvalue(), peak_rss_mb())))
+        finally:
+            queue_handler.job_id = None
+
+
+class Worker:
+    def __init__(self, process=None, conn=None, outbox_conn=None, cancel_event=None):
+        self.process = process
+        self.conn = conn
+        self.outbox_conn = outbox_conn
+        # synchronisation primitives can only be handed to a process when it is created, so every worker
+        # gets its own event that stands for the timeout_event of the job it runs
+        self.cancel_event = cancel_event
+        self.job_id = None
+        self.njobs = 0
+        self.peak_rss = 0
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def kill(self, grace: float = 0):
+        """
+        Kill the whole process group of the worker, tippecanoe included. With a grace period the group is sent
+        SIGTERM first so the worker can flush the checkpoint of its job.
+        """
+        if grace:
+            self.signal_group(signal.SIGTERM)
+            self.process.join(timeout=grace)
+        # the subprocesses (tippecanoe) can outlive the worker
+        self.signal_group(signal.SIGKILL)
+        self.process.join()
+        self.conn.close()
+
+    def signal_group(self, sig=None):
+        try:
+            os.killpg(self.process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+class ProcessPool:
+    """
+    A pool of pre-forked worker processes used to run sync_ingest outside the main process.
+
+    The workers are forked from a forkserver that has already imported GDAL and rio_cogeo so a new (or recycled)
+    worker starts instantly. Every worker is the leader of its own process group. When the cancel event of a job is
+    set (timeout or cancellation from the websocket) the process group of the worker is killed right away, within
+    poll_interval, which frees its cores and RAM, and a fresh worker takes its place. A cancelled job is not resumed so
+    its checkpoint is not flushed. When the awaiting task is cancelled instead (the consumer is draining) the worker is
+    given kill_grace seconds to flush the checkpoint of the job before it is killed. The workers are also recycled
+    after max_jobs jobs or when their peak RSS exceeds max_rss_mb to get rid of the heap fragmentation GDAL leaves behind.
+
+    The log records, websocket messages and results produced in a worker are sent to the parent through a pipe
+    and handled by a dispatcher thread in the context of the job they belong to. The websocket messages are sent by a
+    sender thread of their own so a slow or reconnecting websocket does not hold up the logs and results of the other
+    workers.
+    """
+
+    def __init__(self, size: int = 1, max_jobs: int = 20, max_rss_mb: int = 4096, poll_interval: float = 0.2,
+                 kill_grace: float = 2):
+        self.size = size
+        self.kill_grace = kill_grace
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.poll_interval = poll_interval
+        self.ctx = multiprocessing.get_context('forkserver')
+        self.ctx.set_forkserver_preload(['ingest.processing'])
+        self.idle = None
+        self.jobs = dict()
+        self.job_ids = itertools.count(1)
+        self.workers = dict()
+        self.dispatcher = None
+        self.outgoing = queue.SimpleQueue()
+        self.sender = None
+        self.stopped = threading.Event()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    async def start(self):
+        self.idle = asyncio.Queue()
+        self.dispatcher = threading.Thread(target=self.dispatch, name='pool-dispatcher', daemon=True)
+        self.dispatcher.start()
+        self.sender = threading.Thread(target=self.send, name='pool-websocket-sender', daemon=True)
+        self.sender.start()
+        workers = await asyncio.gather(*[asyncio.to_thread(self.spawn) for i in range(self.size)])
+        for worker in workers:
+            self.idle.put_nowait(worker)
+        logger.info(f'Started {self.size} ingest worker processes')
+
+    async def stop(self):
+        while not self.idle.empty():
+            worker = self.idle.get_nowait()
+            await asyncio.to_thread(self.retire, worker)
+        self.stopped.set()
+        await asyncio.to_thread(self.dispatcher.join)
+        self.outgoing.put(None)
+        await asyncio.to_thread(self.sender.join)
+
+    def spawn(self) -> Worker:
+        job_reader, job_writer = self.ctx.Pipe(duplex=False)
+        outbox_reader, outbox_writer = self.ctx.Pipe(duplex=False)
+        cancel_event = self.ctx.Event()
+        process = self.ctx.Process(target=worker_main, name='ingest-worker', daemon=True,
+                                   kwargs=dict(conn=job_reader, outbox_conn=outbox_writer, cancel_event=cancel_event,
+                                               log_level=logging.getLogger().level))
+        process.start()
+        # only the worker keeps these ends open so the outbox signals EOF when it dies
+        job_reader.close()
+        outbox_writer.close()
+        worker = Worker(process=process, conn=job_writer, outbox_conn=outbox_reader, cancel_event=cancel_event)
+        self.workers[outbox_reader] = worker
+        logger.debug(f'Spawned ingest worker {process.pid}')
+        return worker
+
+    def retire(self, worker: Worker = None):
+        try:
+            worker.conn.send(None)
+            worker.process.join(timeout=5)
+        except OSError:
+            pass
+        if worker.process.is_alive():
+            worker.kill()
+        else:
+            worker.conn.close()
+
+    def replace(self, worker: Worker = None, kill: bool = False, grace: float = 0) -> Worker:
+        """
+        Dispose worker and return a freshly spawned one in its place
+        """
+        if kill:
+            worker.kill(grace=grace)
+        else:
+            self.retire(worker)
+        return self.spawn()
+
+    def resolve(self, job_id=None, outcome=None):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+
+        def _set_(future=job['future']):
+            if future.done():
+                return
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+        job['loop'].call_soon_threadsafe(_set_)
+
+    def dispatch(self):
+        """
+        Forward the log records and websocket messages produced by the workers and resolve the results of the jobs
+        """
+        while not self.stopped.is_set():
+            for outbox_conn in multiprocessing.connection.wait(list(self.workers), timeout=self.poll_interval):
+                worker = self.workers[outbox_conn]
+                try:
+                    kind, job_id, data = outbox_conn.recv()
+                except (EOFError, OSError):
+                    # the worker has exited or was killed
+                    del self.workers[outbox_conn]
+                    outbox_conn.close()
+                    self.resolve(job_id=worker.job_id,
+                                 outcome=WorkerKilledError(f'Worker {worker.pid} has exited while running '
+                                                           f'job {worker.job_id}'))
+                    continue
+                job = self.jobs.get(job_id, {})
+                try:
+                    if kind == 'result':
+                        self.resolve(job_id=job_id, outcome=data)
+                    elif kind == 'log':
+                        token = current_blob_url.set(job.get('blob_url'))
+                        try:
+                            logging.getLogger(data.name).handle(data)
+                        finally:
+                            current_blob_url.reset(token)
+                    elif kind == 'ws' and job.get('websocket_client'):
+                        self.outgoing.put((job_id, job['websocket_client'], data))
+                except Exception as e:
+                    logger.error(f'Failed to dispatch {kind} message from job {job_id}: {e}')
+
+    def send(self):
+        """
+        Send the websocket messages forwarded by the dispatcher, in the order they were produced
+        """
+        while True:
+            item = self.outgoing.get()
+            if item is None:
+                break
+            job_id, websocket_client, (group_name, content, data_type) = item
+            try:
+                websocket_client.send_to_group(group_name, content=content, data_type=data_type)
+            except Exception as e:
+                logger.error(f'Failed to send the websocket message of job {job_id}: {e}')
+
+    async def run(self, func=None, cancel_event: multiprocessing.Event = None, websocket_client=None,
+                  blob_url: str = None, **kwargs):
+        """
+        Run func(**kwargs) in a worker process and return its result. The worker is killed as soon as
+        cancel_event is set, or after kill_grace seconds when the awaiting task is cancelled.
+        @param func: a picklable (module level) function
+        @param cancel_event: the event signalling a timeout or cancellation of the job
+        @param websocket_client: webpubsub client the messages sent by the worker are forwarded to
+        @param blob_url: the blob being ingested. It is handed to func and used to route the log records of the worker
+        @return: the result of func
+        """
+        worker = await self.idle.get()
+        job_id = next(self.job_ids)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.jobs[job_id] = dict(websocket_client=websocket_client, blob_url=blob_url, future=future, loop=loop)
+        worker.job_id = job_id
+        killed = True
+        grace = self.kill_grace
+        try:
+            worker.conn.send((job_id, func, dict(kwargs, blob_url=blob_url), websocket_client is not None))
+            logger.debug(f'Job {job_id} was sent to ingest worker {worker.pid}')
+            while not future.done():
+                if cancel_event and cancel_event.is_set():
+                    # the job is not resumed, the checkpoint does not need to be flushed
+                    grace = 0
+                    worker.cancel_event.set()
+                    raise WorkerKilledError(f'Job {job_id} running in worker {worker.pid} was cancelled')
+                await asyncio.wait([future], timeout=self.poll_interval)
+            ok, result, worker.peak_rss = future.result()
+            killed = False
+            worker.njobs += 1
+            if not ok:
+                raise WorkerJobError(result)
+            return result
+        finally:
+            self.jobs.pop(job_id, None)
+            worker.job_id = None
+            if killed:
+                logger.info(f'Killing ingest worker {worker.pid} running job {job_id}')
+                self.idle.put_nowait(await asyncio.to_thread(self.replace, worker=worker, kill=True, grace=grace))
+            elif worker.njobs >= self.max_jobs or worker.peak_rss >= self.max_rss_mb:
+                logger.info(f'Recycling ingest worker {worker.pid} after {worker.njobs} jobs '
+                            f'and {worker.peak_rss:.0f} MB peak RSS')
+                self.idle.put_nowait(await asyncio.to_thread(self.replace, worker=worker))
+            else:
+                self.idle.put_nowait(worker)